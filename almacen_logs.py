@@ -0,0 +1,398 @@
+"""
+Almacén de logs de auditoría en archivos de segmentos (opcional).
+
+Los logs se escriben una sola vez y se leen en orden, así que no necesitan
+compartir el servidor MySQL con las ventas. AlmacenLogs los agrega como JSON
+lines a archivos de segmento que rotan por tamaño. Cada segmento tiene un
+índice disperso (id, marca de tiempo y posición cada cierto número de
+registros) en un archivo .idx aparte; las lecturas usan mmap y el índice para
+saltar directo a la zona pedida, hacia adelante o hacia atrás.
+
+Varios procesos pueden usar la misma carpeta: cada operación toma un candado
+exclusivo (fcntl.flock) sobre un archivo de la carpeta y, antes de escribir o
+leer, se pone al día con los segmentos y registros que agregaron o borraron los
+demás. En Windows (sin fcntl) el almacén es de un solo proceso.
+"""
+
+import json
+import mmap
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+PREFIJO = 'segmento-'
+EXT_DATOS = '.jsonl'
+EXT_INDICE = '.idx'
+ARCHIVO_CANDADO = '.candado'
+
+
+class Segmento:
+    """Un archivo de segmento: ids consecutivos desde primer_id y su índice disperso"""
+
+    def __init__(self, directorio, primer_id):
+        self.primer_id = primer_id
+        self.ruta = os.path.join(directorio, f"{PREFIJO}{primer_id:012d}{EXT_DATOS}")
+        self.ruta_indice = self.ruta[:-len(EXT_DATOS)] + EXT_INDICE
+        self.ids = []
+        self.marcas = []
+        self.posiciones = []
+        self.ultimo_id = primer_id - 1
+        self.ultimo_ts = None
+        self.tamano = 0
+
+    @property
+    def primer_ts(self):
+        return self.marcas[0] if self.marcas else None
+
+    def agregar_punto(self, id_registro, ts, posicion):
+        self.ids.append(id_registro)
+        self.marcas.append(ts)
+        self.posiciones.append(posicion)
+
+    def fin_antes_de(self, antes=None, hasta_ts=None):
+        """Posición desde la que no hace falta leer: el primer punto con id >= antes o ts >= hasta_ts"""
+        k = len(self.ids)
+        if antes is not None:
+            k = min(k, bisect_left(self.ids, antes))
+        if hasta_ts is not None:
+            k = min(k, bisect_left(self.marcas, hasta_ts))
+        return self.posiciones[k] if k < len(self.posiciones) else None
+
+    def inicio_desde(self, despues=None, desde_ts=None):
+        """Posición desde la que hay que leer: el último punto con id <= despues y ts < desde_ts"""
+        k = 0
+        if despues is not None:
+            k = max(k, bisect_right(self.ids, despues) - 1)
+        if desde_ts is not None:
+            k = max(k, bisect_left(self.marcas, desde_ts) - 1)
+        return self.posiciones[k] if self.posiciones else 0
+
+
+def abrir_mmap(ruta):
+    """mmap de solo lectura del archivo completo, o None si está vacío o ya no existe"""
+    try:
+        with open(ruta, 'rb') as archivo:
+            if os.fstat(archivo.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+
+def lineas_hacia_atras(mapa, fin):
+    """Líneas completas de mapa[:fin], de la última a la primera"""
+    while fin > 0:
+        inicio = mapa.rfind(b'\n', 0, fin - 1) + 1
+        yield mapa[inicio:fin]
+        fin = inicio
+
+
+def lineas_hacia_adelante(mapa, inicio):
+    """Líneas completas de mapa[inicio:], en orden"""
+    while inicio < len(mapa):
+        fin = mapa.find(b'\n', inicio)
+        if fin < 0:
+            return
+        yield mapa[inicio:fin + 1]
+        inicio = fin + 1
+
+
+class AlmacenLogs:
+    """
+    Logs en archivos de segmento. agregar() escribe al final del segmento actual
+    (rota al superar tamano_segmento) y cada intervalo_indice registros anota un
+    punto del índice disperso. Los ids son consecutivos y las marcas de tiempo no
+    decrecen, por eso el mismo índice sirve para buscar por id y por fecha.
+    """
+
+    def __init__(self, directorio, tamano_segmento=32 * 1024 * 1024, intervalo_indice=256):
+        self.directorio = directorio
+        self.tamano_segmento = tamano_segmento
+        self.intervalo_indice = intervalo_indice
+        self._lock = threading.Lock()
+        self._segmentos = []
+        self._archivo = None
+        self._archivo_indice = None
+        self._ruta_abierta = None
+        self._candado = None
+        self._pid = None
+        os.makedirs(directorio, exist_ok=True)
+        with self._bloqueo(sincronizar=False):
+            self._cargar()
+
+    # ---------------------------------------------------------------- candado
+    @contextmanager
+    def _bloqueo(self, sincronizar=True):
+        """Candado entre hilos y entre procesos; al tomarlo se leen los cambios de los demás procesos"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Primer uso en este proceso (o hijo de un fork): un flock heredado
+                # se comparte con el padre, así que cada proceso abre el suyo
+                self._candado = open(os.path.join(self.directorio, ARCHIVO_CANDADO), 'a')
+                self._archivo = self._archivo_indice = self._ruta_abierta = None
+                self._pid = os.getpid()
+            if fcntl:
+                fcntl.flock(self._candado.fileno(), fcntl.LOCK_EX)
+            try:
+                if sincronizar:
+                    self._sincronizar()
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self._candado.fileno(), fcntl.LOCK_UN)
+
+    def _listar(self):
+        return sorted(
+            int(nombre[len(PREFIJO):-len(EXT_DATOS)])
+            for nombre in os.listdir(self.directorio)
+            if nombre.startswith(PREFIJO) and nombre.endswith(EXT_DATOS)
+        )
+
+    def _sincronizar(self):
+        """
+        Se pone al día con otros procesos: segmentos creados (al rotar) o borrados
+        (podar, limpiar) y registros agregados, que cambian el tamaño del archivo.
+        """
+        primeros = self._listar()
+        conocidos = {s.primer_id: s for s in self._segmentos}
+        ultimo_conocido = self._segmentos[-1].primer_id if self._segmentos else None
+        if primeros != list(conocidos):
+            self._segmentos = [conocidos.get(p) or Segmento(self.directorio, p) for p in primeros]
+
+        # Los segmentos cerrados no cambian: solo pueden haber crecido el que era el
+        # último y los que otro proceso creó después
+        for posicion, segmento in enumerate(self._segmentos):
+            nuevo = segmento.primer_id not in conocidos
+            if not nuevo and segmento.primer_id != ultimo_conocido:
+                continue
+            try:
+                cambiado = os.path.getsize(segmento.ruta) != segmento.tamano
+            except OSError:
+                continue
+            if not nuevo and not cambiado:
+                continue
+            if posicion == len(self._segmentos) - 1:
+                # Un proceso que se cortó a mitad de una escritura deja una línea incompleta
+                self._descartar_linea_incompleta(segmento)
+            segmento.ids, segmento.marcas, segmento.posiciones = [], [], []
+            if not self._leer_indice(segmento):
+                self._reconstruir_indice(segmento)
+            self._leer_ultimo(segmento)
+
+        if self._ruta_abierta and (not self._segmentos or self._segmentos[-1].ruta != self._ruta_abierta):
+            self._cerrar_actual()
+
+    # ------------------------------------------------------------------- carga
+    def _cargar(self):
+        primeros = self._listar()
+        for posicion, primer_id in enumerate(primeros):
+            segmento = Segmento(self.directorio, primer_id)
+            abierto = posicion == len(primeros) - 1
+            if abierto:
+                self._descartar_linea_incompleta(segmento)
+            # El índice del segmento abierto se rehace siempre: puede haber quedado
+            # atrás del archivo de datos si el proceso se cortó entre las dos escrituras
+            if abierto or not self._leer_indice(segmento):
+                self._reconstruir_indice(segmento)
+            self._leer_ultimo(segmento)
+            self._segmentos.append(segmento)
+
+    def _descartar_linea_incompleta(self, segmento):
+        with open(segmento.ruta, 'rb+') as archivo:
+            tamano = archivo.seek(0, os.SEEK_END)
+            if tamano == 0:
+                return
+            archivo.seek(-1, os.SEEK_END)
+            if archivo.read(1) == b'\n':
+                return
+            archivo.seek(0)
+            datos = archivo.read()
+            archivo.truncate(datos.rfind(b'\n') + 1)
+
+    def _leer_indice(self, segmento):
+        try:
+            with open(segmento.ruta_indice, 'r', encoding='utf-8') as archivo:
+                for linea in archivo:
+                    id_registro, ts, posicion = linea.split()
+                    segmento.agregar_punto(int(id_registro), float(ts), int(posicion))
+            return True
+        except (OSError, ValueError):
+            segmento.ids, segmento.marcas, segmento.posiciones = [], [], []
+            return False
+
+    def _reconstruir_indice(self, segmento):
+        segmento.ids, segmento.marcas, segmento.posiciones = [], [], []
+        mapa = abrir_mmap(segmento.ruta)
+        lineas = []
+        if mapa is not None:
+            try:
+                posicion = 0
+                for linea in lineas_hacia_adelante(mapa, 0):
+                    registro = json.loads(linea)
+                    if (registro['id'] - segmento.primer_id) % self.intervalo_indice == 0:
+                        segmento.agregar_punto(registro['id'], registro['ts'], posicion)
+                        lineas.append(f"{registro['id']} {registro['ts']} {posicion}\n")
+                    posicion += len(linea)
+            finally:
+                mapa.close()
+        with open(segmento.ruta_indice, 'w', encoding='utf-8') as archivo:
+            archivo.writelines(lineas)
+
+    def _leer_ultimo(self, segmento):
+        mapa = abrir_mmap(segmento.ruta)
+        if mapa is None:
+            segmento.tamano = 0
+            return
+        try:
+            segmento.tamano = len(mapa)
+            ultima = next(lineas_hacia_atras(mapa, len(mapa)))
+            registro = json.loads(ultima)
+            segmento.ultimo_id = registro['id']
+            segmento.ultimo_ts = registro['ts']
+        finally:
+            mapa.close()
+
+    # ---------------------------------------------------------------- escritura
+    def _abrir_actual(self):
+        segmento = self._segmentos[-1]
+        self._archivo = open(segmento.ruta, 'ab')
+        self._archivo_indice = open(segmento.ruta_indice, 'a', encoding='utf-8')
+        self._ruta_abierta = segmento.ruta
+
+    def _cerrar_actual(self):
+        for archivo in (self._archivo, self._archivo_indice):
+            if archivo:
+                archivo.close()
+        self._archivo = self._archivo_indice = self._ruta_abierta = None
+
+    def _ultimo_id(self):
+        return self._segmentos[-1].ultimo_id if self._segmentos else 0
+
+    def agregar(self, registro):
+        """Agrega un registro (dict serializable) y devuelve su id"""
+        with self._bloqueo():
+            actual = self._segmentos[-1] if self._segmentos else None
+            if actual is None or actual.tamano >= self.tamano_segmento:
+                self._cerrar_actual()
+                actual = Segmento(self.directorio, self._ultimo_id() + 1)
+                self._segmentos.append(actual)
+            if self._archivo is None:
+                self._abrir_actual()
+
+            id_registro = actual.ultimo_id + 1
+            ts = round(max(time.time(), actual.ultimo_ts or 0), 3)
+            linea = json.dumps(
+                {'id': id_registro, 'ts': ts, **registro},
+                ensure_ascii=False, separators=(',', ':'), default=str
+            ).encode('utf-8') + b'\n'
+
+            posicion = actual.tamano
+            self._archivo.write(linea)
+            self._archivo.flush()
+            if (id_registro - actual.primer_id) % self.intervalo_indice == 0:
+                self._archivo_indice.write(f"{id_registro} {ts} {posicion}\n")
+                self._archivo_indice.flush()
+                actual.agregar_punto(id_registro, ts, posicion)
+
+            actual.tamano += len(linea)
+            actual.ultimo_id = id_registro
+            actual.ultimo_ts = ts
+            return id_registro
+
+    # ------------------------------------------------------------------ lectura
+    def hacia_atras(self, antes=None, hasta_ts=None):
+        """Registros con id < antes y ts < hasta_ts, del más reciente al más antiguo"""
+        with self._bloqueo():
+            segmentos = list(self._segmentos)
+        for segmento in reversed(segmentos):
+            if antes is not None and segmento.primer_id >= antes:
+                continue
+            if hasta_ts is not None and segmento.primer_ts is not None and segmento.primer_ts >= hasta_ts:
+                continue
+            mapa = abrir_mmap(segmento.ruta)
+            if mapa is None:
+                continue
+            try:
+                fin = segmento.fin_antes_de(antes, hasta_ts)
+                if fin is None:
+                    # Hasta el último salto de línea: una escritura en curso puede dejar una línea a medias
+                    fin = mapa.rfind(b'\n') + 1
+                for linea in lineas_hacia_atras(mapa, fin):
+                    registro = json.loads(linea)
+                    if antes is not None and registro['id'] >= antes:
+                        continue
+                    if hasta_ts is not None and registro['ts'] >= hasta_ts:
+                        continue
+                    yield registro
+            finally:
+                mapa.close()
+
+    def hacia_adelante(self, despues=None, desde_ts=None):
+        """Registros con id > despues y ts >= desde_ts, del más antiguo al más reciente"""
+        with self._bloqueo():
+            segmentos = list(self._segmentos)
+        for segmento in segmentos:
+            if despues is not None and segmento.ultimo_id <= despues:
+                continue
+            if desde_ts is not None and segmento.ultimo_ts is not None and segmento.ultimo_ts < desde_ts:
+                continue
+            mapa = abrir_mmap(segmento.ruta)
+            if mapa is None:
+                continue
+            try:
+                for linea in lineas_hacia_adelante(mapa, segmento.inicio_desde(despues, desde_ts)):
+                    registro = json.loads(linea)
+                    if despues is not None and registro['id'] <= despues:
+                        continue
+                    if desde_ts is not None and registro['ts'] < desde_ts:
+                        continue
+                    yield registro
+            finally:
+                mapa.close()
+
+    # ------------------------------------------------------------------ limpieza
+    def podar(self, antes_ts):
+        """Borra los segmentos cerrados cuyo último registro es anterior a antes_ts y devuelve sus nombres"""
+        with self._bloqueo():
+            vencidos = [
+                s for s in self._segmentos[:-1]
+                if s.ultimo_ts is not None and s.ultimo_ts < antes_ts
+            ]
+            self._segmentos = [s for s in self._segmentos if s not in vencidos]
+            for segmento in vencidos:
+                self._borrar_segmento(segmento)
+        return [os.path.basename(s.ruta) for s in vencidos]
+
+    def limpiar(self):
+        """Borra todos los segmentos; los ids vuelven a empezar en 1"""
+        with self._bloqueo():
+            self._cerrar_actual()
+            segmentos, self._segmentos = self._segmentos, []
+            for segmento in segmentos:
+                self._borrar_segmento(segmento)
+
+    def _borrar_segmento(self, segmento):
+        # Se borran bajo el candado: otro proceso no puede ver uno a medio borrar
+        for ruta in (segmento.ruta, segmento.ruta_indice):
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    def metricas(self):
+        with self._bloqueo():
+            segmentos = list(self._segmentos)
+        return {
+            'segmentos': len(segmentos),
+            'bytes': sum(s.tamano for s in segmentos),
+            'ultimo_id': segmentos[-1].ultimo_id if segmentos else 0,
+            'tamano_segmento': self.tamano_segmento,
+            'intervalo_indice': self.intervalo_indice,
+        }
@@ -0,0 +1,351 @@
+"""
+Motor de analítica del Sistema de Inventario H&D.
+
+Carga ventas y productos en DataFrames columnares (pandas/NumPy) a partir de
+lotes de filas del cursor de MySQL y calcula agrupaciones, márgenes, períodos
+y rankings con operaciones vectorizadas en lugar de ciclos por fila.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# ---------------------------------------------------------------------------------
+# TIPOS DE COLUMNA
+# ---------------------------------------------------------------------------------
+TIPOS_VENTAS = {
+    'id': 'int64',
+    'fecha': 'datetime64[ns]',
+    'producto_id': 'int64',
+    'producto_nombre': 'category',
+    'categoria': 'category',
+    'cantidad': 'int64',
+    'precio_unitario': 'float64',
+    'iva_total': 'float64',
+    'ganancia_unitaria': 'float64',
+    'ganancia_total': 'float64',
+    'total': 'float64',
+}
+
+TIPOS_PRODUCTOS = {
+    'id': 'int64',
+    'nombre': 'object',
+    'categoria': 'category',
+    'stock': 'int64',
+    'precio_unitario': 'float64',
+    'valor_total': 'float64',
+}
+
+TIPOS_IVA = {
+    'anio': 'int64',
+    'mes': 'int64',
+    'num_ventas': 'int64',
+    'total_vendido': 'float64',
+    'iva_total': 'float64',
+}
+
+TIPOS_RENTABILIDAD = {
+    'producto_id': 'int64',
+    'nombre': 'object',
+    'categoria': 'category',
+    'num_ventas': 'int64',
+    'cantidad_vendida': 'int64',
+    'total_vendido': 'float64',
+    'ganancia_unitaria_promedio': 'float64',
+    'ganancia_total': 'float64',
+}
+
+
+def _tipar(df, tipos):
+    """Convierte las columnas conocidas a tipos compactos (Decimal -> float64, DATE -> datetime64)"""
+    for columna, tipo in tipos.items():
+        if columna not in df.columns or tipo == 'category':
+            continue
+        if tipo.startswith('datetime'):
+            df[columna] = pd.to_datetime(df[columna], errors='coerce')
+        elif tipo == 'object':
+            continue
+        else:
+            df[columna] = pd.to_numeric(df[columna], errors='coerce').fillna(0).astype(tipo)
+    return df
+
+
+def cargar_frame(lotes, tipos):
+    """
+    Construye un DataFrame a partir de un iterable de lotes (listas de dicts).
+
+    Cada lote se convierte a columnas tipadas y se descarta, de modo que en memoria
+    solo conviven las columnas NumPy y un lote de filas a la vez.
+    """
+    partes = []
+    for lote in lotes:
+        if lote:
+            partes.append(_tipar(pd.DataFrame.from_records(lote), tipos))
+
+    if not partes:
+        return pd.DataFrame({c: pd.Series(dtype=t) for c, t in tipos.items()})
+
+    df = pd.concat(partes, ignore_index=True)
+    for columna, tipo in tipos.items():
+        if tipo == 'category' and columna in df.columns:
+            df[columna] = df[columna].fillna('Sin categoría').astype('category')
+    return df
+
+
+def cargar_ventas(lotes):
+    """DataFrame de ventas desde lotes del cursor"""
+    return cargar_frame(lotes, TIPOS_VENTAS)
+
+
+def cargar_productos(lotes):
+    """DataFrame de productos desde lotes del cursor"""
+    return cargar_frame(lotes, TIPOS_PRODUCTOS)
+
+
+def a_registros(df):
+    """Convierte un DataFrame a lista de dicts con tipos nativos de Python (para Jinja/JSON)"""
+    if df.empty:
+        return []
+    return [
+        {k: (v.item() if isinstance(v, np.generic) else v) for k, v in fila.items()}
+        for fila in df.to_dict('records')
+    ]
+
+
+# ---------------------------------------------------------------------------------
+# AGRUPACIONES Y MÉTRICAS
+# ---------------------------------------------------------------------------------
+def agrupar_ventas(df, claves):
+    """Suma cantidad, ingresos, IVA y ganancia por las claves indicadas"""
+    agregados = {
+        'cantidad': ('cantidad', 'sum'),
+        'ingresos': ('total', 'sum'),
+        'num_ventas': ('total', 'size'),
+    }
+    if 'iva_total' in df.columns:
+        agregados['iva_total'] = ('iva_total', 'sum')
+    if 'ganancia_total' in df.columns:
+        agregados['ganancia_total'] = ('ganancia_total', 'sum')
+
+    return df.groupby(claves, observed=True, sort=False).agg(**agregados)
+
+
+def calcular_margenes(df, ganancia='ganancia_total', total='total_vendido'):
+    """Margen porcentual vectorizado; 0 cuando no hubo ventas"""
+    ganancias = df[ganancia].to_numpy(dtype='float64')
+    totales = df[total].to_numpy(dtype='float64')
+    margen = np.zeros_like(totales)
+    np.divide(ganancias, totales, out=margen, where=totales > 0)
+    return margen * 100
+
+
+def ranking(df, columna, n=None, ascendente=False):
+    """Ordena por una columna; con n usa nlargest/nsmallest (selección parcial)"""
+    if n is None:
+        return df.sort_values(columna, ascending=ascendente, kind='stable')
+    if ascendente:
+        return df.nsmallest(n, columna)
+    return df.nlargest(n, columna)
+
+
+def ventas_por_periodo(df):
+    """
+    Agrupa las ventas por día y por mes.
+
+    Devuelve dos listas ordenadas de la más reciente a la más antigua con
+    las claves fecha/mes, cantidad, ingresos y num_ventas.
+    """
+    if df.empty:
+        return [], []
+
+    diario = agrupar_ventas(df.dropna(subset=['fecha']), 'fecha')[['cantidad', 'ingresos', 'num_ventas']]
+    diario = diario.sort_index(ascending=False)
+
+    mensual = diario.groupby(diario.index.to_period('M')).sum().sort_index(ascending=False)
+
+    por_dia = diario.reset_index()
+    por_dia['fecha'] = por_dia['fecha'].dt.strftime('%Y-%m-%d')
+
+    por_mes = mensual.reset_index().rename(columns={'fecha': 'mes'})
+    por_mes['mes'] = por_mes['mes'].astype(str)
+
+    return a_registros(por_dia), a_registros(por_mes)
+
+
+def totales_inventario(df):
+    """Totales del inventario: ítems, unidades y valor (stock * precio sin IVA)"""
+    stock = df['stock'].to_numpy(dtype='int64') if not df.empty else np.zeros(0, dtype='int64')
+    precio = df['precio_unitario'].to_numpy(dtype='float64') if not df.empty else np.zeros(0)
+    return {
+        'total_items': int(len(df)),
+        'total_unidades': int(stock.sum()),
+        'valor_total': float(np.dot(stock, precio)),
+    }
+
+
+def valor_por_producto(df, decimales=2):
+    """Columna vectorizada stock * precio unitario redondeada"""
+    return np.round(df['stock'].to_numpy(dtype='float64') * df['precio_unitario'].to_numpy(dtype='float64'), decimales)
+
+
+def rentabilidad_desde_rollup(filas, ordenar='ganancia'):
+    """
+    Separa el resultado de un GROUP BY categoria, producto_id WITH ROLLUP en
+    filas por producto y subtotales por categoría, y calcula márgenes y
+    promedios de forma vectorizada. La fila del total general se descarta.
+    """
+    crudo = pd.DataFrame.from_records(filas or [], columns=list(TIPOS_RENTABILIDAD))
+    es_producto = crudo['producto_id'].notna()
+    es_subtotal = ~es_producto & crudo['categoria'].notna()
+
+    productos = _tipar(crudo[es_producto].copy(), TIPOS_RENTABILIDAD)
+    productos['margen_porcentaje'] = calcular_margenes(productos)
+    productos = ranking(productos, 'cantidad_vendida' if ordenar == 'cantidad' else 'ganancia_total')
+
+    categorias = _tipar(crudo[es_subtotal].copy(), TIPOS_RENTABILIDAD)
+    categorias = categorias[['categoria', 'cantidad_vendida', 'ganancia_total']].rename(
+        columns={'cantidad_vendida': 'unidades_vendidas'}
+    )
+    num_productos = productos.groupby('categoria', sort=False).size()
+    categorias['num_productos'] = categorias['categoria'].map(num_productos).fillna(0).astype('int64')
+
+    ganancias = categorias['ganancia_total'].to_numpy(dtype='float64')
+    cantidades = categorias['num_productos'].to_numpy(dtype='float64')
+    promedio = np.zeros_like(ganancias)
+    np.divide(ganancias, cantidades, out=promedio, where=cantidades > 0)
+    categorias['ganancia_promedio'] = promedio
+
+    return productos, ranking(categorias, 'ganancia_total')
+
+
+# ---------------------------------------------------------------------------------
+# SERIES TEMPORALES
+# ---------------------------------------------------------------------------------
+FRECUENCIAS_SERIE = {
+    'hora': 'h',
+    'dia': 'D',
+    'semana': 'W-MON',
+    'mes': 'MS',
+}
+
+
+def inicio_intervalo(fecha, intervalo):
+    """Inicio del intervalo que contiene la fecha (la semana empieza el lunes)"""
+    fecha = pd.Timestamp(fecha).normalize()
+    if intervalo == 'semana':
+        return fecha - pd.Timedelta(days=fecha.weekday())
+    if intervalo == 'mes':
+        return fecha.replace(day=1)
+    return fecha
+
+
+def fin_intervalo(fecha, intervalo):
+    """Último día del intervalo que contiene la fecha"""
+    fecha = pd.Timestamp(fecha).normalize()
+    if intervalo == 'semana':
+        return fecha + pd.Timedelta(days=6 - fecha.weekday())
+    if intervalo == 'mes':
+        return fecha + pd.offsets.MonthEnd(0)
+    return fecha
+
+
+def contar_intervalos(desde, hasta, intervalo):
+    """Número de intervalos que cubren el rango, sin generarlos"""
+    inicio, fin = inicio_intervalo(desde, intervalo), fin_intervalo(hasta, intervalo)
+    if intervalo == 'mes':
+        return (fin.year - inicio.year) * 12 + fin.month - inicio.month + 1
+    dias = (fin - inicio).days + 1
+    if intervalo == 'hora':
+        return dias * 24
+    if intervalo == 'semana':
+        return dias // 7
+    return dias
+
+
+def elegir_intervalo(desde, hasta, intervalo, max_puntos):
+    """
+    El intervalo pedido o el siguiente más grueso (hora < día < semana < mes)
+    con el que el rango cabe en max_puntos; mes si ninguno cabe.
+    """
+    orden = list(FRECUENCIAS_SERIE)
+    for candidato in orden[orden.index(intervalo):]:
+        if contar_intervalos(desde, hasta, candidato) <= max_puntos:
+            return candidato
+    return orden[-1]
+
+
+def intervalos_serie(desde, hasta, intervalo):
+    """Inicios de todos los intervalos entre desde y hasta (ambos días incluidos)"""
+    fin = fin_intervalo(hasta, intervalo)
+    if intervalo == 'hora':
+        fin = fin + pd.Timedelta(hours=23)
+    return pd.date_range(inicio_intervalo(desde, intervalo), fin, freq=FRECUENCIAS_SERIE[intervalo])
+
+
+def serie_temporal(filas, desde, hasta, intervalo, max_puntos):
+    """
+    Convierte filas agregadas (inicio, num_ventas, cantidad, ingresos) en una serie
+    continua: los intervalos sin ventas van en cero y, si hay más de max_puntos,
+    se suman grupos de intervalos consecutivos. Devuelve (puntos, intervalos_por_punto).
+    """
+    indice = intervalos_serie(desde, hasta, intervalo)
+    columnas = ['num_ventas', 'cantidad', 'ingresos']
+
+    datos = pd.DataFrame.from_records(filas or [], columns=['inicio'] + columnas)
+    datos['inicio'] = pd.to_datetime(datos['inicio'])
+    for columna in columnas:
+        datos[columna] = pd.to_numeric(datos[columna], errors='coerce').fillna(0)
+    serie = datos.groupby('inicio').sum().reindex(indice, fill_value=0)
+
+    por_punto = max(1, int(np.ceil(len(serie) / max_puntos)))
+    if por_punto > 1:
+        grupos = np.arange(len(serie)) // por_punto
+        inicios = serie.index[::por_punto]
+        serie = serie.groupby(grupos).sum()
+        serie.index = inicios
+
+    serie['num_ventas'] = serie['num_ventas'].astype('int64')
+    serie['cantidad'] = serie['cantidad'].astype('int64')
+    serie['ingresos'] = serie['ingresos'].astype('float64')
+
+    formato = '%Y-%m-%d %H:%M' if intervalo == 'hora' else '%Y-%m-%d'
+    serie.index = serie.index.strftime(formato)
+    return a_registros(serie.rename_axis('inicio').reset_index()), por_punto
+
+
+# ---------------------------------------------------------------------------------
+# PUNTOS DE REORDEN
+# ---------------------------------------------------------------------------------
+def puntos_reorden(filas, producto_ids, hasta, dias, dias_reposicion, factor_seguridad, minimo=1):
+    """
+    Velocidad de venta diaria y punto de reorden por producto.
+
+    filas: ventas diarias (producto_id, fecha, cantidad) de los `dias` que terminan en `hasta`.
+    Se arma una matriz producto x día (días sin ventas en cero) y por fila se calcula
+    la media y la desviación de la demanda diaria:
+
+        punto = ceil(media * dias_reposicion + factor_seguridad * desviación * sqrt(dias_reposicion))
+
+    con un piso de `minimo`, para que un producto agotado siempre quede en alerta.
+    """
+    ids = pd.Index(producto_ids, dtype='int64')
+    demanda = np.zeros((len(ids), dias))
+
+    datos = pd.DataFrame.from_records(filas or [], columns=['producto_id', 'fecha', 'cantidad'])
+    if not datos.empty:
+        inicio = pd.Timestamp(hasta).normalize() - pd.Timedelta(days=dias - 1)
+        columna = (pd.to_datetime(datos['fecha']) - inicio).dt.days.to_numpy()
+        fila = ids.get_indexer(datos['producto_id'].astype('int64'))
+        validas = (fila >= 0) & (columna >= 0) & (columna < dias)
+        np.add.at(demanda, (fila[validas], columna[validas]),
+                  pd.to_numeric(datos['cantidad']).to_numpy(dtype='float64')[validas])
+
+    velocidad = demanda.mean(axis=1)
+    desviacion = demanda.std(axis=1)
+    punto = np.ceil(velocidad * dias_reposicion + factor_seguridad * desviacion * np.sqrt(dias_reposicion))
+
+    return pd.DataFrame({
+        'producto_id': ids,
+        'velocidad_diaria': np.round(velocidad, 3),
+        'punto_reorden': np.maximum(punto, minimo).astype('int64'),
+    })
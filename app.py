@@ -4,14 +4,24 @@
 from flask import Flask, request, render_template, redirect, url_for, flash, send_file, session, jsonify
 import json
 import os
-from datetime import datetime
-from collections import defaultdict
+import math
+import re
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from itertools import islice, takewhile
 import pymysql
 from flask_wtf import CSRFProtect
 import openpyxl
-import pandas as pd
+import analitica
+import exportador
+from cache import VersionesDatos, CacheReportes, CacheArchivos, CacheTTL, enlazar_o_copiar
+from planificador import PlanificadorReportes
+from trabajos import GestorTrabajos, LimiteTrabajosExcedido, LISTO
+import importador
+from almacen_logs import AlmacenLogs
+from seguridad import HashContrasenas, HashSaturado, LimitadorIntentos
 
 
 app = Flask(__name__)
@@ -35,6 +45,18 @@ def formato_colombiano(valor, decimales=3):
     
     return texto
 
+@app.template_filter('edad_legible')
+def edad_legible(segundos):
+    """Convierte una edad en segundos a texto corto: "45 s", "12 min", "3 h" """
+    if segundos is None:
+        return '-'
+    segundos = int(segundos)
+    if segundos < 60:
+        return f"{segundos} s"
+    if segundos < 3600:
+        return f"{segundos // 60} min"
+    return f"{segundos // 3600} h {segundos % 3600 // 60} min"
+
 app.secret_key = "dev_secret_key_change_in_production"
 
 # Headers de seguridad
@@ -58,6 +80,37 @@ def get_db_connection():
     )
 
 
+# ejecutar_query, ejecutar_transaccion e iterar_query silencian los errores y
+# devuelven None o un resultado vacío. Cada error se cuenta por hilo, para que
+# quien guarda resultados en caché pueda saber si alguna consulta falló.
+_errores_db = threading.local()
+
+
+class ErrorBaseDatos(Exception):
+    """Alguna consulta falló (y se silenció) mientras se calculaba un resultado"""
+
+
+def errores_db_hilo():
+    """Cantidad de errores de base de datos silenciados en el hilo actual"""
+    return getattr(_errores_db, 'total', 0)
+
+
+def contar_error_db():
+    _errores_db.total = errores_db_hilo() + 1
+
+
+def sin_errores_db(calcular):
+    """Envuelve calcular(**parametros) para que lance ErrorBaseDatos si alguna consulta falló"""
+    @wraps(calcular)
+    def envuelta(**parametros):
+        errores = errores_db_hilo()
+        resultado = calcular(**parametros)
+        if errores_db_hilo() != errores:
+            raise ErrorBaseDatos(f"Falló una consulta al calcular {calcular.__name__}")
+        return resultado
+    return envuelta
+
+
 def ejecutar_query(query, params=None, commit=False, fetch_one=False, fetch_all=False):
     """
     Función auxiliar para ejecutar consultas SQL de forma segura.
@@ -71,6 +124,7 @@ def ejecutar_query(query, params=None, commit=False, fetch_one=False, fetch_all=
         
         if commit:
             connection.commit()
+            notificar_escritura(query)
             last_id = cursor.lastrowid
             return last_id
         
@@ -85,6 +139,7 @@ def ejecutar_query(query, params=None, commit=False, fetch_one=False, fetch_all=
         return None
         
     except Exception as e:
+        contar_error_db()
         print(f" Error en la base de datos: {e}")
         import logging
         logging.error(f"Error DB: {e}")
@@ -98,10 +153,490 @@ def ejecutar_query(query, params=None, commit=False, fetch_one=False, fetch_all=
             connection.close()
 
 
+def ejecutar_transaccion(sentencias):
+    """
+    Ejecuta una lista de (query, params) en una sola transacción.
+    Devuelve el lastrowid de la primera sentencia, o None si algo falla (rollback).
+    """
+    connection = None
+    cursor = None
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        primer_id = None
+
+        for indice, (query, params) in enumerate(sentencias):
+            cursor.execute(query, params or ())
+            if indice == 0:
+                primer_id = cursor.lastrowid
+
+        connection.commit()
+        for query, _ in sentencias:
+            notificar_escritura(query)
+        return primer_id
+
+    except Exception as e:
+        contar_error_db()
+        print(f" Error en la base de datos: {e}")
+        import logging
+        logging.error(f"Error DB: {e}")
+        if connection:
+            connection.rollback()
+        return None
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+_SENTENCIA_ESCRITURA = re.compile(
+    r'^\s*(?:INSERT\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE\s+TABLE|ALTER\s+TABLE)\s+`?(\w+)',
+    re.IGNORECASE
+)
+
+
+def notificar_escritura(query):
+    """Incrementa la versión de datos de la tabla modificada por la consulta"""
+    coincidencia = _SENTENCIA_ESCRITURA.match(query)
+    if coincidencia:
+        versiones_datos.incrementar(coincidencia.group(1).lower())
+
+
+def iterar_query(query, params=None, tamano_lote=5000):
+    """
+    Ejecuta una consulta con cursor del lado del servidor (SSDictCursor) y
+    entrega los resultados en lotes, sin cargar todo el resultado en memoria.
+    """
+    connection = None
+    cursor = None
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+        cursor.execute(query, params or ())
+
+        while True:
+            lote = cursor.fetchmany(tamano_lote)
+            if not lote:
+                break
+            yield lote
+
+    except Exception as e:
+        contar_error_db()
+        print(f" Error en la base de datos: {e}")
+        import logging
+        logging.error(f"Error DB: {e}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+class Instantanea:
+    """
+    Consultas de solo lectura sobre una misma transacción con snapshot consistente:
+    todas ven los datos tal como estaban al abrirla, aunque entren ventas en medio.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def consultar(self, query, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, params or ())
+            return cursor.fetchall()
+
+    def consultar_uno(self, query, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, params or ())
+            return cursor.fetchone()
+
+    def iterar(self, query, params=None, tamano_lote=5000):
+        """Como iterar_query; hay que consumirlo entero antes de la siguiente consulta"""
+        with self.connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute(query, params or ())
+            while True:
+                lote = cursor.fetchmany(tamano_lote)
+                if not lote:
+                    break
+                yield lote
+
+
+@contextmanager
+def instantanea_consistente():
+    """
+    Abre una transacción READ ONLY con WITH CONSISTENT SNAPSHOT (InnoDB, REPEATABLE
+    READ) en una sola conexión. A diferencia de ejecutar_query, los errores no se
+    silencian: quien la usa necesita saber si la instantánea quedó incompleta.
+    """
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+        yield Instantanea(connection)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+# ---------------------------------------------------------------------------------
+# ESQUEMA E ÍNDICES
+# ---------------------------------------------------------------------------------
+TABLAS = [
+    """
+    CREATE TABLE IF NOT EXISTS resumen_iva_mensual (
+        anio SMALLINT NOT NULL,
+        mes TINYINT NOT NULL,
+        num_ventas INT NOT NULL DEFAULT 0,
+        total_vendido DECIMAL(18, 3) NOT NULL DEFAULT 0,
+        iva_total DECIMAL(18, 3) NOT NULL DEFAULT 0,
+        PRIMARY KEY (anio, mes)
+    ) ENGINE=InnoDB
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS resumen_ventas_diario (
+        fecha DATE NOT NULL,
+        producto_id INT NOT NULL,
+        categoria VARCHAR(100) NULL,
+        num_ventas INT NOT NULL DEFAULT 0,
+        cantidad INT NOT NULL DEFAULT 0,
+        ingresos DECIMAL(18, 3) NOT NULL DEFAULT 0,
+        PRIMARY KEY (fecha, producto_id),
+        KEY idx_resumen_diario_producto (producto_id, fecha),
+        KEY idx_resumen_diario_categoria (categoria, fecha)
+    ) ENGINE=InnoDB
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS resumen_ventas_mensual (
+        anio SMALLINT NOT NULL,
+        mes TINYINT NOT NULL,
+        producto_id INT NOT NULL,
+        categoria VARCHAR(100) NULL,
+        num_ventas INT NOT NULL DEFAULT 0,
+        cantidad INT NOT NULL DEFAULT 0,
+        ingresos DECIMAL(18, 3) NOT NULL DEFAULT 0,
+        PRIMARY KEY (anio, mes, producto_id),
+        KEY idx_resumen_mensual_producto (producto_id, anio, mes),
+        KEY idx_resumen_mensual_categoria (categoria, anio, mes)
+    ) ENGINE=InnoDB
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS resumen_logs_diario (
+        fecha DATE NOT NULL,
+        usuario VARCHAR(100) NOT NULL,
+        accion VARCHAR(255) NOT NULL,
+        total INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (fecha, usuario, accion),
+        KEY idx_resumen_logs_usuario (usuario, fecha),
+        KEY idx_resumen_logs_accion (accion, fecha)
+    ) ENGINE=InnoDB
+    """,
+    # Índice de búsqueda de logs: logs está particionada y MySQL no admite FULLTEXT
+    # en tablas particionadas, así que el texto y las referencias extraídas viven aquí
+    """
+    CREATE TABLE IF NOT EXISTS logs_busqueda (
+        log_id INT NOT NULL PRIMARY KEY,
+        fecha DATE NOT NULL,
+        usuario VARCHAR(100) NOT NULL,
+        accion VARCHAR(255) NOT NULL,
+        detalle TEXT NULL,
+        producto_id INT NULL,
+        venta_id INT NULL,
+        monto DECIMAL(18, 3) NULL,
+        KEY idx_logs_busqueda_producto (producto_id, log_id),
+        KEY idx_logs_busqueda_venta (venta_id, log_id),
+        KEY idx_logs_busqueda_usuario_monto (usuario, monto),
+        KEY idx_logs_busqueda_fecha (fecha),
+        FULLTEXT KEY ft_logs_busqueda (accion, detalle)
+    ) ENGINE=InnoDB
+    """,
+]
+
+COLUMNAS = [
+    # (tabla, columna, definición) — en orden, bajo_stock depende de punto_reorden
+    ('productos', 'velocidad_diaria', "DECIMAL(10, 3) NOT NULL DEFAULT 0"),
+    # Punto de reorden inicial de 5 unidades, hasta que se calcula con las ventas del producto
+    ('productos', 'punto_reorden', "INT NOT NULL DEFAULT 5"),
+    ('productos', 'bajo_stock', "TINYINT(1) AS (stock < punto_reorden) STORED"),
+]
+
+INDICES = [
+    # (tabla, nombre, columnas)
+    ('ventas', 'idx_ventas_fecha', 'fecha'),
+    ('ventas', 'idx_ventas_producto_fecha', 'producto_id, fecha'),
+    ('productos', 'idx_productos_bajo_stock', 'bajo_stock, stock'),
+    # InnoDB agrega la clave primaria al final de cada índice: filtrando por usuario
+    # o acción el visor de logs recorre el índice ya ordenado por id. Con un rango
+    # de fechas pagina por (fecha, id), que es el orden de idx_logs_fecha
+    ('logs', 'idx_logs_usuario', 'usuario'),
+    ('logs', 'idx_logs_accion', 'accion'),
+    ('logs', 'idx_logs_fecha', 'fecha'),
+]
+
+
+def agregar_columna_si_falta(tabla, columna, definicion):
+    """Agrega una columna solo si todavía no existe"""
+    existe = ejecutar_query(
+        """
+        SELECT COUNT(*) as total
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """,
+        (tabla, columna),
+        fetch_one=True
+    )
+    if existe and existe.get('total', 0) > 0:
+        return False
+
+    ejecutar_query(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}", commit=True)
+    return True
+
+
+def existe_indice(tabla, nombre):
+    """True si la tabla ya tiene un índice con ese nombre"""
+    existe = ejecutar_query(
+        """
+        SELECT COUNT(*) as total
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """,
+        (tabla, nombre),
+        fetch_one=True
+    )
+    return bool(existe and existe.get('total', 0) > 0)
+
+
+def crear_indice_si_falta(tabla, nombre, columnas, unico=False):
+    """Crea un índice solo si todavía no existe (MySQL no soporta IF NOT EXISTS)"""
+    if existe_indice(tabla, nombre):
+        return False
+
+    tipo = "UNIQUE INDEX" if unico else "INDEX"
+    ejecutar_query(f"CREATE {tipo} {nombre} ON {tabla} ({columnas})", commit=True)
+    return True
+
+
+# Estado de uq_productos_sku. Sin ese índice el upsert de la importación
+# insertaría filas repetidas en vez de actualizar, así que importar se bloquea
+# y se informan los SKU repetidos que impiden crearlo
+indice_sku = {'listo': False, 'conflictos': []}
+_indice_sku_lock = threading.Lock()
+
+
+def preparar_indice_sku():
+    """
+    Crea el índice único sobre productos.codigo_sku que usa la importación desde
+    Excel. El SKU es opcional en los formularios y se guardaba como '', así que
+    la columna pasa a aceptar NULL y los vacíos se convierten en NULL antes.
+    Deja en indice_sku si el índice existe y, si no, qué SKU lo impiden.
+    """
+    columna = ejecutar_query(
+        """
+        SELECT column_type, is_nullable
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = 'productos' AND column_name = 'codigo_sku'
+        """,
+        fetch_one=True
+    )
+    if not columna:
+        return False
+
+    if columna.get('is_nullable') == 'NO':
+        ejecutar_query(f"ALTER TABLE productos MODIFY codigo_sku {columna['column_type']} NULL", commit=True)
+    ejecutar_query("UPDATE productos SET codigo_sku = NULL WHERE codigo_sku = ''", commit=True)
+
+    duplicados = ejecutar_query(
+        """
+        SELECT codigo_sku, COUNT(*) as total
+        FROM productos
+        WHERE codigo_sku IS NOT NULL
+        GROUP BY codigo_sku
+        HAVING COUNT(*) > 1
+        LIMIT 10
+        """,
+        fetch_all=True
+    )
+    if duplicados and not existe_indice('productos', 'uq_productos_sku'):
+        conflictos = [str(d['codigo_sku']) for d in duplicados]
+        print(f"❌ No se puede crear el índice único de SKU, hay códigos repetidos: {', '.join(conflictos)}")
+        indice_sku.update(listo=False, conflictos=conflictos)
+        return False
+
+    creado = crear_indice_si_falta('productos', 'uq_productos_sku', 'codigo_sku', unico=True)
+    indice_sku.update(listo=existe_indice('productos', 'uq_productos_sku'), conflictos=[])
+    return creado
+
+
+def error_indice_sku():
+    """
+    None si existe el índice único de SKU; si no, reintenta crearlo (los SKU
+    repetidos pudieron corregirse desde que arrancó el proceso) y devuelve el
+    mensaje de error para quien quiera importar.
+    """
+    if not indice_sku['listo']:
+        with _indice_sku_lock:
+            if not indice_sku['listo']:
+                try:
+                    preparar_indice_sku()
+                except Exception as e:
+                    print(f"❌ Error al preparar el índice de SKU: {e}")
+    if indice_sku['listo']:
+        return None
+    if indice_sku['conflictos']:
+        return ("No se puede importar: hay productos con el mismo código SKU. "
+                f"Corrige estos SKU repetidos: {', '.join(indice_sku['conflictos'])}")
+    return "No se puede importar: no se pudo verificar el índice único de SKU"
+
+
+def asegurar_esquema():
+    """Crea las tablas auxiliares y los índices que necesitan los reportes si aún no existen"""
+    for ddl in TABLAS:
+        ejecutar_query(ddl, commit=True)
+
+    for tabla, columna, definicion in COLUMNAS:
+        try:
+            agregar_columna_si_falta(tabla, columna, definicion)
+        except Exception as e:
+            print(f"❌ Error al agregar la columna {tabla}.{columna}: {e}")
+
+    for tabla, nombre, columnas in INDICES:
+        try:
+            crear_indice_si_falta(tabla, nombre, columnas)
+        except Exception as e:
+            print(f"❌ Error al crear el índice {nombre}: {e}")
+
+    try:
+        preparar_indice_sku()
+    except Exception as e:
+        print(f"❌ Error al preparar el índice de SKU: {e}")
+
+    try:
+        preparar_indice_username()
+        asegurar_admin_inicial()
+    except Exception as e:
+        print(f"❌ Error al preparar la tabla de usuarios: {e}")
+
+    try:
+        particionar_logs()
+        asegurar_particiones_logs()
+    except Exception as e:
+        print(f"❌ Error al particionar la tabla de logs: {e}")
+
+    resumen = ejecutar_query("SELECT COUNT(*) as total FROM resumen_iva_mensual", fetch_one=True)
+    if resumen and resumen.get('total', 0) == 0:
+        reconstruir_resumen_iva()
+
+    resumen = ejecutar_query("SELECT COUNT(*) as total FROM resumen_ventas_diario", fetch_one=True)
+    if resumen and resumen.get('total', 0) == 0:
+        reconstruir_resumen_ventas()
+
+    resumen = ejecutar_query("SELECT COUNT(*) as total FROM resumen_logs_diario", fetch_one=True)
+    if resumen and resumen.get('total', 0) == 0:
+        reconstruir_resumen_logs()
+
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+@app.before_request
+def preparar_base_datos():
+    """Verifica el esquema y arranca el planificador una sola vez por proceso, antes de la primera petición"""
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if not _esquema_listo:
+            asegurar_esquema()
+            if os.getenv('PLANIFICADOR_ACTIVO', '1') == '1':
+                planificador.iniciar()
+            _esquema_listo = True
+
+
 # ---------------------------------------------------------------------------------
 # CONSTANTES
 # ---------------------------------------------------------------------------------
-STOCK_MINIMO = 5
+# Cálculo del punto de reorden por velocidad de venta
+VENTANA_VELOCIDAD_DIAS = int(os.getenv('VENTANA_VELOCIDAD_DIAS', 30))
+DIAS_REPOSICION = int(os.getenv('DIAS_REPOSICION', 7))
+FACTOR_SEGURIDAD = float(os.getenv('FACTOR_SEGURIDAD', 1.65))
+PUNTO_REORDEN_MINIMO = 1
+
+POR_PAGINA_REPORTES = 25
+TOP_N_REPORTES = 5
+
+# Series de ventas: puntos máximos por respuesta y nombres aceptados para el intervalo
+MAX_PUNTOS_SERIE = 500
+INTERVALOS_SERIE = {
+    'hora': 'hora', 'hour': 'hora',
+    'dia': 'dia', 'day': 'dia',
+    'semana': 'semana', 'week': 'semana',
+    'mes': 'mes', 'month': 'mes',
+}
+
+MESES_NOMBRES = {
+    1: 'Enero', 2: 'Febrero', 3: 'Marzo', 4: 'Abril',
+    5: 'Mayo', 6: 'Junio', 7: 'Julio', 8: 'Agosto',
+    9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'
+}
+
+# Hash de contraseñas en un pool acotado; PASSWORD_METODO acepta los métodos de
+# Werkzeug ('scrypt:n:r:p' o 'pbkdf2:sha256:iteraciones')
+hash_contrasenas = HashContrasenas(
+    metodo=os.getenv('PASSWORD_METODO', 'scrypt:32768:8:1'),
+    max_hilos=int(os.getenv('PASSWORD_HILOS', 2)),
+    max_en_cola=int(os.getenv('PASSWORD_EN_COLA', 32))
+)
+
+# Límite de intentos de inicio de sesión: (intentos seguidos, segundos para recuperar uno)
+limitador_login = LimitadorIntentos({
+    'ip': (int(os.getenv('LOGIN_INTENTOS_IP', 20)), float(os.getenv('LOGIN_RECARGA_IP', 3))),
+    'usuario': (int(os.getenv('LOGIN_INTENTOS_USUARIO', 5)), float(os.getenv('LOGIN_RECARGA_USUARIO', 30))),
+})
+
+# Versión de datos por tabla y caché de resultados de reportes. Las versiones son
+# del proceso: la aplicación corre en un solo proceso (el planificador, los pools
+# de trabajos y el limitador de login también viven en memoria)
+versiones_datos = VersionesDatos()
+cache_reportes = CacheReportes(
+    max_entradas=int(os.getenv('CACHE_REPORTES_ENTRADAS', 128)),
+    max_bytes=int(os.getenv('CACHE_REPORTES_MB', 32)) * 1024 * 1024
+)
+
+# Precálculo de reportes en segundo plano (las tareas se registran más abajo)
+planificador = PlanificadorReportes()
+
+# Archivos exportados ya generados, por tipo, filtros y versión de datos
+cache_archivos = CacheArchivos(
+    os.getenv('EXPORTACIONES_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exportaciones_cache')),
+    max_bytes=int(os.getenv('EXPORTACIONES_CACHE_MB', 256)) * 1024 * 1024
+)
+
+# Exportaciones en segundo plano (los tipos se registran más abajo). Las descargas
+# directas por GET también pasan por este pool: esperan a lo sumo
+# ESPERA_EXPORTACION_DIRECTA segundos (las exportaciones chicas terminan antes) y
+# si no, muestran la página del trabajo, que se recarga sola hasta que esté listo
+ESPERA_EXPORTACION_DIRECTA = float(os.getenv('EXPORTACIONES_ESPERA_DIRECTA', 2))
+gestor_exportaciones = GestorTrabajos(
+    os.getenv('EXPORTACIONES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exportaciones')),
+    max_hilos=int(os.getenv('EXPORTACIONES_HILOS', 2)),
+    max_por_usuario=int(os.getenv('EXPORTACIONES_POR_USUARIO', 2)),
+    ttl=int(os.getenv('EXPORTACIONES_TTL', 3600))
+)
+
+# Importaciones de productos en segundo plano; el spool guarda los archivos subidos
+gestor_importaciones = GestorTrabajos(
+    os.getenv('IMPORTACIONES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'importaciones')),
+    max_hilos=int(os.getenv('IMPORTACIONES_HILOS', 1)),
+    max_por_usuario=int(os.getenv('IMPORTACIONES_POR_USUARIO', 1)),
+    ttl=int(os.getenv('IMPORTACIONES_TTL', 3600)),
+    prefijo_hilos='importacion'
+)
 
 ROLES = {
     'admin': 'Administrador',
@@ -117,7 +652,8 @@ def cargar_productos():
     """Carga todos los productos desde MySQL"""
     query = """
         SELECT id, codigo_sku, nombre, categoria, marca, stock, precio_unitario, 
-               descripcion, valor_total, fecha_creacion, fecha_actualizacion
+               descripcion, valor_total, velocidad_diaria, punto_reorden, bajo_stock,
+               fecha_creacion, fecha_actualizacion
         FROM productos
         ORDER BY id
     """
@@ -125,6 +661,110 @@ def cargar_productos():
     return productos if productos else []
 
 
+def cargar_productos_bajo_stock(limite=None):
+    """Productos por debajo de su punto de reorden (usa idx_productos_bajo_stock)"""
+    query = """
+        SELECT id, codigo_sku, nombre, categoria, marca, stock, precio_unitario, 
+               descripcion, valor_total, velocidad_diaria, punto_reorden, bajo_stock,
+               fecha_creacion, fecha_actualizacion
+        FROM productos
+        WHERE bajo_stock = 1
+        ORDER BY stock
+    """
+    params = None
+    if limite:
+        query += " LIMIT %s"
+        params = (limite,)
+    productos = ejecutar_query(query, params, fetch_all=True)
+    return productos if productos else []
+
+
+def contar_productos_bajo_stock():
+    """Número de productos por debajo de su punto de reorden"""
+    resultado = ejecutar_query("SELECT COUNT(*) as total FROM productos WHERE bajo_stock = 1", fetch_one=True)
+    return resultado['total'] if resultado else 0
+
+
+def actualizar_puntos_reorden(producto_ids=None):
+    """
+    Recalcula la velocidad de venta diaria y el punto de reorden de los productos
+    indicados (o de todos) con las ventas de los últimos VENTANA_VELOCIDAD_DIAS días,
+    leídas del resumen diario. Solo escribe los productos cuyo valor cambió.
+    """
+    if producto_ids:
+        producto_ids = sorted({int(pid) for pid in producto_ids})
+
+    def filtro_ids(columna):
+        if not producto_ids:
+            return "", []
+        return f" AND {columna} IN ({', '.join(['%s'] * len(producto_ids))})", list(producto_ids)
+
+    condicion, params = filtro_ids('id')
+    actuales = ejecutar_query(
+        "SELECT id as producto_id, velocidad_diaria, punto_reorden FROM productos WHERE 1=1" + condicion,
+        tuple(params) if params else None,
+        fetch_all=True
+    ) or []
+
+    hasta = datetime.now().date()
+    desde = hasta - timedelta(days=VENTANA_VELOCIDAD_DIAS - 1)
+    condicion, params = filtro_ids('producto_id')
+    filas = ejecutar_query(
+        "SELECT producto_id, fecha, cantidad FROM resumen_ventas_diario WHERE fecha >= %s AND fecha <= %s"
+        + condicion,
+        tuple([desde.isoformat(), hasta.isoformat()] + params),
+        fetch_all=True
+    )
+
+    calculados = analitica.puntos_reorden(
+        filas, [p['producto_id'] for p in actuales], hasta, VENTANA_VELOCIDAD_DIAS,
+        DIAS_REPOSICION, FACTOR_SEGURIDAD, PUNTO_REORDEN_MINIMO
+    )
+
+    anteriores = {p['producto_id']: (float(p['velocidad_diaria'] or 0), p['punto_reorden']) for p in actuales}
+    sentencias = [
+        (
+            "UPDATE productos SET velocidad_diaria = %s, punto_reorden = %s WHERE id = %s",
+            (c['velocidad_diaria'], c['punto_reorden'], c['producto_id'])
+        )
+        for c in analitica.a_registros(calculados)
+        if anteriores.get(c['producto_id']) != (c['velocidad_diaria'], c['punto_reorden'])
+    ]
+    if sentencias:
+        ejecutar_transaccion(sentencias)
+
+    return {'productos_revisados': len(actuales), 'productos_actualizados': len(sentencias)}
+
+
+# Productos tocados por ventas nuevas, editadas o eliminadas. Las rutas solo los
+# anotan y la tarea puntos_reorden_pendientes los recalcula juntos en segundo plano
+_reorden_pendientes = set()
+_reorden_lock = threading.Lock()
+
+
+def encolar_puntos_reorden(producto_ids):
+    """Anota productos para recalcular su punto de reorden en la próxima vuelta del planificador"""
+    with _reorden_lock:
+        _reorden_pendientes.update(int(pid) for pid in producto_ids if pid)
+
+
+def recalcular_puntos_reorden_pendientes():
+    """
+    Recalcula el punto de reorden de los productos anotados. Si una consulta
+    falla, los vuelve a anotar para el siguiente intento.
+    """
+    with _reorden_lock:
+        producto_ids = set(_reorden_pendientes)
+        _reorden_pendientes.clear()
+    if not producto_ids:
+        return {'productos_revisados': 0, 'productos_actualizados': 0}
+
+    try:
+        return sin_errores_db(actualizar_puntos_reorden)(producto_ids=producto_ids)
+    except Exception:
+        encolar_puntos_reorden(producto_ids)
+        raise
+
 
 def obtener_producto_por_id(producto_id):
     """Obtiene un producto específico por su ID"""
@@ -225,6 +865,77 @@ def cargar_ventas():
     ventas = ejecutar_query(query, fetch_all=True)
     return ventas if ventas else []
 
+
+def cargar_categorias():
+    """Lista de categorías distintas del catálogo"""
+    query = "SELECT DISTINCT categoria FROM productos ORDER BY categoria"
+    categorias = ejecutar_query(query, fetch_all=True)
+    return [c['categoria'] for c in categorias if c['categoria']] if categorias else []
+
+
+def filtros_ventas_sql(fecha_desde='', fecha_hasta='', categoria=''):
+    """
+    Construye el WHERE de ventas sin funciones sobre columnas, para poder usar índices.
+    La fecha final se convierte en límite exclusivo del día siguiente (rango semiabierto).
+    """
+    condiciones = []
+    params = []
+
+    if fecha_desde:
+        condiciones.append("v.fecha >= %s")
+        params.append(fecha_desde)
+
+    if fecha_hasta:
+        try:
+            hasta = datetime.strptime(fecha_hasta, '%Y-%m-%d') + timedelta(days=1)
+            condiciones.append("v.fecha < %s")
+            params.append(hasta.strftime('%Y-%m-%d'))
+        except ValueError:
+            pass
+
+    if categoria:
+        condiciones.append("v.categoria = %s")
+        params.append(categoria)
+
+    where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+    return where, params
+
+
+def contar_productos_vendidos(fecha_desde='', fecha_hasta='', categoria=''):
+    """Número de productos distintos con ventas en el filtro"""
+    where, params = filtros_ventas_sql(fecha_desde, fecha_hasta, categoria)
+    query = f"SELECT COUNT(DISTINCT v.producto_id) as total FROM ventas v{where}"
+    resultado = ejecutar_query(query, tuple(params), fetch_one=True)
+    return resultado['total'] if resultado else 0
+
+
+def ranking_productos_vendidos(fecha_desde='', fecha_hasta='', categoria='',
+                               ascendente=False, limite=TOP_N_REPORTES, desplazamiento=0):
+    """
+    Agrupa las ventas por producto en MySQL (índice idx_ventas_producto_fecha)
+    y devuelve solo la página pedida del ranking por unidades vendidas.
+    """
+    where, params = filtros_ventas_sql(fecha_desde, fecha_hasta, categoria)
+    direccion = "ASC" if ascendente else "DESC"
+
+    query = f"""
+        SELECT
+            v.producto_id as id,
+            MAX(v.producto_nombre) as nombre,
+            MAX(v.categoria) as categoria,
+            SUM(v.cantidad) as cantidad_vendida,
+            SUM(v.total) as ingresos,
+            COUNT(*) as num_ventas
+        FROM ventas v{where}
+        GROUP BY v.producto_id
+        ORDER BY cantidad_vendida {direccion}, v.producto_id
+        LIMIT %s OFFSET %s
+    """
+    params.extend([limite, desplazamiento])
+
+    productos = ejecutar_query(query, tuple(params), fetch_all=True)
+    return productos if productos else []
+
 def guardar_venta(venta):
     """Guarda una nueva venta en MySQL"""
     query = """
@@ -253,8 +964,180 @@ def guardar_venta(venta):
         venta.get('usuario_id'),
         venta.get('usuario_nombre')
     )
-    return ejecutar_query(query, params, commit=True)
-    # ---------------------------------------------------------------------------------
+    sentencia_resumen = (
+        """
+        INSERT INTO resumen_iva_mensual (anio, mes, num_ventas, total_vendido, iva_total)
+        VALUES (%s, %s, 1, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            num_ventas = num_ventas + 1,
+            total_vendido = total_vendido + VALUES(total_vendido),
+            iva_total = iva_total + VALUES(iva_total)
+        """,
+        (*anio_mes(venta['fecha']), venta.get('total', 0), venta.get('iva_total', 0))
+    )
+    return ejecutar_transaccion(
+        [(query, params), sentencia_resumen] + sentencias_sumar_resumen_ventas(venta)
+    )
+
+
+# ---------------------------------------------------------------------------------
+# RESUMEN MENSUAL DE IVA
+# ---------------------------------------------------------------------------------
+def anio_mes(fecha):
+    """(año, mes) de una fecha date/datetime o texto 'YYYY-MM-DD'"""
+    if hasattr(fecha, 'year'):
+        return fecha.year, fecha.month
+    texto = str(fecha)
+    return int(texto[:4]), int(texto[5:7])
+
+
+def rango_mes(anio, mes):
+    """Rango semiabierto [inicio, fin) de un mes, apto para usar el índice de fecha"""
+    inicio = f"{anio:04d}-{mes:02d}-01"
+    fin = f"{anio + 1:04d}-01-01" if mes == 12 else f"{anio:04d}-{mes + 1:02d}-01"
+    return inicio, fin
+
+
+def sentencias_recalcular_resumen_iva(fecha):
+    """Sentencias que recalculan el resumen de IVA del mes de la fecha dada"""
+    anio, mes = anio_mes(fecha)
+    inicio, fin = rango_mes(anio, mes)
+    return [
+        (
+            """
+            REPLACE INTO resumen_iva_mensual (anio, mes, num_ventas, total_vendido, iva_total)
+            SELECT %s, %s, COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(iva_total), 0)
+            FROM ventas
+            WHERE fecha >= %s AND fecha < %s
+            """,
+            (anio, mes, inicio, fin)
+        ),
+        (
+            "DELETE FROM resumen_iva_mensual WHERE anio = %s AND mes = %s AND num_ventas = 0",
+            (anio, mes)
+        ),
+    ]
+
+
+def reconstruir_resumen_iva():
+    """Reconstruye el resumen mensual de IVA completo a partir de ventas"""
+    return ejecutar_transaccion([
+        ("DELETE FROM resumen_iva_mensual", None),
+        (
+            """
+            INSERT INTO resumen_iva_mensual (anio, mes, num_ventas, total_vendido, iva_total)
+            SELECT YEAR(fecha), MONTH(fecha), COUNT(*), SUM(total), SUM(iva_total)
+            FROM ventas
+            GROUP BY YEAR(fecha), MONTH(fecha)
+            """,
+            None
+        ),
+    ])
+
+
+# ---------------------------------------------------------------------------------
+# RESÚMENES DE VENTAS POR DÍA Y POR MES (SERIES TEMPORALES)
+# ---------------------------------------------------------------------------------
+def sentencias_sumar_resumen_ventas(venta):
+    """Sentencias que suman una venta nueva a los resúmenes diario y mensual"""
+    anio, mes = anio_mes(venta['fecha'])
+    valores = (venta['producto_id'], venta['categoria'], venta['cantidad'], venta.get('total', 0))
+    acumular = """
+        ON DUPLICATE KEY UPDATE
+            categoria = VALUES(categoria),
+            num_ventas = num_ventas + 1,
+            cantidad = cantidad + VALUES(cantidad),
+            ingresos = ingresos + VALUES(ingresos)
+    """
+    return [
+        (
+            """
+            INSERT INTO resumen_ventas_diario (fecha, producto_id, categoria, num_ventas, cantidad, ingresos)
+            VALUES (%s, %s, %s, 1, %s, %s)
+            """ + acumular,
+            (venta['fecha'], *valores)
+        ),
+        (
+            """
+            INSERT INTO resumen_ventas_mensual (anio, mes, producto_id, categoria, num_ventas, cantidad, ingresos)
+            VALUES (%s, %s, %s, %s, 1, %s, %s)
+            """ + acumular,
+            (anio, mes, *valores)
+        ),
+    ]
+
+
+def sentencias_recalcular_resumen_ventas(fecha, producto_id):
+    """Sentencias que recalculan el día y el mes de un producto en los resúmenes de ventas"""
+    anio, mes = anio_mes(fecha)
+    inicio, fin = rango_mes(anio, mes)
+    return [
+        (
+            "DELETE FROM resumen_ventas_diario WHERE fecha = %s AND producto_id = %s",
+            (fecha, producto_id)
+        ),
+        (
+            """
+            INSERT INTO resumen_ventas_diario (fecha, producto_id, categoria, num_ventas, cantidad, ingresos)
+            SELECT fecha, producto_id, MAX(categoria), COUNT(*), SUM(cantidad), SUM(total)
+            FROM ventas
+            WHERE fecha = %s AND producto_id = %s
+            GROUP BY fecha, producto_id
+            """,
+            (fecha, producto_id)
+        ),
+        (
+            "DELETE FROM resumen_ventas_mensual WHERE anio = %s AND mes = %s AND producto_id = %s",
+            (anio, mes, producto_id)
+        ),
+        (
+            """
+            INSERT INTO resumen_ventas_mensual (anio, mes, producto_id, categoria, num_ventas, cantidad, ingresos)
+            SELECT %s, %s, producto_id, MAX(categoria), SUM(num_ventas), SUM(cantidad), SUM(ingresos)
+            FROM resumen_ventas_diario
+            WHERE fecha >= %s AND fecha < %s AND producto_id = %s
+            GROUP BY producto_id
+            """,
+            (anio, mes, inicio, fin, producto_id)
+        ),
+    ]
+
+
+def reconstruir_resumen_ventas():
+    """Reconstruye los resúmenes diario y mensual de ventas a partir de la tabla ventas"""
+    return ejecutar_transaccion([
+        ("DELETE FROM resumen_ventas_diario", None),
+        (
+            """
+            INSERT INTO resumen_ventas_diario (fecha, producto_id, categoria, num_ventas, cantidad, ingresos)
+            SELECT fecha, producto_id, MAX(categoria), COUNT(*), SUM(cantidad), SUM(total)
+            FROM ventas
+            GROUP BY fecha, producto_id
+            """,
+            None
+        ),
+        ("DELETE FROM resumen_ventas_mensual", None),
+        (
+            """
+            INSERT INTO resumen_ventas_mensual (anio, mes, producto_id, categoria, num_ventas, cantidad, ingresos)
+            SELECT YEAR(fecha), MONTH(fecha), producto_id, MAX(categoria),
+                   SUM(num_ventas), SUM(cantidad), SUM(ingresos)
+            FROM resumen_ventas_diario
+            GROUP BY YEAR(fecha), MONTH(fecha), producto_id
+            """,
+            None
+        ),
+    ])
+
+
+def cargar_anios_ventas():
+    """Años con ventas, leídos del resumen mensual"""
+    query = "SELECT DISTINCT anio FROM resumen_iva_mensual ORDER BY anio DESC"
+    anios = ejecutar_query(query, fetch_all=True)
+    return [str(r['anio']) for r in anios] if anios else []
+
+
+# ---------------------------------------------------------------------------------
 # FUNCIONES DE USUARIOS Y AUTENTICACIÓN
 # ---------------------------------------------------------------------------------
 def cargar_usuarios():
@@ -266,20 +1149,42 @@ def cargar_usuarios():
         ORDER BY id
     """
     usuarios = ejecutar_query(query, fetch_all=True)
-    
-    if not usuarios:
-        query_insert = """
-            INSERT INTO usuarios (username, password, nombre_completo, rol, activo)
-            VALUES (%s, %s, %s, %s, %s)
+    return usuarios if usuarios else []
+
+
+def asegurar_admin_inicial():
+    """Crea el usuario admin por defecto si la tabla de usuarios está vacía (una vez, al arrancar)"""
+    existe = ejecutar_query("SELECT id FROM usuarios LIMIT 1", fetch_one=True)
+    if existe:
+        return False
+
+    query_insert = """
+        INSERT INTO usuarios (username, password, nombre_completo, rol, activo)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+    ejecutar_query(
+        query_insert,
+        ('admin', hash_contrasenas.generar('admin123'), 'Administrador', 'admin', True),
+        commit=True
+    )
+    print("👤 Usuario admin creado por defecto")
+    return True
+
+
+def preparar_indice_username():
+    """Índice único de usuarios.username para el login, salvo que ya haya un índice que empiece por esa columna"""
+    existe = ejecutar_query(
         """
-        ejecutar_query(
-            query_insert,
-            ('admin', generate_password_hash('admin123'), 'Administrador', 'admin', True),
-            commit=True
-        )
-        return cargar_usuarios()
-    
-    return usuarios
+        SELECT COUNT(*) as total
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'usuarios'
+          AND column_name = 'username' AND seq_in_index = 1
+        """,
+        fetch_one=True
+    )
+    if existe and existe.get('total', 0) > 0:
+        return False
+    return crear_indice_si_falta('usuarios', 'uq_usuarios_username', 'username', unico=True)
 
 
 def crear_usuario(username, password, nombre_completo, rol):
@@ -288,7 +1193,7 @@ def crear_usuario(username, password, nombre_completo, rol):
         INSERT INTO usuarios (username, password, nombre_completo, rol, activo)
         VALUES (%s, %s, %s, %s, %s)
     """
-    password_hash = generate_password_hash(password)
+    password_hash = hash_contrasenas.generar(password)
     params = (username, password_hash, nombre_completo, rol, True)
     return ejecutar_query(query, params, commit=True)
 
@@ -311,13 +1216,29 @@ def eliminar_usuario_db(usuario_id):
 
 def actualizar_password_usuario(usuario_id, nueva_password):
     """Actualiza la contraseña de un usuario"""
-    query = """
+    return guardar_hash_usuario(usuario_id, hash_contrasenas.generar(nueva_password))
+
+
+def guardar_hash_usuario(usuario_id, password_hash, hash_anterior=None):
+    """
+    Guarda un hash ya calculado. Con hash_anterior (rehash tras el login) solo se
+    reemplaza si la contraseña sigue siendo la verificada: un cambio de contraseña
+    hecho mientras el rehash esperaba en cola no se pisa.
+    """
+    if hash_anterior is None:
+        query = """
+            UPDATE usuarios 
+            SET password = %s, fecha_actualizacion = NOW()
+            WHERE id = %s
+        """
+        return ejecutar_query(query, (password_hash, usuario_id), commit=True)
+
+    query = """
         UPDATE usuarios 
         SET password = %s, fecha_actualizacion = NOW()
-        WHERE id = %s
+        WHERE id = %s AND password = %s
     """
-    password_hash = generate_password_hash(nueva_password)
-    return ejecutar_query(query, (password_hash, usuario_id), commit=True)
+    return ejecutar_query(query, (password_hash, usuario_id, hash_anterior), commit=True)
 
 
 def obtener_usuario_por_id(usuario_id):
@@ -331,42 +1252,627 @@ def obtener_usuario_por_id(usuario_id):
     return ejecutar_query(query, (usuario_id,), fetch_one=True)
 
 
-def registrar_log(accion, detalle=""):
-    """Registra una acción en los logs de MySQL"""
+def obtener_usuario_por_username(username):
+    """Obtiene un usuario por su nombre de usuario (búsqueda por índice, para el login)"""
     query = """
-        INSERT INTO logs (fecha, hora, usuario, accion, detalle)
-        VALUES (%s, %s, %s, %s, %s)
+        SELECT id, username, password, nombre_completo, rol, activo, 
+               fecha_creacion, fecha_actualizacion
+        FROM usuarios
+        WHERE username = %s
+        LIMIT 1
     """
-    params = (
-        datetime.now().strftime('%Y-%m-%d'),
-        datetime.now().strftime('%H:%M:%S'),
-        session.get('username', 'Sistema'),
-        accion,
-        detalle
+    return ejecutar_query(query, (username,), fetch_one=True)
+
+
+# Rol y estado de cada usuario con sesión abierta, para no consultar MySQL en cada petición.
+# Un cambio hecho por el admin se ve en la siguiente petición (se invalida) o, como
+# mucho, pasados USUARIOS_CACHE_TTL segundos si se hizo desde otro proceso.
+estado_usuarios = CacheTTL(ttl=int(os.getenv('USUARIOS_CACHE_TTL', 60)))
+
+
+def estado_usuario(usuario_id):
+    """
+    {'rol', 'activo'} del usuario (un usuario borrado queda como inactivo y sin rol,
+    también en caché), o None si la consulta falló: un error pasajero de MySQL no
+    debe leerse como "el usuario ya no existe".
+    """
+    def consultar():
+        errores = errores_db_hilo()
+        usuario = ejecutar_query(
+            "SELECT rol, activo FROM usuarios WHERE id = %s", (usuario_id,), fetch_one=True
+        )
+        if usuario:
+            return {'rol': usuario['rol'], 'activo': bool(usuario['activo'])}
+        if errores_db_hilo() != errores:
+            return None
+        return {'rol': None, 'activo': False}
+
+    return estado_usuarios.obtener_o_calcular(usuario_id, consultar)
+
+
+# Con LOGS_ALMACEN=archivos los logs se guardan en archivos de segmento locales en
+# lugar de MySQL (ver almacen_logs.py); ver_logs, la búsqueda y la exportación leen de ahí
+LOGS_ALMACEN = os.getenv('LOGS_ALMACEN', 'mysql')
+almacen_logs = AlmacenLogs(
+    os.getenv('LOGS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs_segmentos')),
+    tamano_segmento=int(os.getenv('LOGS_SEGMENTO_MB', 32)) * 1024 * 1024
+) if LOGS_ALMACEN == 'archivos' else None
+
+
+def registrar_log(accion, detalle="", usuario=None):
+    """Registra una acción en los logs de MySQL (usuario se pasa fuera de una petición)"""
+    ahora = datetime.now()
+    fecha = ahora.strftime('%Y-%m-%d')
+    usuario = usuario or session.get('username', 'Sistema')
+    if almacen_logs:
+        try:
+            almacen_logs.agregar({
+                'fecha': fecha, 'hora': ahora.strftime('%H:%M:%S'), 'usuario': usuario,
+                'accion': accion, 'detalle': detalle, 'fecha_registro': ahora.strftime('%Y-%m-%d %H:%M:%S')
+            })
+        except OSError as e:
+            print(f"❌ Error al escribir el log en archivo: {e}")
+        return
+
+    referencias = extraer_referencias_log(accion, detalle)
+    ejecutar_transaccion([
+        (
+            """
+            INSERT INTO logs (fecha, hora, usuario, accion, detalle)
+            VALUES (%s, %s, %s, %s, %s)
+            """,
+            (fecha, ahora.strftime('%H:%M:%S'), usuario, accion, detalle)
+        ),
+        (
+            """
+            INSERT INTO logs_busqueda (log_id, fecha, usuario, accion, detalle, producto_id, venta_id, monto)
+            VALUES (LAST_INSERT_ID(), %s, %s, %s, %s, %s, %s, %s)
+            """,
+            (fecha, usuario, accion, detalle, referencias['producto_id'], referencias['venta_id'], referencias['monto'])
+        ),
+        (
+            """
+            INSERT INTO resumen_logs_diario (fecha, usuario, accion, total)
+            VALUES (%s, %s, %s, 1)
+            ON DUPLICATE KEY UPDATE total = total + 1
+            """,
+            (fecha, usuario, accion)
+        ),
+    ])
+
+
+def reconstruir_resumen_logs():
+    """Reconstruye el conteo diario de logs por usuario y acción a partir de la tabla logs"""
+    return ejecutar_transaccion([
+        ("DELETE FROM resumen_logs_diario", None),
+        (
+            """
+            INSERT INTO resumen_logs_diario (fecha, usuario, accion, total)
+            SELECT fecha, usuario, accion, COUNT(*)
+            FROM logs
+            GROUP BY fecha, usuario, accion
+            """,
+            None
+        ),
+    ])
+
+
+LOGS_POR_PAGINA = 50
+# Con el almacén de archivos, las opciones de los filtros salen de los últimos N logs
+OPCIONES_LOGS_RECIENTES = 5000
+
+
+def fechas_filtro_validas(*fechas):
+    """True si cada fecha está vacía o tiene el formato YYYY-MM-DD"""
+    try:
+        for fecha in fechas:
+            if fecha:
+                datetime.strptime(fecha, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+
+def filtros_logs_sql(fecha_desde='', fecha_hasta='', usuario='', accion=''):
+    """
+    Condiciones y parámetros de los filtros de logs. Sirven igual para logs y para
+    resumen_logs_diario, que tienen las mismas columnas fecha, usuario y accion.
+    """
+    condiciones = []
+    params = []
+
+    if fecha_desde:
+        condiciones.append("fecha >= %s")
+        params.append(fecha_desde)
+
+    if fecha_hasta:
+        condiciones.append("fecha <= %s")
+        params.append(fecha_hasta)
+
+    if usuario:
+        condiciones.append("usuario = %s")
+        params.append(usuario)
+
+    if accion:
+        condiciones.append("accion = %s")
+        params.append(accion)
+
+    return condiciones, params
+
+
+def cargar_logs(filtros=None, antes=None, despues=None, limite=LOGS_POR_PAGINA, fecha_cursor=None):
+    """
+    Una página de logs, del más reciente al más antiguo, paginada por id (keyset):
+    antes=id trae la página siguiente (más antigua) y despues=id la anterior. Cada
+    página cuesta lo mismo sin importar el tamaño de la tabla, a diferencia de OFFSET.
+    Con un rango de fechas se ordena por (fecha, id), el orden de idx_logs_fecha,
+    y el cursor es (fecha_cursor, id): ordenar solo por id obligaría a MySQL a leer
+    y ordenar todo el rango antes del LIMIT.
+    Devuelve (logs, hay_anteriores, hay_siguientes).
+    """
+    filtros = filtros or {}
+    if almacen_logs:
+        return recorrer_logs_archivos(filtros, antes=antes, despues=despues, limite=limite)
+
+    condiciones, params = filtros_logs_sql(**filtros)
+    por_fecha = bool(filtros.get('fecha_desde') or filtros.get('fecha_hasta'))
+    cursor, operador = (despues, '>') if despues is not None else (antes, '<')
+    if cursor is not None:
+        if por_fecha and fecha_cursor:
+            condiciones.append(f"(fecha, id) {operador} (%s, %s)")
+            params.extend([fecha_cursor, cursor])
+        else:
+            condiciones.append(f"id {operador} %s")
+            params.append(cursor)
+    orden = "ASC" if despues is not None else "DESC"
+    orden_sql = f"fecha {orden}, id {orden}" if por_fecha else f"id {orden}"
+
+    where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+    query = f"""
+    SELECT id, fecha, hora, usuario, accion, detalle, fecha_registro
+    FROM logs{where}
+    ORDER BY {orden_sql}
+    LIMIT %s
+    """
+    logs = ejecutar_query(query, tuple(params) + (limite + 1,), fetch_all=True) or []
+
+    hay_mas = len(logs) > limite
+    logs = logs[:limite]
+    if despues is not None:
+        logs.reverse()
+        return logs, hay_mas, True
+    return logs, antes is not None, hay_mas
+
+
+def contar_logs(filtros=None):
+    """Total de logs que cumplen los filtros, sumado desde resumen_logs_diario (una fila por día, usuario y acción)"""
+    if almacen_logs:
+        # El almacén de archivos no lleva conteos: contar sería leer todos los segmentos
+        return None
+    condiciones, params = filtros_logs_sql(**(filtros or {}))
+    where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+    resultado = ejecutar_query(
+        f"SELECT COALESCE(SUM(total), 0) as total FROM resumen_logs_diario{where}",
+        tuple(params) or None,
+        fetch_one=True
     )
-    ejecutar_query(query, params, commit=True)
+    return int(resultado['total']) if resultado else 0
+
+
+def opciones_filtro_logs():
+    """Usuarios y acciones distintos para los filtros del visor, leídos de los índices del resumen"""
+    if almacen_logs:
+        recientes = list(islice(almacen_logs.hacia_atras(), OPCIONES_LOGS_RECIENTES))
+        return sorted({r['usuario'] for r in recientes}), sorted({r['accion'] for r in recientes})
+
+    usuarios = ejecutar_query(
+        "SELECT DISTINCT usuario FROM resumen_logs_diario ORDER BY usuario", fetch_all=True
+    ) or []
+    acciones = ejecutar_query(
+        "SELECT DISTINCT accion FROM resumen_logs_diario ORDER BY accion", fetch_all=True
+    ) or []
+    return [u['usuario'] for u in usuarios], [a['accion'] for a in acciones]
+
+
+# ---------------------------------------------------------------------------------
+# BÚSQUEDA EN LOGS (FULLTEXT Y REFERENCIAS EXTRAÍDAS)
+# ---------------------------------------------------------------------------------
+RE_LOG_VENTA = re.compile(r'(?:Venta #|ID de venta eliminada: )(\d+)')
+RE_LOG_PRODUCTO = re.compile(r'Producto #(\d+)')
+RE_LOG_ID = re.compile(r'\bID: (\d+)')
+RE_LOG_MONTO = re.compile(r'Total: \$([\d,]+(?:\.\d+)?)')
+LOTE_INDEXAR_LOGS = 5000
+
+
+def extraer_referencias_log(accion, detalle):
+    """
+    IDs de producto y de venta y el monto que menciona un mensaje de log. El 'ID: n'
+    sin prefijo se refiere a la venta o al producto según la acción.
+    """
+    detalle = detalle or ''
+    venta = RE_LOG_VENTA.search(detalle)
+    producto = RE_LOG_PRODUCTO.search(detalle)
+    if not venta and accion.startswith('Venta'):
+        venta = RE_LOG_ID.search(detalle)
+    elif not producto and accion.startswith('Producto'):
+        producto = RE_LOG_ID.search(detalle)
+    monto = RE_LOG_MONTO.search(detalle)
+
+    return {
+        'producto_id': int(producto.group(1)) if producto else None,
+        'venta_id': int(venta.group(1)) if venta else None,
+        'monto': float(monto.group(1).replace(',', '')) if monto else None,
+    }
+
 
+def indexar_logs_pendientes(tamano_lote=LOTE_INDEXAR_LOGS):
+    """
+    Agrega a logs_busqueda los logs que no están indexados (los que existían antes
+    de la búsqueda; los nuevos se indexan al registrarse). Recorre logs por rangos
+    de id con un anti-join contra el índice, así un recorrido interrumpido se
+    completa en el siguiente aunque mientras tanto hayan entrado logs más nuevos.
+    """
+    rango = ejecutar_query("SELECT MIN(id) as minimo, MAX(id) as maximo FROM logs", fetch_one=True)
+    if not rango or rango['minimo'] is None:
+        return {'indexados': 0}
 
-def cargar_logs():
-    """Carga todos los logs desde MySQL"""
+    indexados = 0
     query = """
-    SELECT id, fecha, hora, usuario, accion, detalle, fecha_registro
-    FROM logs
-    ORDER BY fecha_registro ASC
+        SELECT l.id, l.fecha, l.usuario, l.accion, l.detalle
+        FROM logs l
+        LEFT JOIN logs_busqueda b ON b.log_id = l.id
+        WHERE l.id >= %s AND l.id < %s AND b.log_id IS NULL
+    """
+    for desde in range(rango['minimo'], rango['maximo'] + 1, tamano_lote):
+        lote = ejecutar_query(query, (desde, desde + tamano_lote), fetch_all=True)
+        if not lote:
+            continue
+        filas = []
+        for log in lote:
+            referencias = extraer_referencias_log(log['accion'] or '', log['detalle'])
+            filas.append((
+                log['id'], log['fecha'], log['usuario'] or '', log['accion'] or '', log['detalle'],
+                referencias['producto_id'], referencias['venta_id'], referencias['monto']
+            ))
+        marcadores = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(filas))
+        ejecutar_query(
+            f"""
+            INSERT IGNORE INTO logs_busqueda (log_id, fecha, usuario, accion, detalle, producto_id, venta_id, monto)
+            VALUES {marcadores}
+            """,
+            tuple(valor for fila in filas for valor in fila),
+            commit=True
+        )
+        indexados += len(filas)
+
+    if indexados:
+        print(f"🔎 {indexados} logs agregados al índice de búsqueda")
+    return {'indexados': indexados}
+
+
+def consulta_busqueda_fulltext(texto):
+    """
+    Convierte el texto del usuario en una consulta FULLTEXT en modo booleano: todas
+    las palabras son obligatorias y se aceptan como prefijo. Se descartan las de
+    menos de 3 caracteres (innodb_ft_min_token_size) y los operadores que escriba.
+    """
+    palabras = [p for p in re.findall(r'\w+', texto or '') if len(p) >= 3]
+    return ' '.join(f'+{p}*' for p in palabras)
+
+
+CAMPOS_BUSQUEDA_LOGS = ('texto', 'producto_id', 'venta_id', 'monto_min')
+
+
+def condiciones_busqueda_logs(criterios):
+    """Condiciones WHERE (sobre logs_busqueda b) y parámetros de los criterios de búsqueda"""
+    condiciones, params = filtros_logs_sql(
+        criterios.get('fecha_desde', ''), criterios.get('fecha_hasta', ''),
+        criterios.get('usuario', ''), criterios.get('accion', '')
+    )
+    condiciones = [f"b.{c}" for c in condiciones]
+
+    busqueda = consulta_busqueda_fulltext(criterios.get('texto'))
+    if busqueda:
+        condiciones.append("MATCH(b.accion, b.detalle) AGAINST (%s IN BOOLEAN MODE)")
+        params.append(busqueda)
+
+    for campo in ('producto_id', 'venta_id'):
+        if criterios.get(campo) is not None:
+            condiciones.append(f"b.{campo} = %s")
+            params.append(criterios[campo])
+
+    if criterios.get('monto_min') is not None:
+        condiciones.append("b.monto >= %s")
+        params.append(criterios['monto_min'])
+    return condiciones, params
+
+
+def buscar_logs(criterios, antes=None, limite=LOGS_POR_PAGINA):
+    """
+    Logs que cumplen los criterios (texto, producto_id, venta_id, usuario, accion,
+    monto_min, fecha_desde, fecha_hasta), del más reciente al más antiguo, paginados
+    por id. Cada criterio usa un índice de logs_busqueda; el resto de columnas se
+    toma de logs por clave primaria. Devuelve (logs, hay_siguientes).
+    """
+    if almacen_logs:
+        logs, _, hay_siguientes = recorrer_logs_archivos(criterios, antes=antes, limite=limite)
+        for log in logs:
+            log.update(extraer_referencias_log(log['accion'], log['detalle']))
+        return logs, hay_siguientes
+
+    condiciones, params = condiciones_busqueda_logs(criterios)
+
+    if antes is not None:
+        condiciones.append("b.log_id < %s")
+        params.append(antes)
+
+    where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+    query = f"""
+    SELECT l.id, l.fecha, l.hora, l.usuario, l.accion, l.detalle, l.fecha_registro,
+           b.producto_id, b.venta_id, b.monto
+    FROM logs_busqueda b
+    JOIN logs l ON l.id = b.log_id AND l.fecha = b.fecha{where}
+    ORDER BY b.log_id DESC
+    LIMIT %s
+    """
+    logs = ejecutar_query(query, tuple(params) + (limite + 1,), fetch_all=True) or []
+    return logs[:limite], len(logs) > limite
+
+
+def criterios_busqueda_logs(args):
+    """Criterios de búsqueda leídos de la query string; los números inválidos se ignoran"""
+    criterios = {
+        campo: args.get(campo, '').strip()
+        for campo in ('texto', 'usuario', 'accion', 'fecha_desde', 'fecha_hasta')
+    }
+    criterios['producto_id'] = args.get('producto_id', type=int)
+    criterios['venta_id'] = args.get('venta_id', type=int)
+    criterios['monto_min'] = args.get('monto_min', type=float)
+    return criterios
+
+
+def rango_ts_logs(fecha_desde='', fecha_hasta=''):
+    """(desde_ts, hasta_ts) de un rango de fechas; hasta_ts es el inicio del día siguiente (exclusivo)"""
+    desde_ts = datetime.strptime(fecha_desde, '%Y-%m-%d').timestamp() if fecha_desde else None
+    hasta_ts = (datetime.strptime(fecha_hasta, '%Y-%m-%d') + timedelta(days=1)).timestamp() if fecha_hasta else None
+    return desde_ts, hasta_ts
+
+
+def filtro_logs_archivos(criterios):
+    """Predicado con los mismos filtros y búsqueda que las consultas SQL, para los logs en archivos"""
+    palabras = [p.lower() for p in re.findall(r'\w+', criterios.get('texto') or '') if len(p) >= 3]
+    referencias = {c: criterios.get(c) for c in ('producto_id', 'venta_id') if criterios.get(c) is not None}
+    monto_min = criterios.get('monto_min')
+
+    def cumple(log):
+        if any(criterios.get(c) and log.get(c) != criterios[c] for c in ('usuario', 'accion')):
+            return False
+        if palabras:
+            contenido = f"{log.get('accion') or ''} {log.get('detalle') or ''}".lower()
+            if not all(p in contenido for p in palabras):
+                return False
+        if referencias or monto_min is not None:
+            extraidas = extraer_referencias_log(log.get('accion') or '', log.get('detalle'))
+            if any(extraidas[c] != v for c, v in referencias.items()):
+                return False
+            if monto_min is not None and (extraidas['monto'] is None or extraidas['monto'] < monto_min):
+                return False
+        return True
+
+    return cumple
+
+
+def recorrer_logs_archivos(criterios, antes=None, despues=None, limite=LOGS_POR_PAGINA):
+    """
+    Página de logs del almacén de archivos, con la misma forma que cargar_logs. El
+    índice disperso ubica el inicio por id o por fecha y la lectura se corta apenas
+    sale del rango de fechas; los demás filtros se aplican al recorrer.
+    """
+    desde_ts, hasta_ts = rango_ts_logs(criterios.get('fecha_desde'), criterios.get('fecha_hasta'))
+    cumple = filtro_logs_archivos(criterios)
+
+    if despues is not None:
+        registros = almacen_logs.hacia_adelante(despues=despues, desde_ts=desde_ts)
+        en_rango = takewhile(lambda r: hasta_ts is None or r['ts'] < hasta_ts, registros)
+    else:
+        registros = almacen_logs.hacia_atras(antes=antes, hasta_ts=hasta_ts)
+        en_rango = takewhile(lambda r: desde_ts is None or r['ts'] >= desde_ts, registros)
+
+    logs = list(islice(filter(cumple, en_rango), limite + 1))
+    hay_mas = len(logs) > limite
+    logs = logs[:limite]
+    if despues is not None:
+        logs.reverse()
+        return logs, hay_mas, True
+    return logs, antes is not None, hay_mas
+
+
+def registrar_intentos_fallidos():
+    """Tarea del planificador: un log por IP y usuario con los inicios de sesión fallidos acumulados"""
+    resumenes = limitador_login.resumir_fallos()
+    for r in resumenes:
+        desde = datetime.fromtimestamp(r['desde']).strftime('%H:%M:%S')
+        hasta = datetime.fromtimestamp(r['hasta']).strftime('%H:%M:%S')
+        registrar_log(
+            'Inicios de sesión fallidos',
+            f"Usuario: {r['usuario']} | IP: {r['ip']} | {r['fallos']} fallido(s), "
+            f"{r['rechazados']} bloqueado(s) por límite | {desde} a {hasta}",
+            usuario='Sistema'
+        )
+    return {'resumenes': len(resumenes)}
+
+
+# ---------------------------------------------------------------------------------
+# LOGS PARTICIONADOS POR MES Y RETENCIÓN
+# ---------------------------------------------------------------------------------
+# Meses de logs que se conservan y meses futuros con partición ya creada. La poda
+# borra particiones sin vuelta atrás: está desactivada (0) salvo que se configure
+LOGS_MESES_RETENCION = int(os.getenv('LOGS_MESES_RETENCION', 0))
+LOGS_MESES_ADELANTE = 2
+PARTICION_FUTURO = 'p_futuro'
+
+
+def sumar_meses(anio, mes, meses):
+    """(año, mes) desplazado en la cantidad de meses dada (puede ser negativa)"""
+    indice = anio * 12 + (mes - 1) + meses
+    return indice // 12, indice % 12 + 1
+
+
+def particion_mes(anio, mes):
+    """Definición de la partición del mes: guarda las fechas menores al primer día del mes siguiente"""
+    _, fin = rango_mes(anio, mes)
+    return f"PARTITION p{anio:04d}{mes:02d} VALUES LESS THAN ('{fin}')"
+
+
+def particiones_logs():
+    """Particiones de logs en orden, con su límite superior (vacío si la tabla no está particionada)"""
+    particiones = ejecutar_query(
+        """
+        SELECT partition_name as nombre, partition_description as limite
+        FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = 'logs' AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position
+        """,
+        fetch_all=True
+    )
+    return particiones or []
+
+
+def particionar_logs():
     """
-    logs = ejecutar_query(query, fetch_all=True)
-    return logs if logs else []
+    Convierte logs en una tabla particionada por mes (RANGE COLUMNS sobre fecha), una
+    sola vez. MySQL exige que la columna de partición esté en la clave primaria, por
+    eso pasa a ser (id, fecha); id sigue siendo AUTO_INCREMENT y único en la práctica.
+    """
+    if particiones_logs():
+        return False
+
+    ejecutar_query("UPDATE logs SET fecha = DATE(fecha_registro) WHERE fecha IS NULL", commit=True)
+    rango = ejecutar_query("SELECT MIN(fecha) as desde FROM logs", fetch_one=True)
+    hoy = datetime.now()
+    anio, mes = anio_mes(rango['desde']) if rango and rango.get('desde') else (hoy.year, hoy.month)
+    hasta = sumar_meses(hoy.year, hoy.month, LOGS_MESES_ADELANTE)
+
+    particiones = []
+    while (anio, mes) <= hasta:
+        particiones.append(particion_mes(anio, mes))
+        anio, mes = sumar_meses(anio, mes, 1)
+    particiones.append(f"PARTITION {PARTICION_FUTURO} VALUES LESS THAN (MAXVALUE)")
+
+    print("🔄 Particionando la tabla de logs por mes...")
+    ejecutar_query("ALTER TABLE logs DROP PRIMARY KEY, ADD PRIMARY KEY (id, fecha)", commit=True)
+    ejecutar_query(
+        f"ALTER TABLE logs PARTITION BY RANGE COLUMNS(fecha) ({', '.join(particiones)})",
+        commit=True
+    )
+    return True
+
+
+def asegurar_particiones_logs():
+    """
+    Crea las particiones de los próximos meses separándolas de p_futuro. p_futuro
+    está vacía mientras haya particiones adelantadas, así que reorganizarla no mueve filas.
+    """
+    particiones = [p['nombre'] for p in particiones_logs() if p['nombre'] != PARTICION_FUTURO]
+    if not particiones:
+        return []
+
+    hoy = datetime.now()
+    ultima = (int(particiones[-1][1:5]), int(particiones[-1][5:7]))
+    hasta = sumar_meses(hoy.year, hoy.month, LOGS_MESES_ADELANTE)
+
+    nuevas = []
+    anio, mes = sumar_meses(*ultima, 1)
+    while (anio, mes) <= hasta:
+        nuevas.append(particion_mes(anio, mes))
+        anio, mes = sumar_meses(anio, mes, 1)
+    if not nuevas:
+        return []
+
+    ejecutar_query(
+        f"""
+        ALTER TABLE logs REORGANIZE PARTITION {PARTICION_FUTURO} INTO (
+            {', '.join(nuevas)}, PARTITION {PARTICION_FUTURO} VALUES LESS THAN (MAXVALUE)
+        )
+        """,
+        commit=True
+    )
+    return nuevas
+
+
+def podar_logs(meses=None):
+    """
+    Aplica la retención: borra con DROP PARTITION los meses más antiguos que el
+    límite. Quitar una partición entera no recorre sus filas ni bloquea las demás.
+    """
+    meses = LOGS_MESES_RETENCION if meses is None else meses
+    if meses <= 0:
+        return {'particiones_eliminadas': []}
+
+    hoy = datetime.now()
+    limite, _ = rango_mes(*sumar_meses(hoy.year, hoy.month, -meses))
+    if almacen_logs:
+        vencidos = almacen_logs.podar(datetime.strptime(limite, '%Y-%m-%d').timestamp())
+        if vencidos:
+            registrar_log(
+                "Retención de logs",
+                f"Se eliminaron los logs anteriores a {limite} ({len(vencidos)} segmento(s))",
+                usuario='Sistema'
+            )
+        return {'segmentos_eliminados': vencidos}
+
+    vencidas = [
+        p['nombre'] for p in particiones_logs()
+        if p['nombre'] != PARTICION_FUTURO and p['limite'].strip("'") <= limite
+    ]
+    if vencidas:
+        ejecutar_query(f"ALTER TABLE logs DROP PARTITION {', '.join(vencidas)}", commit=True)
+        ejecutar_query("DELETE FROM resumen_logs_diario WHERE fecha < %s", (limite,), commit=True)
+        ejecutar_query("DELETE FROM logs_busqueda WHERE fecha < %s", (limite,), commit=True)
+        registrar_log(
+            "Retención de logs",
+            f"Se eliminaron los logs anteriores a {limite} ({', '.join(vencidas)})",
+            usuario='Sistema'
+        )
+    return {'particiones_eliminadas': vencidas}
+
+
+def mantener_logs():
+    """Tarea diaria: crea las particiones de los próximos meses y aplica la retención"""
+    if almacen_logs:
+        return podar_logs()
+    return {'particiones_creadas': len(asegurar_particiones_logs()), **podar_logs()}
 
 
 # ---------------------------------------------------------------------------------
 # DECORADORES DE AUTENTICACIÓN
 # ---------------------------------------------------------------------------------
+def sesion_vigente():
+    """
+    True si el usuario de la sesión sigue existiendo y activo. Actualiza el rol de la
+    sesión si el admin lo cambió; si no, cierra la sesión. Usa el caché estado_usuarios;
+    si la base no responde se mantiene la sesión tal como está.
+    """
+    estado = estado_usuario(session['user_id'])
+    if estado is None:
+        # No se pudo consultar la base: la sesión sigue con el rol que ya tenía
+        return True
+    if not estado['activo']:
+        session.clear()
+        return False
+    session['rol'] = estado['rol']
+    return True
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             flash('Debes iniciar sesión para acceder a esta página.', 'warning')
             return redirect(url_for('login'))
+        if not sesion_vigente():
+            flash('Tu cuenta ya no está activa. Contacta al administrador.', 'warning')
+            return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -404,25 +1910,45 @@ def login():
             flash('Por favor completa todos los campos.', 'error')
             return redirect(url_for('login'))
         
-        usuarios = cargar_usuarios()
-        usuario = next((u for u in usuarios if u['username'] == username), None)
+        # Antes de tocar la base o calcular un hash
+        ip = request.remote_addr or 'desconocida'
+        if not limitador_login.permitir(ip, username):
+            flash('Demasiados intentos de inicio de sesión. Espera unos segundos e intenta de nuevo.', 'error')
+            return redirect(url_for('login'))
+        
+        usuario = obtener_usuario_por_username(username)
         
         if not usuario:
-            flash('Usuario no encontrado.', 'error')
+            limitador_login.fallo(ip, username)
+            flash('Usuario o contraseña incorrectos.', 'error')
             return redirect(url_for('login'))
         
-        if not usuario.get('activo', True):
-            flash('Tu cuenta está desactivada. Contacta al administrador.', 'error')
+        try:
+            password_valida = hash_contrasenas.verificar(usuario['password'], password)
+        except HashSaturado:
+            flash('Hay muchos inicios de sesión en este momento. Intenta de nuevo en unos segundos.', 'warning')
             return redirect(url_for('login'))
         
-        if not check_password_hash(usuario['password'], password):
-            flash('Contraseña incorrecta.', 'error')
+        # Una cuenta desactivada cuenta como intento fallido y responde igual que
+        # una contraseña incorrecta, para no revelar qué cuentas existen
+        if not password_valida or not usuario.get('activo', True):
+            limitador_login.fallo(ip, username)
+            flash('Usuario o contraseña incorrectos.', 'error')
             return redirect(url_for('login'))
         
+        limitador_login.exito(ip, username)
+        
+        if hash_contrasenas.requiere_rehash(usuario['password']):
+            usuario_id, hash_verificado = usuario['id'], usuario['password']
+            hash_contrasenas.rehash_en_segundo_plano(
+                password, lambda nuevo_hash: guardar_hash_usuario(usuario_id, nuevo_hash, hash_verificado)
+            )
+        
         session['user_id'] = usuario['id']
         session['username'] = usuario['username']
         session['nombre_completo'] = usuario['nombre_completo']
         session['rol'] = usuario['rol']
+        estado_usuarios.guardar(usuario['id'], {'rol': usuario['rol'], 'activo': True})
         
         registrar_log('Inicio de sesión', f"Usuario: {usuario['username']}")
         
@@ -474,13 +2000,15 @@ def nuevo_usuario():
             flash('Rol inválido.', 'error')
             return redirect(url_for('nuevo_usuario'))
         
-        usuarios = cargar_usuarios()
-        
-        if any(u['username'] == username for u in usuarios):
+        if obtener_usuario_por_username(username):
             flash(f'El usuario "{username}" ya existe.', 'error')
             return redirect(url_for('nuevo_usuario'))
         
-        usuario_id = crear_usuario(username, password, nombre_completo, rol)
+        try:
+            usuario_id = crear_usuario(username, password, nombre_completo, rol)
+        except HashSaturado:
+            flash('El servidor está ocupado. Intenta de nuevo en unos segundos.', 'warning')
+            return redirect(url_for('nuevo_usuario'))
         
         if usuario_id:
             registrar_log('Usuario creado', f"Nuevo usuario: {username} ({ROLES[rol]})")
@@ -510,6 +2038,7 @@ def toggle_usuario(id):
     
     nuevo_estado = not usuario.get('activo', True)
     actualizar_usuario_estado(id, nuevo_estado)
+    estado_usuarios.invalidar(id)
     
     estado = "activado" if nuevo_estado else "desactivado"
     registrar_log(f'Usuario {estado}', f"Usuario: {usuario['username']}")
@@ -538,6 +2067,7 @@ def eliminar_usuario(id):
         return redirect(url_for('lista_usuarios'))
     
     eliminar_usuario_db(id)
+    estado_usuarios.invalidar(id)
     
     registrar_log('Usuario eliminado', f"Usuario: {usuario['username']}")
     
@@ -575,12 +2105,16 @@ def cambiar_password():
             flash('Usuario no encontrado.', 'error')
             return redirect(url_for('cambiar_password'))
         
-        if not check_password_hash(usuario['password'], password_actual):
-            flash('La contraseña actual es incorrecta.', 'error')
+        try:
+            if not hash_contrasenas.verificar(usuario['password'], password_actual):
+                flash('La contraseña actual es incorrecta.', 'error')
+                return redirect(url_for('cambiar_password'))
+            
+            actualizar_password_usuario(usuario['id'], password_nueva)
+        except HashSaturado:
+            flash('El servidor está ocupado. Intenta de nuevo en unos segundos.', 'warning')
             return redirect(url_for('cambiar_password'))
         
-        actualizar_password_usuario(usuario['id'], password_nueva)
-        
         registrar_log('Contraseña cambiada', f"Usuario: {usuario['username']}")
         
         flash('¡Contraseña actualizada exitosamente!', 'success')
@@ -616,7 +2150,11 @@ def resetear_password_usuario(id):
             flash('La contraseña debe tener al menos 6 caracteres.', 'error')
             return redirect(url_for('resetear_password_usuario', id=id))
         
-        actualizar_password_usuario(id, nueva_password)
+        try:
+            actualizar_password_usuario(id, nueva_password)
+        except HashSaturado:
+            flash('El servidor está ocupado. Intenta de nuevo en unos segundos.', 'warning')
+            return redirect(url_for('resetear_password_usuario', id=id))
         
         registrar_log('Contraseña reseteada por admin', f"Admin reseteó contraseña de: {usuario['username']}")
         
@@ -630,18 +2168,106 @@ def resetear_password_usuario(id):
 @login_required
 @role_required('admin', 'auditor')
 def ver_logs():
-    """Ver logs del sistema"""
-    logs = cargar_logs()
-    return render_template('logs.html', logs=logs)
+    """Ver logs del sistema: filtros por usuario, acción y fechas, paginados por id"""
+    filtros = {
+        campo: request.args.get(campo, '').strip()
+        for campo in ('fecha_desde', 'fecha_hasta', 'usuario', 'accion')
+    }
+    if not fechas_filtro_validas(filtros['fecha_desde'], filtros['fecha_hasta']):
+        flash("Las fechas deben tener el formato AAAA-MM-DD.", "error")
+        filtros['fecha_desde'] = filtros['fecha_hasta'] = ''
+
+    antes = request.args.get('antes', type=int)
+    despues = request.args.get('despues', type=int)
+    # Fecha del log que hace de cursor; solo se usa cuando hay un rango de fechas
+    fecha_cursor = request.args.get('fecha_cursor', '').strip()
+    if not fechas_filtro_validas(fecha_cursor):
+        fecha_cursor = ''
+    criterios = {**criterios_busqueda_logs(request.args), **filtros}
+    busqueda = {
+        k: criterios[k] for k in CAMPOS_BUSQUEDA_LOGS
+        if criterios[k] not in ('', None)
+    }
+
+    if busqueda:
+        # La búsqueda solo avanza hacia logs más antiguos; "Más recientes" vuelve al inicio
+        logs, hay_siguientes = buscar_logs(criterios, antes=antes)
+        hay_anteriores = antes is not None
+        total = None
+    else:
+        logs, hay_anteriores, hay_siguientes = cargar_logs(
+            filtros, antes=antes, despues=despues, fecha_cursor=fecha_cursor
+        )
+        total = contar_logs(filtros)
+    usuarios, acciones = opciones_filtro_logs()
+
+    return render_template(
+        'logs.html',
+        logs=logs,
+        filtros=filtros,
+        busqueda=busqueda,
+        filtros_activos={**{k: v for k, v in filtros.items() if v}, **busqueda},
+        total=total,
+        hay_anteriores=hay_anteriores,
+        hay_siguientes=hay_siguientes,
+        usuarios=usuarios,
+        acciones=acciones,
+        retencion_meses=LOGS_MESES_RETENCION
+    )
+
+
+@app.route('/logs/buscar')
+@login_required
+@role_required('admin', 'auditor')
+def buscar_logs_json():
+    """
+    Búsqueda de logs en JSON: texto libre sobre acción y detalle (FULLTEXT) y filtros
+    por producto_id, venta_id, usuario, accion, monto_min y fechas. Pagina con antes=id.
+    """
+    criterios = criterios_busqueda_logs(request.args)
+    if not fechas_filtro_validas(criterios['fecha_desde'], criterios['fecha_hasta']):
+        return jsonify({'success': False, 'error': 'Las fechas deben tener el formato AAAA-MM-DD'}), 400
+
+    logs, hay_mas = buscar_logs(criterios, antes=request.args.get('antes', type=int))
+    for log in logs:
+        for campo in ('fecha', 'hora', 'fecha_registro'):
+            if log.get(campo) is not None:
+                log[campo] = str(log[campo])
+        if log.get('monto') is not None:
+            log['monto'] = float(log['monto'])
+
+    return jsonify({
+        'success': True,
+        'logs': logs,
+        'hay_mas': hay_mas,
+        'siguiente': logs[-1]['id'] if hay_mas else None
+    })
 
 
 @app.route('/logs/eliminar/<int:id>', methods=['POST'])
 @login_required
 @role_required('admin')
 def eliminar_log(id):
-    """Elimina un log individual"""
-    query = "DELETE FROM logs WHERE id = %s"
-    ejecutar_query(query, (id,), commit=True)
+    """Elimina un log individual y lo descuenta del resumen diario"""
+    if almacen_logs:
+        flash("Los logs guardados en archivos no se eliminan uno por uno; se borran por antigüedad.", "warning")
+        return redirect(url_for('ver_logs'))
+
+    log = ejecutar_query("SELECT fecha, usuario, accion FROM logs WHERE id = %s", (id,), fetch_one=True)
+    if log:
+        clave = (log['fecha'], log['usuario'], log['accion'])
+        ejecutar_transaccion([
+            ("DELETE FROM logs WHERE id = %s AND fecha = %s", (id, log['fecha'])),
+            ("DELETE FROM logs_busqueda WHERE log_id = %s", (id,)),
+            (
+                "UPDATE resumen_logs_diario SET total = total - 1 WHERE fecha = %s AND usuario = %s AND accion = %s",
+                clave
+            ),
+            (
+                "DELETE FROM resumen_logs_diario WHERE fecha = %s AND usuario = %s AND accion = %s AND total <= 0",
+                clave
+            ),
+        ])
 
     registrar_log("Log eliminado", f"ID del log eliminado: {id}")
     flash("Registro eliminado correctamente.", "success")
@@ -653,13 +2279,33 @@ def eliminar_log(id):
 @role_required('admin')
 def limpiar_logs():
     """Elimina todos los registros del historial y reinicia el AUTO_INCREMENT"""
-    ejecutar_query("DELETE FROM logs", commit=True)
-    ejecutar_query("ALTER TABLE logs AUTO_INCREMENT = 1", commit=True)
+    if almacen_logs:
+        almacen_logs.limpiar()
+    else:
+        # TRUNCATE vacía todas las particiones sin recorrer filas y reinicia el AUTO_INCREMENT
+        ejecutar_query("TRUNCATE TABLE logs", commit=True)
+        ejecutar_query("DELETE FROM resumen_logs_diario", commit=True)
+        ejecutar_query("TRUNCATE TABLE logs_busqueda", commit=True)
     registrar_log("Historial limpiado", "Se eliminaron todos los logs y se reinició el AUTO_INCREMENT.")
     flash("Historial limpiado correctamente. IDs reiniciados desde 1.", "success")
     return redirect(url_for('ver_logs'))
 
 
+@app.route('/logs/podar', methods=['POST'])
+@login_required
+@role_required('admin')
+def podar_logs_antiguos():
+    """Aplica ahora la retención de logs en lugar de esperar la tarea diaria"""
+    resultado = podar_logs()
+    if resultado.get('segmentos_eliminados'):
+        flash(f"Se eliminaron {len(resultado['segmentos_eliminados'])} segmento(s) de logs anteriores a la retención.", "success")
+    elif resultado.get('particiones_eliminadas'):
+        flash(f"Se eliminaron {len(resultado['particiones_eliminadas'])} mes(es) de logs anteriores a la retención.", "success")
+    else:
+        flash(f"No hay logs con más de {LOGS_MESES_RETENCION} meses.", "info")
+    return redirect(url_for('ver_logs'))
+
+
 # ---------------------------------------------------------------------------------
 # RUTAS PRINCIPALES DE PRODUCTOS
 # ---------------------------------------------------------------------------------
@@ -674,22 +2320,19 @@ def inicio():
 @login_required
 def lista_productos():
     """Lista todos los productos con filtros y búsqueda"""
-    productos = cargar_productos()
-
     query = request.args.get("q", "").lower().strip()
     categoria = request.args.get("categoria", "").strip()
     ordenar = request.args.get("ordenar", "")
     solo_bajo_stock = request.args.get("solo_bajo_stock", "0") == "1"
 
+    productos = cargar_productos_bajo_stock() if solo_bajo_stock else cargar_productos()
+
     if query:
         productos = [p for p in productos if query in p.get('nombre', '').lower()]
 
     if categoria:
         productos = [p for p in productos if p.get('categoria') == categoria]
 
-    if solo_bajo_stock:
-        productos = [p for p in productos if p.get('stock', 0) < STOCK_MINIMO]
-
     if ordenar == "precio_asc":
         productos = sorted(productos, key=lambda x: x.get("precio_unitario", 0))
     elif ordenar == "precio_desc":
@@ -699,17 +2342,15 @@ def lista_productos():
     elif ordenar == "stock_desc":
         productos = sorted(productos, key=lambda x: x.get("stock", 0), reverse=True)
 
-    todos_productos = cargar_productos()
-    bajo_stock_total = sum(1 for p in todos_productos if p.get('stock', 0) < STOCK_MINIMO)
-    categorias = sorted({p.get("categoria", "") for p in todos_productos})
+    bajo_stock_total = contar_productos_bajo_stock()
+    categorias = cargar_categorias()
 
     return render_template(
         "productos.html",
         productos=productos,
         categorias=categorias,
         bajo_stock_total=bajo_stock_total,
-        solo_bajo_stock=solo_bajo_stock,
-        STOCK_MINIMO=STOCK_MINIMO
+        solo_bajo_stock=solo_bajo_stock
     )
 
 
@@ -726,7 +2367,7 @@ def nuevo_producto():
             stock = int(request.form['stock'])
             precio_unitario = round(float(request.form['precio_unitario']), 3)
             descripcion = request.form.get('descripcion', '').strip()
-            codigo_sku = request.form.get('codigo_sku', '').strip()
+            codigo_sku = request.form.get('codigo_sku', '').strip() or None
 
             if not nombre or not categoria:
                 flash("El nombre y la categoría son obligatorios.", "error")
@@ -799,7 +2440,7 @@ def editar_producto(id):
             stock = int(request.form['stock'])
             precio_unitario = round(float(request.form['precio_unitario']), 3)
             descripcion = request.form.get('descripcion', '').strip()
-            codigo_sku = request.form.get('codigo_sku', '').strip()
+            codigo_sku = request.form.get('codigo_sku', '').strip() or None
 
             if stock < 0 or precio_unitario < 0:
                 flash("El stock y el precio no pueden ser negativos.", "error")
@@ -974,12 +2615,14 @@ def nueva_venta():
             # Registrar en logs
             registrar_log(
                 'Venta registrada', 
-                f"{cantidad} x {producto['nombre']} | Total: ${total_venta:,.0f} | Ganancia: ${ganancia_total:,.0f} ({porcentaje_ganancia}%)"
+                f"Venta #{venta_id} | {cantidad} x {producto['nombre']} (Producto #{producto_id}) | "
+                f"Total: ${total_venta:,.0f} | Ganancia: ${ganancia_total:,.0f} ({porcentaje_ganancia}%)"
             )
 
             # Actualizar stock del producto
             nuevo_stock = producto['stock'] - cantidad
             actualizar_stock_producto(producto_id, nuevo_stock)
+            encolar_puntos_reorden([producto_id])
 
             # Mostrar mensaje de éxito
             flash(
@@ -1097,10 +2740,21 @@ def historial_ventas():
 def eliminar_venta(id):
     """Elimina una venta del historial"""
     try:
+        venta = ejecutar_query("SELECT fecha, producto_id FROM ventas WHERE id = %s", (id,), fetch_one=True)
+        
+        if not venta:
+            flash('Venta no encontrada.', 'error')
+            return redirect(url_for('historial_ventas'))
+        
         query = "DELETE FROM ventas WHERE id = %s"
-        ejecutar_query(query, (id,), commit=True)
+        ejecutar_transaccion(
+            [(query, (id,))]
+            + sentencias_recalcular_resumen_iva(venta['fecha'])
+            + sentencias_recalcular_resumen_ventas(venta['fecha'], venta['producto_id'])
+        )
+        encolar_puntos_reorden([venta['producto_id']])
         
-        registrar_log('Venta eliminada', f'ID de venta eliminada: {id}')
+        registrar_log('Venta eliminada', f"ID de venta eliminada: {id} | Producto #{venta['producto_id']}")
         
         if reiniciar_autoincrement_ventas():
             flash('Venta eliminada. IDs reiniciados a 1 (no quedan ventas).', 'success')
@@ -1179,7 +2833,7 @@ def editar_venta(id):
         return redirect(url_for('editar_venta', id=id))
     
     venta_actual = ejecutar_query(
-        "SELECT producto_id, cantidad FROM ventas WHERE id = %s",
+        "SELECT producto_id, cantidad, fecha FROM ventas WHERE id = %s",
         (id,),
         fetch_one=True
     )
@@ -1232,13 +2886,15 @@ def editar_venta(id):
         WHERE id = %s
     """
     
-    ejecutar_query(
-        query_update,
-        (producto_id, producto['nombre'], producto['categoria'], 
-         cantidad, precio_base, iva_total, porcentaje_ganancia, 
-         ganancia_unitaria, ganancia_total, total_venta, id),
-        commit=True
+    params_update = (
+        producto_id, producto['nombre'], producto['categoria'], 
+        cantidad, precio_base, iva_total, porcentaje_ganancia, 
+        ganancia_unitaria, ganancia_total, total_venta, id
     )
+    sentencias = [(query_update, params_update)] + sentencias_recalcular_resumen_iva(venta_actual['fecha'])
+    for pid in {venta_actual['producto_id'], producto_id}:
+        sentencias += sentencias_recalcular_resumen_ventas(venta_actual['fecha'], pid)
+    ejecutar_transaccion(sentencias)
     
     actualizar_stock_producto(producto_id, nuevo_stock)
     
@@ -1248,7 +2904,9 @@ def editar_venta(id):
             stock_anterior_nuevo = producto_anterior['stock'] + venta_actual['cantidad']
             actualizar_stock_producto(venta_actual['producto_id'], stock_anterior_nuevo)
     
-    registrar_log('Venta editada', f"ID: {id} | Producto: {producto['nombre']} x{cantidad}")
+    encolar_puntos_reorden([venta_actual['producto_id'], producto_id])
+    
+    registrar_log('Venta editada', f"ID: {id} | Producto: {producto['nombre']} (Producto #{producto_id}) x{cantidad}")
     
     flash(f"Venta #{id} actualizada exitosamente.", "success")
     return redirect(url_for('historial_ventas'))
@@ -1256,187 +2914,493 @@ def editar_venta(id):
 
 
 # ---------------------------------------------------------------------------------
-# DASHBOARD Y REPORTES
+# CÁLCULO DE REPORTES (CON CACHÉ)
 # ---------------------------------------------------------------------------------
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    """Dashboard con métricas y estadísticas generales"""
-    productos = cargar_productos()
-    ventas = cargar_ventas()
+def reporte_cacheado(nombre, tablas, calcular, **parametros):
+    """
+    Devuelve el resultado de un reporte desde la caché. La clave incluye la
+    versión de las tablas de las que depende, así cualquier escritura lo invalida.
+    Si alguna consulta falló durante el cálculo el resultado se entrega sin guardarlo.
+    """
+    errores = errores_db_hilo()
+    return cache_reportes.obtener_o_calcular(
+        nombre,
+        parametros,
+        versiones_datos.actual(*tablas),
+        lambda: calcular(**parametros),
+        guardar_si=lambda: errores_db_hilo() == errores
+    )
 
-    total_productos = len(productos)
-    valor_inventario_total = sum(p.get('valor_total', 0) for p in productos)
-    productos_bajo_stock = sum(1 for p in productos if p.get('stock', 0) < STOCK_MINIMO)
-    total_ventas_realizadas = len(ventas)
-    ingresos_totales = sum(v.get('total', 0) for v in ventas)
 
-    ventas_por_producto = {}
-    for v in ventas:
-        pid = v.get('producto_id')
-        if pid not in ventas_por_producto:
-            ventas_por_producto[pid] = {
-                'nombre': v.get('producto_nombre'),
-                'cantidad_vendida': 0,
-                'ingresos': 0
-            }
-        ventas_por_producto[pid]['cantidad_vendida'] += v.get('cantidad', 0)
-        ventas_por_producto[pid]['ingresos'] += v.get('total', 0)
+def calcular_reporte_periodo():
+    """Ventas agrupadas por día y por mes"""
+    lotes = iterar_query("SELECT fecha, cantidad, total FROM ventas")
+    ventas_por_dia, ventas_por_mes = analitica.ventas_por_periodo(analitica.cargar_ventas(lotes))
+    return {'ventas_por_dia': ventas_por_dia, 'ventas_por_mes': ventas_por_mes}
 
-    top_vendidos = sorted(
-        ventas_por_producto.values(),
-        key=lambda x: x['cantidad_vendida'],
-        reverse=True
-    )[:5]
 
-    ventas_por_categoria = {}
-    for v in ventas:
-        cat = v.get('categoria', 'Sin categoría')
-        if cat not in ventas_por_categoria:
-            ventas_por_categoria[cat] = {
-                'cantidad': 0,
-                'ingresos': 0
-            }
-        ventas_por_categoria[cat]['cantidad'] += v.get('cantidad', 0)
-        ventas_por_categoria[cat]['ingresos'] += v.get('total', 0)
+CONSULTA_TOTALES_INVENTARIO = """
+    SELECT COUNT(*) as total_items,
+           COALESCE(SUM(stock), 0) as total_unidades,
+           COALESCE(SUM(stock * precio_unitario), 0) as valor_total
+    FROM productos
+"""
 
-    ventas_por_dia = defaultdict(lambda: {'cantidad': 0, 'ingresos': 0})
 
-    for v in ventas:
-        fecha = v.get('fecha')
-        ventas_por_dia[fecha]['cantidad'] += v.get('cantidad', 0)
-        ventas_por_dia[fecha]['ingresos'] += v.get('total', 0)
-
-    ventas_diarias = sorted(
-        [{'fecha': k, 'cantidad': v['cantidad'], 'ingresos': v['ingresos']}
-         for k, v in ventas_por_dia.items() if k],
-        key=lambda x: x['fecha']
-    )[-7:]
-
-    productos_criticos = [
-        p for p in productos
-        if p.get('stock', 0) < STOCK_MINIMO
-    ]
-    productos_criticos = sorted(productos_criticos, key=lambda x: x.get('stock', 0))[:10]
+def calcular_totales_inventario(totales=None):
+    """Totales del inventario calculados en MySQL, sin traer los productos"""
+    if totales is None:
+        totales = ejecutar_query(CONSULTA_TOTALES_INVENTARIO, fetch_one=True)
+    totales = totales or {}
+    return {
+        'total_items': int(totales.get('total_items') or 0),
+        'total_unidades': int(totales.get('total_unidades') or 0),
+        'valor_total': float(totales.get('valor_total') or 0),
+    }
 
-    return render_template(
-        'dashboard.html',
-        total_productos=total_productos,
-        valor_inventario_total=valor_inventario_total,
-        productos_bajo_stock=productos_bajo_stock,
-        total_ventas_realizadas=total_ventas_realizadas,
-        ingresos_totales=ingresos_totales,
-        top_vendidos=top_vendidos,
-        ventas_por_categoria=ventas_por_categoria,
-        ventas_diarias=ventas_diarias,
-        productos_criticos=productos_criticos,
-        STOCK_MINIMO=STOCK_MINIMO
-    )
 
+def calcular_inventario_total():
+    """Productos del inventario con su valor y los totales generales"""
+    productos = analitica.cargar_productos(iterar_query(
+        "SELECT id, nombre, categoria, stock, precio_unitario FROM productos ORDER BY id"
+    ))
+    productos['valor'] = analitica.valor_por_producto(productos)
 
-@app.route('/reportes/productos-mas-vendidos')
-@login_required
-def reporte_mas_vendidos():
-    """Reporte detallado de productos más vendidos"""
+    return {
+        'productos': analitica.a_registros(productos),
+        **analitica.totales_inventario(productos)
+    }
+
+
+def consulta_iva(anio='', mes=''):
+    """(query, params, filtro_texto) del IVA por año y mes sobre el resumen mensual"""
+    query = """
+        SELECT anio, mes, num_ventas, total_vendido, iva_total
+        FROM resumen_iva_mensual
+        WHERE 1=1
+    """
+    
+    params = []
+    filtro_texto = ""
+    
+    if anio.isdigit():
+        query += " AND anio = %s"
+        params.append(int(anio))
+        filtro_texto = f"Año {anio}"
+    
+    if mes.isdigit():
+        query += " AND mes = %s"
+        params.append(int(mes))
+        nombre_mes = MESES_NOMBRES.get(int(mes), 'Mes ' + mes)
+        filtro_texto = f"{filtro_texto} - {nombre_mes}" if filtro_texto else nombre_mes
+    
+    query += " ORDER BY anio DESC, mes DESC"
+    return query, tuple(params) if params else None, filtro_texto
+
+
+def resumir_iva(resultados):
+    """Filas por mes (con el nombre del mes) y totales del reporte de IVA"""
+    resumen = analitica.cargar_frame([resultados or []], analitica.TIPOS_IVA)
+    return {
+        'iva_por_mes': [
+            {**r, 'mes_nombre': MESES_NOMBRES.get(r['mes'], str(r['mes']))}
+            for r in analitica.a_registros(resumen)
+        ],
+        'total_iva': float(resumen['iva_total'].sum()),
+        'total_vendido': float(resumen['total_vendido'].sum()),
+        'total_ventas': int(resumen['num_ventas'].sum()),
+    }
+
+
+def calcular_reporte_iva(anio='', mes=''):
+    """IVA cobrado agrupado por año y mes, leído del resumen mensual (clave primaria anio, mes)"""
+    query, params, filtro_texto = consulta_iva(anio, mes)
+    resultados = ejecutar_query(query, params, fetch_all=True)
+    
+    return {
+        **resumir_iva(resultados),
+        'anios': reporte_cacheado('anios_ventas', ('resumen_iva_mensual',), cargar_anios_ventas),
+        'filtro_texto': filtro_texto
+    }
+
+
+def consulta_rentabilidad(fecha_desde='', fecha_hasta=''):
+    """
+    (query, params) de la rentabilidad por producto y subtotales por categoría en
+    una sola pasada sobre ventas (GROUP BY ... WITH ROLLUP, rango de fechas sobre idx_ventas_fecha).
+    """
+    where, params = filtros_ventas_sql(fecha_desde, fecha_hasta)
+
+    query = f"""
+        SELECT 
+            COALESCE(v.categoria, 'Sin categoría') as categoria,
+            v.producto_id,
+            MAX(v.producto_nombre) as nombre,
+            COUNT(*) as num_ventas,
+            SUM(v.cantidad) as cantidad_vendida,
+            SUM(v.total) as total_vendido,
+            AVG(v.ganancia_unitaria) as ganancia_unitaria_promedio,
+            SUM(v.ganancia_total) as ganancia_total
+        FROM ventas v{where}
+        GROUP BY COALESCE(v.categoria, 'Sin categoría'), v.producto_id WITH ROLLUP
+    """
+    return query, tuple(params) if params else None
+
+
+def resumir_rentabilidad(resultados, ordenar='ganancia'):
+    """Productos y categorías ordenados, con la ganancia y las unidades totales"""
+    productos, categorias = analitica.rentabilidad_desde_rollup(resultados, ordenar)
+    return {
+        'productos_rentables': analitica.a_registros(productos),
+        'rentabilidad_categorias': analitica.a_registros(categorias),
+        'ganancia_total': float(productos['ganancia_total'].sum()),
+        'unidades_vendidas': int(productos['cantidad_vendida'].sum())
+    }
+
+
+def calcular_reporte_rentabilidad(fecha_desde='', fecha_hasta='', ordenar='ganancia'):
+    """Rentabilidad por producto y subtotales por categoría (ver consulta_rentabilidad)"""
+    query, params = consulta_rentabilidad(fecha_desde, fecha_hasta)
+    resultados = ejecutar_query(query, params, fetch_all=True)
+    return resumir_rentabilidad(resultados, ordenar)
+
+
+def calcular_serie_ventas(desde, hasta, intervalo='dia', producto_id='', categoria='', max_puntos=MAX_PUNTOS_SERIE):
+    """
+    Serie de ventas (num_ventas, cantidad, ingresos) entre dos fechas, agrupada por
+    hora, día, semana o mes. Día y semana salen del resumen diario, mes del mensual
+    y hora de ventas (solo rangos cortos: si el rango no cabe en max_puntos se pasa
+    a un intervalo más grueso), así el costo depende del número de puntos y no del
+    largo del histórico.
+    """
+    intervalo_usado = analitica.elegir_intervalo(desde, hasta, intervalo, max_puntos)
+    inicio = analitica.inicio_intervalo(desde, intervalo_usado).strftime('%Y-%m-%d')
+    fin = analitica.fin_intervalo(hasta, intervalo_usado).strftime('%Y-%m-%d')
+
+    if intervalo_usado == 'mes':
+        anio_desde, mes_desde = anio_mes(inicio)
+        anio_hasta, mes_hasta = anio_mes(fin)
+        condiciones = ["(v.anio, v.mes) >= (%s, %s)", "(v.anio, v.mes) <= (%s, %s)"]
+        params = [anio_desde, mes_desde, anio_hasta, mes_hasta]
+        if categoria:
+            condiciones.append("v.categoria = %s")
+            params.append(categoria)
+        where = " WHERE " + " AND ".join(condiciones)
+        tabla = "resumen_ventas_mensual"
+        columna_inicio = "MAKEDATE(v.anio, 1) + INTERVAL (v.mes - 1) MONTH"
+    else:
+        where, params = filtros_ventas_sql(inicio, fin, categoria)
+        if intervalo_usado == 'hora':
+            tabla = "ventas"
+            columna_inicio = "TIMESTAMP(v.fecha, MAKETIME(HOUR(v.hora), 0, 0))"
+        else:
+            tabla = "resumen_ventas_diario"
+            columna_inicio = "v.fecha" if intervalo_usado == 'dia' else "DATE_SUB(v.fecha, INTERVAL WEEKDAY(v.fecha) DAY)"
+
+    if producto_id:
+        where += " AND v.producto_id = %s"
+        params.append(int(producto_id))
+
+    if tabla == "ventas":
+        agregados = "COUNT(*) as num_ventas, SUM(v.cantidad) as cantidad, SUM(v.total) as ingresos"
+    else:
+        agregados = "SUM(v.num_ventas) as num_ventas, SUM(v.cantidad) as cantidad, SUM(v.ingresos) as ingresos"
+
+    query = f"""
+        SELECT {columna_inicio} as inicio, {agregados}
+        FROM {tabla} v{where}
+        GROUP BY inicio
+    """
+    filas = ejecutar_query(query, tuple(params), fetch_all=True)
+    puntos, intervalos_por_punto = analitica.serie_temporal(filas, inicio, fin, intervalo_usado, max_puntos)
+
+    return {
+        'desde': inicio,
+        'hasta': fin,
+        'intervalo': intervalo_usado,
+        'intervalo_solicitado': intervalo,
+        'intervalos_por_punto': intervalos_por_punto,
+        'puntos': puntos
+    }
+
+
+def calcular_dashboard():
+    """Métricas y estadísticas generales del dashboard"""
+    productos = cargar_productos()
     ventas = cargar_ventas()
 
-    if not ventas:
-        flash("No hay ventas registradas para generar el reporte.", "info")
-        return redirect(url_for('dashboard'))
+    total_productos = len(productos)
+    valor_inventario_total = sum(p.get('valor_total', 0) for p in productos)
+    productos_bajo_stock = contar_productos_bajo_stock()
+    total_ventas_realizadas = len(ventas)
+    ingresos_totales = sum(v.get('total', 0) for v in ventas)
 
     ventas_por_producto = {}
     for v in ventas:
         pid = v.get('producto_id')
         if pid not in ventas_por_producto:
             ventas_por_producto[pid] = {
-                'id': pid,
                 'nombre': v.get('producto_nombre'),
-                'categoria': v.get('categoria'),
                 'cantidad_vendida': 0,
-                'ingresos': 0,
-                'num_ventas': 0
+                'ingresos': 0
             }
         ventas_por_producto[pid]['cantidad_vendida'] += v.get('cantidad', 0)
         ventas_por_producto[pid]['ingresos'] += v.get('total', 0)
-        ventas_por_producto[pid]['num_ventas'] += 1
 
-    productos_vendidos = list(ventas_por_producto.values())
-
-    top_5_mas = sorted(
-        productos_vendidos,
+    top_vendidos = sorted(
+        ventas_por_producto.values(),
         key=lambda x: x['cantidad_vendida'],
         reverse=True
     )[:5]
 
-    top_5_menos = sorted(
-        productos_vendidos,
-        key=lambda x: x['cantidad_vendida']
-    )[:5]
+    ventas_por_categoria = {}
+    for v in ventas:
+        cat = v.get('categoria', 'Sin categoría')
+        if cat not in ventas_por_categoria:
+            ventas_por_categoria[cat] = {
+                'cantidad': 0,
+                'ingresos': 0
+            }
+        ventas_por_categoria[cat]['cantidad'] += v.get('cantidad', 0)
+        ventas_por_categoria[cat]['ingresos'] += v.get('total', 0)
 
-    todos_ordenados = sorted(
-        productos_vendidos,
-        key=lambda x: x['cantidad_vendida'],
-        reverse=True
+    hoy = datetime.now().date()
+    serie = calcular_serie_ventas((hoy - timedelta(days=6)).isoformat(), hoy.isoformat(), 'dia')
+    ventas_diarias = [
+        {'fecha': p['inicio'], 'cantidad': p['cantidad'], 'ingresos': p['ingresos']}
+        for p in serie['puntos']
+    ]
+
+    productos_criticos = cargar_productos_bajo_stock(limite=10)
+
+    return {
+        'total_productos': total_productos,
+        'valor_inventario_total': valor_inventario_total,
+        'productos_bajo_stock': productos_bajo_stock,
+        'total_ventas_realizadas': total_ventas_realizadas,
+        'ingresos_totales': ingresos_totales,
+        'top_vendidos': top_vendidos,
+        'ventas_por_categoria': ventas_por_categoria,
+        'ventas_diarias': ventas_diarias,
+        'productos_criticos': productos_criticos
+    }
+
+
+# ---------------------------------------------------------------------------------
+# PLANIFICADOR DE REPORTES (SNAPSHOTS PRECALCULADOS)
+# ---------------------------------------------------------------------------------
+def reporte_precalculado(nombre, tablas, calcular, **parametros):
+    """
+    Sirve el snapshot del planificador si existe para estos parámetros;
+    si no, calcula (con caché). Devuelve (datos, edad_en_segundos o None).
+    """
+    snapshot = planificador.snapshot(nombre, parametros)
+    if snapshot is not None:
+        return snapshot
+    return reporte_cacheado(nombre, tablas, calcular, **parametros), None
+
+
+def parametros_rentabilidad_meses():
+    """Filtros de rentabilidad para el mes actual y el anterior"""
+    hoy = datetime.now().date()
+    inicio_actual = hoy.replace(day=1)
+    fin_anterior = inicio_actual - timedelta(days=1)
+    inicio_anterior = fin_anterior.replace(day=1)
+    fin_actual = (inicio_actual + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return [
+        {'fecha_desde': inicio_actual.isoformat(), 'fecha_hasta': fin_actual.isoformat(), 'ordenar': 'ganancia'},
+        {'fecha_desde': inicio_anterior.isoformat(), 'fecha_hasta': fin_anterior.isoformat(), 'ordenar': 'ganancia'},
+    ]
+
+
+def parametros_iva_meses():
+    """Filtros de IVA: todo el histórico, el año actual y el mes actual"""
+    hoy = datetime.now().date()
+    return [
+        {},
+        {'anio': str(hoy.year)},
+        {'anio': str(hoy.year), 'mes': f"{hoy.month:02d}"},
+    ]
+
+
+def registrar_tareas_planificador():
+    # Los reportes con snapshot fallan si una consulta falló: el planificador
+    # conserva el snapshot anterior en lugar de guardar uno vacío o incompleto
+    intervalo = int(os.getenv('PLANIFICADOR_INTERVALO', 900))
+    umbral = int(os.getenv('PLANIFICADOR_UMBRAL_VENTAS', 20))
+
+    planificador.registrar(
+        'dashboard', sin_errores_db(calcular_dashboard),
+        intervalo=intervalo, tablas=('ventas', 'productos'), umbral_cambios=umbral,
+        descripcion='Métricas del dashboard'
+    )
+    planificador.registrar(
+        'iva', sin_errores_db(calcular_reporte_iva), parametros=parametros_iva_meses,
+        intervalo=intervalo, tablas=('ventas',), umbral_cambios=umbral,
+        descripcion='IVA por mes (histórico, año y mes actual)'
+    )
+    planificador.registrar(
+        'rentabilidad', sin_errores_db(calcular_reporte_rentabilidad), parametros=parametros_rentabilidad_meses,
+        intervalo=intervalo, tablas=('ventas',), umbral_cambios=umbral,
+        descripcion='Rentabilidad del mes actual y del anterior'
     )
+    planificador.registrar(
+        'puntos_reorden', actualizar_puntos_reorden,
+        intervalo=24 * 3600,
+        descripcion='Velocidad de venta y punto de reorden de todos los productos'
+    )
+    planificador.registrar(
+        'puntos_reorden_pendientes', recalcular_puntos_reorden_pendientes,
+        intervalo=60,
+        descripcion='Punto de reorden de los productos con ventas recientes'
+    )
+    planificador.registrar(
+        'inventario_total', sin_errores_db(calcular_inventario_total),
+        intervalo=intervalo, tablas=('productos',), umbral_cambios=umbral,
+        descripcion='Totales del inventario'
+    )
+    planificador.registrar(
+        'intentos_login', registrar_intentos_fallidos,
+        intervalo=60,
+        descripcion='Resumen en logs de los inicios de sesión fallidos'
+    )
+    planificador.registrar(
+        'indexar_logs', sin_errores_db(indexar_logs_pendientes),
+        intervalo=24 * 3600,
+        descripcion='Agrega al índice de búsqueda los logs que falten'
+    )
+    planificador.registrar(
+        'mantener_logs', mantener_logs,
+        intervalo=24 * 3600,
+        descripcion='Particiones mensuales de logs y retención'
+    )
+
+
+registrar_tareas_planificador()
+versiones_datos.suscribir(lambda tabla, version: planificador.notificar_cambio(tabla))
+
+
+# ---------------------------------------------------------------------------------
+# DASHBOARD Y REPORTES
+# ---------------------------------------------------------------------------------
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    """Dashboard con métricas y estadísticas generales"""
+    datos, edad_snapshot = reporte_precalculado('dashboard', ('ventas', 'productos'), calcular_dashboard)
 
     return render_template(
-        'reporte_productos.html',
-        top_5_mas=top_5_mas,
-        top_5_menos=top_5_menos,
-        todos_productos=todos_ordenados,
-        total_productos=len(productos_vendidos)
+        'dashboard.html',
+        **datos,
+        edad_snapshot=edad_snapshot
     )
 
 
-@app.route('/reportes/ventas-por-periodo')
+@app.route('/api/ventas/serie')
 @login_required
-def reporte_ventas_periodo():
-    """Reporte de ventas por período usando MySQL"""
+def api_serie_ventas():
+    """
+    Serie temporal de ventas para gráficas.
+    Parámetros: desde, hasta (YYYY-MM-DD), intervalo (hora|dia|semana|mes),
+    producto_id, categoria y max_puntos.
+    """
+    hoy = datetime.now().date()
+    try:
+        desde = datetime.strptime(request.args.get('desde') or (hoy - timedelta(days=29)).isoformat(), '%Y-%m-%d').date()
+        hasta = datetime.strptime(request.args.get('hasta') or hoy.isoformat(), '%Y-%m-%d').date()
+        producto_id = request.args.get('producto_id', '').strip()
+        if producto_id:
+            producto_id = str(int(producto_id))
+        max_puntos = min(max(int(request.args.get('max_puntos', MAX_PUNTOS_SERIE)), 1), MAX_PUNTOS_SERIE)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Parámetros inválidos'}), 400
+
+    intervalo = INTERVALOS_SERIE.get(request.args.get('intervalo', 'dia').strip().lower())
+    if not intervalo:
+        return jsonify({'success': False, 'error': 'Intervalo no válido (hora, dia, semana o mes)'}), 400
+
+    if desde > hasta:
+        return jsonify({'success': False, 'error': 'La fecha inicial es posterior a la final'}), 400
+
+    serie = reporte_cacheado(
+        'serie_ventas', ('ventas', 'resumen_ventas_diario', 'resumen_ventas_mensual'), calcular_serie_ventas,
+        desde=desde.isoformat(),
+        hasta=hasta.isoformat(),
+        intervalo=intervalo,
+        producto_id=producto_id,
+        categoria=request.args.get('categoria', '').strip(),
+        max_puntos=max_puntos
+    )
+    return jsonify({'success': True, **serie})
 
-    ventas = cargar_ventas()
 
-    if not ventas:
-        flash("No hay ventas registradas.", "info")
-        return redirect(url_for('dashboard'))
+@app.route('/reportes/productos-mas-vendidos')
+@login_required
+def reporte_mas_vendidos():
+    """Reporte detallado de productos más vendidos"""
+    fecha_desde = request.args.get('fecha_desde', '').strip()
+    fecha_hasta = request.args.get('fecha_hasta', '').strip()
+    categoria = request.args.get('categoria', '').strip()
 
-    ventas_diarias = defaultdict(lambda: {'cantidad': 0, 'ingresos': 0, 'num_ventas': 0})
-    ventas_mensuales = defaultdict(lambda: {'cantidad': 0, 'ingresos': 0, 'num_ventas': 0})
+    try:
+        pagina = max(int(request.args.get('pagina', 1)), 1)
+    except ValueError:
+        pagina = 1
 
-    for v in ventas:
-        fecha = v.get('fecha')
+    total_productos = contar_productos_vendidos(fecha_desde, fecha_hasta, categoria)
 
-        if isinstance(fecha, datetime):
-            fecha_str = fecha.strftime("%Y-%m-%d")
-        elif hasattr(fecha, "strftime"):  
-            fecha_str = fecha.strftime("%Y-%m-%d")
-        else:
-            fecha_str = str(fecha)
+    if not total_productos and not (fecha_desde or fecha_hasta or categoria):
+        flash("No hay ventas registradas para generar el reporte.", "info")
+        return redirect(url_for('dashboard'))
 
-        ventas_diarias[fecha_str]['cantidad'] += v.get('cantidad', 0)
-        ventas_diarias[fecha_str]['ingresos'] += v.get('total', 0)
-        ventas_diarias[fecha_str]['num_ventas'] += 1
+    total_paginas = max(math.ceil(total_productos / POR_PAGINA_REPORTES), 1)
+    pagina = min(pagina, total_paginas)
 
-        mes = fecha_str[:7]
-        ventas_mensuales[mes]['cantidad'] += v.get('cantidad', 0)
-        ventas_mensuales[mes]['ingresos'] += v.get('total', 0)
-        ventas_mensuales[mes]['num_ventas'] += 1
+    top_5_mas = ranking_productos_vendidos(fecha_desde, fecha_hasta, categoria)
+    top_5_menos = ranking_productos_vendidos(fecha_desde, fecha_hasta, categoria, ascendente=True)
 
-    ventas_por_dia = sorted(
-        [{'fecha': k, **v} for k, v in ventas_diarias.items()],
-        key=lambda x: x['fecha'],
-        reverse=True
+    todos_ordenados = ranking_productos_vendidos(
+        fecha_desde, fecha_hasta, categoria,
+        limite=POR_PAGINA_REPORTES,
+        desplazamiento=(pagina - 1) * POR_PAGINA_REPORTES
     )
 
-    ventas_por_mes = sorted(
-        [{'mes': k, **v} for k, v in ventas_mensuales.items()],
-        key=lambda x: x['mes'],
-        reverse=True
+    filtros = {
+        k: v for k, v in (
+            ('fecha_desde', fecha_desde),
+            ('fecha_hasta', fecha_hasta),
+            ('categoria', categoria)
+        ) if v
+    }
+
+    return render_template(
+        'reporte_productos.html',
+        top_5_mas=top_5_mas,
+        top_5_menos=top_5_menos,
+        todos_productos=todos_ordenados,
+        total_productos=total_productos,
+        categorias=cargar_categorias(),
+        filtros=filtros,
+        pagina=pagina,
+        total_paginas=total_paginas,
+        desplazamiento=(pagina - 1) * POR_PAGINA_REPORTES
     )
 
+
+@app.route('/reportes/ventas-por-periodo')
+@login_required
+def reporte_ventas_periodo():
+    """Reporte de ventas por período usando MySQL"""
+    reporte = reporte_cacheado('periodo', ('ventas',), calcular_reporte_periodo)
+
+    if not reporte['ventas_por_dia']:
+        flash("No hay ventas registradas.", "info")
+        return redirect(url_for('dashboard'))
+
     return render_template(
         'reporte_periodo.html',
-        ventas_por_dia=ventas_por_dia,
-        ventas_por_mes=ventas_por_mes
+        ventas_por_dia=reporte['ventas_por_dia'],
+        ventas_por_mes=reporte['ventas_por_mes']
     )
 
 
@@ -1444,608 +3408,304 @@ def reporte_ventas_periodo():
 @login_required
 def reporte_inventario_total():
     """Reporte completo del inventario total"""
-    productos = cargar_productos()
+    reporte, edad_snapshot = reporte_precalculado('inventario_total', ('productos',), calcular_inventario_total)
 
-    if not productos:
+    if not reporte['productos']:
         flash("No hay productos en el inventario para mostrar el reporte.", "info")
         return redirect(url_for('lista_productos'))
 
-    total_items = len(productos)
-    total_unidades = sum(p.get('stock', 0) for p in productos)
-    valor_total_inventario = sum(p.get('stock', 0) * p.get('precio_unitario', 0) for p in productos)
-
-    productos_ordenados = sorted(productos, key=lambda x: x.get('id', 0))
-
     return render_template(
         "reportes/reporte_inventario_total.html",
-        productos=productos_ordenados,
-        total_items=total_items,
-        total_unidades=total_unidades,
-        valor_total=valor_total_inventario
+        productos=reporte['productos'],
+        total_items=reporte['total_items'],
+        total_unidades=reporte['total_unidades'],
+        valor_total=reporte['valor_total'],
+        edad_snapshot=edad_snapshot
     )
 
 
-@app.route("/reportes/inventario-total/excel")
-@login_required
-def exportar_excel_inventario():
-    """Exporta el inventario total a Excel"""
-    try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        from openpyxl.utils import get_column_letter
-    except Exception as e:
-        flash("openpyxl no está disponible. Instala 'openpyxl' para exportar a Excel.", "error")
-        return redirect(url_for('reporte_inventario_total'))
+# ---------------------------------------------------------------------------------
+# EXPORTACIONES (GENERADORES DE ARCHIVOS)
+# ---------------------------------------------------------------------------------
+def progreso_por_filas(progreso, total):
+    """Adapta un callback de progreso (fracción) a uno que recibe filas escritas"""
+    if not progreso or not total:
+        return None
+    return lambda escritas: progreso(escritas / total, f"{escritas:,} de {total:,} filas")
 
-    import io
 
-    productos = cargar_productos()
-    productos_sorted = sorted(productos, key=lambda x: x.get('id', 0))
-
-    total_items = len(productos_sorted)
-    total_unidades = sum(p.get('stock', 0) for p in productos_sorted)
-    valor_total = sum(p.get('stock', 0) * p.get('precio_unitario', 0) for p in productos_sorted)
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Inventario Total"
-
-    ws.merge_cells('A1:F1')
-    cell_title = ws['A1']
-    cell_title.value = "Reporte de Inventario Total - Motorrepuestos H&D"
-    cell_title.font = Font(size=14, bold=True)
-    cell_title.alignment = Alignment(horizontal="center", vertical="center")
-
-    ws.merge_cells('A2:B2')
-    ws.merge_cells('C2:D2')
-    ws.merge_cells('E2:F2')
-
-    ws['A2'].value = "Total de Productos"
-    ws['C2'].value = "Total de Unidades"
-    ws['E2'].value = "Valor Total del Inventario"
-
-    ws['A2'].font = Font(bold=True)
-    ws['C2'].font = Font(bold=True)
-    ws['E2'].font = Font(bold=True)
-
-    ws.merge_cells('A3:B3')
-    ws.merge_cells('C3:D3')
-    ws.merge_cells('E3:F3')
-
-    ws['A3'].value = total_items
-    ws['C3'].value = total_unidades
-    ws['E3'].value = valor_total
-
-    ws['A3'].alignment = Alignment(horizontal="center")
-    ws['C3'].alignment = Alignment(horizontal="center")
-    ws['E3'].alignment = Alignment(horizontal="center")
-
-    box_fill = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
-    for cell_coord in ['A2', 'C2', 'E2', 'A3', 'C3', 'E3']:
-        ws[cell_coord].fill = box_fill
-
-    start_row = 5
-    encabezados = ["ID", "Producto", "Categoría", "Cantidad", "Precio Unitario", "Valor Total"]
-
-    for col_idx, header in enumerate(encabezados, start=1):
-        cell = ws.cell(row=start_row, column=col_idx, value=header)
-        cell.fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-        cell.font = Font(color="FFFFFF", bold=True)
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    row = start_row + 1
-    for p in productos_sorted:
-        cantidad = p.get("stock", 0)
-        precio = p.get("precio_unitario", 0)
-        valor = round(cantidad * precio, 2)
-
-        ws.cell(row=row, column=1, value=p.get("id"))
-        ws.cell(row=row, column=2, value=p.get("nombre"))
-        ws.cell(row=row, column=3, value=p.get("categoria"))
-        ws.cell(row=row, column=4, value=cantidad)
-
-        cell_precio = ws.cell(row=row, column=5, value=precio)
-        cell_valor = ws.cell(row=row, column=6, value=valor)
-
-        cell_precio.number_format = '"$"#,##0.00'
-        cell_valor.number_format = '"$"#,##0.00'
-
-        ws.cell(row=row, column=1).alignment = Alignment(horizontal="center")
-        ws.cell(row=row, column=4).alignment = Alignment(horizontal="center")
-
-        row += 1
-
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
+CONSULTA_FILAS_INVENTARIO = (
+    "SELECT id, nombre, categoria, stock, precio_unitario, "
+    "ROUND(stock * precio_unitario, 2) as valor FROM productos ORDER BY id"
+)
+
+
+def filas_inventario(lotes=None):
+    """Filas del inventario leídas por lotes desde MySQL (o de los lotes dados)"""
+    if lotes is None:
+        lotes = iterar_query(CONSULTA_FILAS_INVENTARIO)
+    return (
+        (p['id'], p['nombre'], p['categoria'], p['stock'], float(p['precio_unitario'] or 0), float(p['valor'] or 0))
+        for lote in lotes
+        for p in lote
     )
 
-    max_col = len(encabezados)
-    max_row = ws.max_row
 
-    for r in ws.iter_rows(min_row=start_row, max_row=max_row, min_col=1, max_col=max_col):
-        for c in r:
-            c.border = thin_border
+COLUMNAS_INVENTARIO = [
+    exportador.Columna("ID", 'centrado', ancho=6),
+    exportador.Columna("Producto", ancho=36),
+    exportador.Columna("Categoría", ancho=18),
+    exportador.Columna("Cantidad", 'entero', ancho=9, total=True),
+    exportador.Columna("Precio Unitario", 'moneda', ancho=14),
+    exportador.Columna("Valor Total", 'moneda', ancho=15, total=True),
+]
 
-    for idx, column_cells in enumerate(ws.columns, start=1):
-        try:
-            length = max(len(str(cell.value)) if cell.value else 0 for cell in column_cells)
-        except:
-            length = 10
 
-        width = min(max(length + 2, 10), 60)
-        col_letter = get_column_letter(idx)
-        ws.column_dimensions[col_letter].width = width
+def datos_inventario():
+    """Resumen, filas y número de filas del inventario total"""
+    totales = reporte_cacheado('totales_inventario', ('productos',), calcular_totales_inventario)
+    resumen = [
+        ("Total de Productos", totales['total_items']),
+        ("Total de Unidades", totales['total_unidades']),
+        ("Valor Total del Inventario", totales['valor_total'], 'moneda'),
+    ]
+    return resumen, filas_inventario(), totales['total_items']
 
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
 
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name="inventario_total.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+COLUMNAS_IVA = [
+    exportador.Columna("Año", 'centrado', ancho=12),
+    exportador.Columna("Mes", ancho=15),
+    exportador.Columna("Ventas Realizadas", 'entero', ancho=18, total=True),
+    exportador.Columna("Total Vendido", 'moneda', ancho=18, total=True),
+    exportador.Columna("IVA Cobrado", 'moneda', ancho=18, total=True, destacar=True),
+]
+
+
+def datos_iva(anio='', mes=''):
+    """
+    Resumen, filas y número de filas del reporte de IVA. Sale de los datos actuales
+    (caché por versión), no del snapshot del planificador: el archivo se guarda en
+    cache_archivos con la versión actual de las tablas y debe corresponderle.
+    """
+    reporte = reporte_cacheado('iva', ('resumen_iva_mensual',), calcular_reporte_iva, anio=anio, mes=mes)
+    resumen = [
+        ("Total Ventas Realizadas", reporte['total_ventas']),
+        ("Total Vendido", reporte['total_vendido'], 'moneda'),
+        ("IVA a Pagar", reporte['total_iva'], 'moneda'),
+    ]
+    filas = [
+        (r['anio'], r['mes_nombre'], r['num_ventas'], r['total_vendido'], r['iva_total'])
+        for r in reporte['iva_por_mes']
+    ]
+    return resumen, filas, len(filas)
+
+
+COLUMNAS_RENTABILIDAD = [
+    exportador.Columna("Posición", 'centrado', ancho=10),
+    exportador.Columna("Producto", ancho=30),
+    exportador.Columna("Categoría", ancho=15),
+    exportador.Columna("Unidades", 'entero', ancho=10, total=True),
+    exportador.Columna("Total Vendido", 'moneda', ancho=15, total=True),
+    exportador.Columna("Gan. Unitaria", 'moneda', ancho=15),
+    exportador.Columna("Gan. Total", 'moneda', ancho=15, total=True, destacar=True),
+    exportador.Columna("% Margen", 'porcentaje', ancho=12),
+]
+
+
+def datos_rentabilidad(fecha_desde='', fecha_hasta='', ordenar='ganancia'):
+    """Resumen, filas y número de filas del reporte de rentabilidad (datos actuales, como datos_iva)"""
+    reporte = reporte_cacheado(
+        'rentabilidad', ('ventas',), calcular_reporte_rentabilidad,
+        fecha_desde=fecha_desde, fecha_hasta=fecha_hasta, ordenar=ordenar
     )
+    productos = reporte['productos_rentables']
+    resumen = [
+        ("Ganancia Total", reporte['ganancia_total'], 'moneda'),
+        ("Productos Vendidos", len(productos)),
+        ("Unidades Vendidas", reporte['unidades_vendidas']),
+    ]
+    filas = [
+        (posicion, r['nombre'], r['categoria'], r['cantidad_vendida'], r['total_vendido'],
+         r['ganancia_unitaria_promedio'], r['ganancia_total'], r['margen_porcentaje'])
+        for posicion, r in enumerate(productos, start=1)
+    ]
+    return resumen, filas, len(filas)
+
+
+# Reportes tabulares exportables: cada uno se puede generar en todos los formatos de exportador.FORMATOS
+REPORTES_EXPORTABLES = {
+    'inventario': {
+        'titulo': "Reporte de Inventario Total - Motorrepuestos H&D", 'hoja': "Inventario Total",
+        'color': "1F4E78", 'columnas': COLUMNAS_INVENTARIO, 'datos': datos_inventario,
+        'nombre_descarga': "inventario_total", 'parametros': (), 'tablas': ('productos',),
+    },
+    'iva': {
+        'titulo': "Reporte de IVA a Pagar al Gobierno", 'hoja': "Reporte IVA",
+        'color': "F39C12", 'columnas': COLUMNAS_IVA, 'datos': datos_iva,
+        'nombre_descarga': "reporte_iva", 'parametros': ('anio', 'mes'), 'tablas': ('resumen_iva_mensual',),
+    },
+    'rentabilidad': {
+        'titulo': "Reporte de Productos Más Rentables", 'hoja': "Rentabilidad",
+        'color': "27AE60", 'columnas': COLUMNAS_RENTABILIDAD, 'datos': datos_rentabilidad,
+        'nombre_descarga': "reporte_rentabilidad", 'parametros': ('fecha_desde', 'fecha_hasta', 'ordenar'),
+        'tablas': ('ventas',), 'destacar_primeras': 3,
+    },
+}
 
 
-@app.route("/reportes/inventario-total/pdf")
-@login_required
-def exportar_pdf_inventario():
-    """Exporta el inventario total a PDF"""
-    try:
-        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.lib import colors
-        from reportlab.lib.pagesizes import A4, landscape
-    except Exception:
-        flash("reportlab no está disponible. Instala 'reportlab' para exportar a PDF.", "error")
-        return redirect(url_for('reporte_inventario_total'))
+def generador_reporte(reporte, formato):
+    """Función generar(ruta, progreso=None, **parametros) de un reporte en un formato"""
+    definicion = REPORTES_EXPORTABLES[reporte]
+
+    def generar(ruta, progreso=None, **parametros):
+        resumen, filas, total = definicion['datos'](**parametros)
+        exportador.escribir_tabla(
+            ruta, formato,
+            titulo=definicion['titulo'],
+            columnas=definicion['columnas'],
+            filas=filas,
+            resumen=resumen,
+            hoja=definicion['hoja'],
+            color=definicion['color'],
+            destacar_primeras=definicion.get('destacar_primeras', 0),
+            progreso=progreso_por_filas(progreso, total)
+        )
+    return generar
 
-    productos = cargar_productos()
-    productos_sorted = sorted(productos, key=lambda x: x.get('id', 0))
-
-    total_items = len(productos_sorted)
-    total_unidades = sum(p.get('stock', 0) for p in productos_sorted)
-    valor_total = sum(p.get('stock', 0) * p.get('precio_unitario', 0) for p in productos_sorted)
-
-    import io
-    buffer = io.BytesIO()
-
-    doc = SimpleDocTemplate(
-        buffer,
-        pagesize=landscape(A4),
-        rightMargin=20,
-        leftMargin=20,
-        topMargin=20,
-        bottomMargin=20
-    )
 
-    styles = getSampleStyleSheet()
-    story = []
+def clave_exportacion(tipo, parametros):
+    """Clave del archivo en la caché (y ETag): tipo, filtros y versión de los datos"""
+    definicion = TIPOS_EXPORTACION[tipo]
+    return cache_archivos.clave(tipo, parametros, versiones_datos.actual(*definicion['tablas']))
 
-    title_style = ParagraphStyle(
-        name="TitleCenter",
-        parent=styles['Heading1'],
-        alignment=1,
-        fontSize=18,
-        spaceAfter=8
-    )
 
-    story.append(Paragraph("Reporte de Inventario Total - Motorrepuestos H&D", title_style))
-    story.append(Spacer(1, 8))
+def archivo_exportacion(tipo, parametros, progreso=None):
+    """
+    Devuelve (ruta, etag, temporal) del archivo de una exportación. Si ya existe en
+    la caché para estos filtros y esta versión de los datos se reutiliza; si no, se
+    genera y se guarda. temporal=True cuando el archivo no cupo en la caché y debe
+    borrarse después de enviarlo.
+    """
+    definicion = TIPOS_EXPORTACION[tipo]
+    etag = clave_exportacion(tipo, parametros)
 
-    totals_data = [
-        ["Total de Productos", str(total_items)],
-        ["Total de Unidades", str(total_unidades)],
-        ["Valor Total del Inventario", f"${valor_total:,.2f}"]
-    ]
-    totals_table = Table(totals_data, colWidths=[200, 120], hAlign='CENTER')
-    totals_table.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#f0f0f0")),
-        ("BACKGROUND", (0, 1), (-1, -1), colors.whitesmoke),
-        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-    ]))
-    story.append(totals_table)
-    story.append(Spacer(1, 12))
-
-    data = [["ID", "Producto", "Categoría", "Cantidad", "Precio Unitario", "Valor Total"]]
-    for p in productos_sorted:
-        cantidad = p.get("stock", 0)
-        precio = p.get("precio_unitario", 0)
-        valor = round(cantidad * precio, 2)
-
-        data.append([
-            p.get("id"),
-            p.get("nombre"),
-            p.get("categoria"),
-            str(cantidad),
-            f"${precio:,.2f}",
-            f"${valor:,.2f}"
-        ])
+    ruta = cache_archivos.obtener(etag)
+    if ruta:
+        if progreso:
+            progreso(1.0, 'Archivo reutilizado de la caché')
+        return ruta, etag, False
 
-    col_widths = [40, 240, 120, 60, 90, 100]
+    temporal = exportador.archivo_temporal(definicion['sufijo'])
+    try:
+        sin_errores_db(definicion['generar'])(ruta=temporal, progreso=progreso, **parametros)
+        ruta = cache_archivos.guardar(etag, temporal, definicion['sufijo'])
+    except Exception:
+        exportador.eliminar_archivo(temporal)
+        raise
 
-    table = Table(data, colWidths=col_widths, repeatRows=1, hAlign='CENTER')
+    if ruta is None:
+        return temporal, etag, True
+    exportador.eliminar_archivo(temporal)
+    return ruta, etag, False
 
-    table_style = TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1F4E78")),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, 0), 10),
-        ("BOTTOMPADDING", (0, 0), (-1, 0), 8),
-        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-        ("BACKGROUND", (0, 1), (-1, -1), colors.whitesmoke),
-    ])
 
-    table.setStyle(table_style)
-    story.append(table)
+def enviar_exportacion(tipo, volver_a, **parametros):
+    """
+    Descarga directa (enlaces GET sin JavaScript). Si el archivo ya está en la caché
+    se sirve con su ETag; si no, se genera en el pool de exportaciones, con el mismo
+    límite por usuario que las exportaciones en segundo plano. La petición espera
+    unos segundos (ESPERA_EXPORTACION_DIRECTA) y redirige a la descarga; si tarda más
+    redirige a la página del trabajo, que muestra el enlace de descarga al terminar.
+    """
+    definicion = TIPOS_EXPORTACION[tipo]
+    etag = clave_exportacion(tipo, parametros)
+    ruta = cache_archivos.obtener(etag)
+    if ruta:
+        return send_file(
+            ruta,
+            as_attachment=True,
+            download_name=definicion['nombre_descarga'],
+            mimetype=definicion['mimetype'],
+            conditional=True,
+            etag=etag,
+            max_age=0
+        )
 
-    doc.build(story)
-    buffer.seek(0)
+    try:
+        trabajo = gestor_exportaciones.enviar(tipo, session.get('user_id'), parametros)
+    except LimiteTrabajosExcedido as e:
+        flash(str(e), "error")
+        return redirect(url_for(volver_a))
+
+    if not gestor_exportaciones.esperar(trabajo, ESPERA_EXPORTACION_DIRECTA):
+        return redirect(url_for('ver_exportacion', trabajo_id=trabajo.id, volver=url_for(volver_a)))
+
+    if trabajo.estado != LISTO:
+        print(f"❌ Error al generar {definicion['nombre_descarga']}: {trabajo.error}")
+        if (trabajo.error or '').startswith(('ImportError', 'ModuleNotFoundError')):
+            flash("No se puede exportar: falta una librería del servidor.", "error")
+        else:
+            flash("Error al generar el archivo.", "error")
+        return redirect(url_for(volver_a))
+    return redirect(url_for('descargar_exportacion', trabajo_id=trabajo.id))
+
+
+@app.route("/reportes/inventario-total/excel")
+@login_required
+def exportar_excel_inventario():
+    """Exporta el inventario total a Excel"""
+    return enviar_exportacion('inventario_excel', 'reporte_inventario_total')
 
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name="inventario_total.pdf",
-        mimetype="application/pdf"
-    )
+
+@app.route("/reportes/inventario-total/pdf")
+@login_required
+def exportar_pdf_inventario():
+    """Exporta el inventario total a PDF"""
+    return enviar_exportacion('inventario_pdf', 'reporte_inventario_total')
 
 @app.route('/reportes/iva')
 @login_required
 def reporte_iva():
     """Reporte de IVA a pagar al gobierno"""
-    anio_filtro = request.args.get('anio', '')
-    mes_filtro = request.args.get('mes', '')
-    
-    query = """
-        SELECT 
-            YEAR(fecha) as anio,
-            MONTH(fecha) as mes,
-            COUNT(*) as num_ventas,
-            SUM(total) as total_vendido,
-            SUM(iva_total) as iva_total
-        FROM ventas
-        WHERE 1=1
-    """
-    
-    params = []
-    filtro_texto = ""
-    
-    if anio_filtro:
-        query += " AND YEAR(fecha) = %s"
-        params.append(anio_filtro)
-        filtro_texto = f"Año {anio_filtro}"
-    
-    if mes_filtro:
-        query += " AND MONTH(fecha) = %s"
-        params.append(mes_filtro)
-        meses = {
-            '01': 'Enero', '02': 'Febrero', '03': 'Marzo', '04': 'Abril',
-            '05': 'Mayo', '06': 'Junio', '07': 'Julio', '08': 'Agosto',
-            '09': 'Septiembre', '10': 'Octubre', '11': 'Noviembre', '12': 'Diciembre'
-        }
-        if filtro_texto:
-            filtro_texto += f" - {meses.get(mes_filtro, 'Mes ' + mes_filtro)}"
-        else:
-            filtro_texto = meses.get(mes_filtro, 'Mes ' + mes_filtro)
-    
-    query += " GROUP BY YEAR(fecha), MONTH(fecha) ORDER BY anio DESC, mes DESC"
-    
-    resultados = ejecutar_query(query, tuple(params) if params else None, fetch_all=True)
-    
-    iva_por_mes = []
-    total_iva = 0
-    total_vendido = 0
-    total_ventas = 0
-    
-    meses_nombres = {
-        1: 'Enero', 2: 'Febrero', 3: 'Marzo', 4: 'Abril',
-        5: 'Mayo', 6: 'Junio', 7: 'Julio', 8: 'Agosto',
-        9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'
-    }
-    
-    if resultados:
-        for r in resultados:
-            iva_por_mes.append({
-                'anio': r['anio'],
-                'mes': r['mes'],
-                'mes_nombre': meses_nombres.get(r['mes'], str(r['mes'])),
-                'num_ventas': r['num_ventas'],
-                'total_vendido': r['total_vendido'] or 0,
-                'iva_total': r['iva_total'] or 0
-            })
-            total_iva += r['iva_total'] or 0
-            total_vendido += r['total_vendido'] or 0
-            total_ventas += r['num_ventas']
-    
-    query_anios = "SELECT DISTINCT YEAR(fecha) as anio FROM ventas ORDER BY anio DESC"
-    anios_result = ejecutar_query(query_anios, fetch_all=True)
-    anios = [str(r['anio']) for r in anios_result] if anios_result else []
-    
-    return render_template(
-        'reportes/reporte_iva.html',
-        iva_por_mes=iva_por_mes,
-        total_iva=total_iva,
-        total_vendido=total_vendido,
-        total_ventas=total_ventas,
-        anios=anios,
-        filtro_texto=filtro_texto
+    reporte, edad_snapshot = reporte_precalculado(
+        'iva', ('resumen_iva_mensual',), calcular_reporte_iva,
+        anio=request.args.get('anio', ''),
+        mes=request.args.get('mes', '')
     )
+    
+    return render_template('reportes/reporte_iva.html', **reporte, edad_snapshot=edad_snapshot)
 
 
 @app.route('/reportes/iva/excel')
 @login_required
 def exportar_iva_excel():
     """Exporta el reporte de IVA a Excel"""
-    try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        from openpyxl.utils import get_column_letter
-    except Exception:
-        flash("openpyxl no está disponible. Instala 'openpyxl' para exportar a Excel.", "error")
-        return redirect(url_for('reporte_iva'))
-
-    import io
-    
-    anio_filtro = request.args.get('anio', '')
-    mes_filtro = request.args.get('mes', '')
-    
-    query = """
-        SELECT 
-            YEAR(fecha) as anio,
-            MONTH(fecha) as mes,
-            COUNT(*) as num_ventas,
-            SUM(total) as total_vendido,
-            SUM(iva_total) as iva_total
-        FROM ventas
-        WHERE 1=1
-    """
-    
-    params = []
-    
-    if anio_filtro:
-        query += " AND YEAR(fecha) = %s"
-        params.append(anio_filtro)
-    
-    if mes_filtro:
-        query += " AND MONTH(fecha) = %s"
-        params.append(mes_filtro)
-    
-    query += " GROUP BY YEAR(fecha), MONTH(fecha) ORDER BY anio DESC, mes DESC"
-    
-    resultados = ejecutar_query(query, tuple(params) if params else None, fetch_all=True)
-    
-    meses_nombres = {
-        1: 'Enero', 2: 'Febrero', 3: 'Marzo', 4: 'Abril',
-        5: 'Mayo', 6: 'Junio', 7: 'Julio', 8: 'Agosto',
-        9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'
-    }
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Reporte IVA"
-    
-    ws.merge_cells('A1:E1')
-    cell_title = ws['A1']
-    cell_title.value = "Reporte de IVA a Pagar al Gobierno"
-    cell_title.font = Font(size=16, bold=True, color="FFFFFF")
-    cell_title.fill = PatternFill(start_color="F39C12", end_color="F39C12", fill_type="solid")
-    cell_title.alignment = Alignment(horizontal="center", vertical="center")
-    ws.row_dimensions[1].height = 30
-    
-    total_iva = sum(r['iva_total'] or 0 for r in resultados) if resultados else 0
-    total_vendido = sum(r['total_vendido'] or 0 for r in resultados) if resultados else 0
-    total_ventas = sum(r['num_ventas'] for r in resultados) if resultados else 0
-    
-    ws.merge_cells('A3:B3')
-    ws.merge_cells('C3:D3')
-    ws['A3'] = "Total Ventas Realizadas"
-    ws['C3'] = "Total Vendido"
-    ws['E3'] = "IVA a Pagar"
-    
-    ws['A3'].font = Font(bold=True)
-    ws['C3'].font = Font(bold=True)
-    ws['E3'].font = Font(bold=True)
-    
-    ws.merge_cells('A4:B4')
-    ws.merge_cells('C4:D4')
-    ws['A4'] = total_ventas
-    ws['C4'] = total_vendido
-    ws['E4'] = total_iva
-    
-    ws['A4'].alignment = Alignment(horizontal="center")
-    ws['C4'].alignment = Alignment(horizontal="center")
-    ws['E4'].alignment = Alignment(horizontal="center")
-    
-    ws['C4'].number_format = '"$"#,##0.00'
-    ws['E4'].number_format = '"$"#,##0.00'
-    ws['E4'].font = Font(bold=True, size=14, color="E67E22")
-    
-    summary_fill = PatternFill(start_color="FEF5E7", end_color="FEF5E7", fill_type="solid")
-    for cell in ['A3', 'C3', 'E3', 'A4', 'C4', 'E4']:
-        ws[cell].fill = summary_fill
-    
-    start_row = 6
-    encabezados = ["Año", "Mes", "Ventas Realizadas", "Total Vendido", "IVA Cobrado"]
-    
-    for col_idx, header in enumerate(encabezados, start=1):
-        cell = ws.cell(row=start_row, column=col_idx, value=header)
-        cell.fill = PatternFill(start_color="F39C12", end_color="F39C12", fill_type="solid")
-        cell.font = Font(color="FFFFFF", bold=True)
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-    
-    row = start_row + 1
-    if resultados:
-        for r in resultados:
-            ws.cell(row=row, column=1, value=r['anio'])
-            ws.cell(row=row, column=2, value=meses_nombres.get(r['mes'], str(r['mes'])))
-            ws.cell(row=row, column=3, value=r['num_ventas'])
-            
-            cell_total = ws.cell(row=row, column=4, value=r['total_vendido'] or 0)
-            cell_total.number_format = '"$"#,##0.00'
-            
-            cell_iva = ws.cell(row=row, column=5, value=r['iva_total'] or 0)
-            cell_iva.number_format = '"$"#,##0.00'
-            cell_iva.font = Font(color="E67E22", bold=True)
-            
-            ws.cell(row=row, column=1).alignment = Alignment(horizontal="center")
-            ws.cell(row=row, column=3).alignment = Alignment(horizontal="center")
-            
-            row += 1
-    
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    max_row = row - 1
-    for r in ws.iter_rows(min_row=start_row, max_row=max_row, min_col=1, max_col=5):
-        for cell in r:
-            cell.border = thin_border
-    
-    ws.column_dimensions['A'].width = 12
-    ws.column_dimensions['B'].width = 15
-    ws.column_dimensions['C'].width = 18
-    ws.column_dimensions['D'].width = 18
-    ws.column_dimensions['E'].width = 18
-    
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name="reporte_iva.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    return enviar_exportacion(
+        'iva_excel', 'reporte_iva',
+        anio=request.args.get('anio', ''),
+        mes=request.args.get('mes', '')
+    )
 
 
 @app.route('/reportes/rentabilidad')
 @login_required
 def reporte_rentabilidad():
     """Reporte de productos más rentables"""
-    fecha_desde = request.args.get('fecha_desde', '')
-    fecha_hasta = request.args.get('fecha_hasta', '')
-    ordenar = request.args.get('ordenar', 'ganancia')
-    
-    query = """
-        SELECT 
-            v.producto_id,
-            p.nombre,
-            p.categoria,
-            COUNT(*) as num_ventas,
-            SUM(v.cantidad) as cantidad_vendida,
-            SUM(v.total) as total_vendido,
-            AVG(v.ganancia_unitaria) as ganancia_unitaria_promedio,
-            SUM(v.ganancia_total) as ganancia_total
-        FROM ventas v
-        JOIN productos p ON v.producto_id = p.id
-        WHERE 1=1
-    """
-    
-    params = []
-    
-    if fecha_desde:
-        query += " AND DATE(v.fecha) >= %s"
-        params.append(fecha_desde)
-    
-    if fecha_hasta:
-        query += " AND DATE(v.fecha) <= %s"
-        params.append(fecha_hasta)
-    
-    query += " GROUP BY v.producto_id, p.nombre, p.categoria"
-    
-    if ordenar == 'cantidad':
-        query += " ORDER BY cantidad_vendida DESC"
-    else:
-        query += " ORDER BY ganancia_total DESC"
-    
-    resultados = ejecutar_query(query, tuple(params) if params else None, fetch_all=True)
-    
-    productos_rentables = []
-    ganancia_total = 0
-    unidades_vendidas = 0
-    
-    if resultados:
-        for r in resultados:
-            ganancia_tot = r['ganancia_total'] or 0
-            total_vend = r['total_vendido'] or 0
-            
-            if total_vend > 0:
-                margen = (ganancia_tot / total_vend) * 100
-            else:
-                margen = 0
-            
-            productos_rentables.append({
-                'producto_id': r['producto_id'],
-                'nombre': r['nombre'],
-                'categoria': r['categoria'],
-                'num_ventas': r['num_ventas'],
-                'cantidad_vendida': r['cantidad_vendida'],
-                'total_vendido': total_vend,
-                'ganancia_unitaria_promedio': r['ganancia_unitaria_promedio'] or 0,
-                'ganancia_total': ganancia_tot,
-                'margen_porcentaje': margen
-            })
-            
-            ganancia_total += ganancia_tot
-            unidades_vendidas += r['cantidad_vendida']
-    
-    query_cat = """
-        SELECT 
-            p.categoria,
-            COUNT(DISTINCT v.producto_id) as num_productos,
-            SUM(v.cantidad) as unidades_vendidas,
-            SUM(v.ganancia_total) as ganancia_total
-        FROM ventas v
-        JOIN productos p ON v.producto_id = p.id
-        WHERE 1=1
-    """
-    
-    params_cat = []
-    
-    if fecha_desde:
-        query_cat += " AND DATE(v.fecha) >= %s"
-        params_cat.append(fecha_desde)
-    
-    if fecha_hasta:
-        query_cat += " AND DATE(v.fecha) <= %s"
-        params_cat.append(fecha_hasta)
-    
-    query_cat += " GROUP BY p.categoria ORDER BY ganancia_total DESC"
-    
-    resultados_cat = ejecutar_query(query_cat, tuple(params_cat) if params_cat else None, fetch_all=True)
-    
-    rentabilidad_categorias = []
-    if resultados_cat:
-        for r in resultados_cat:
-            ganancia_cat = r['ganancia_total'] or 0
-            num_prod = r['num_productos']
-            
-            rentabilidad_categorias.append({
-                'categoria': r['categoria'],
-                'num_productos': num_prod,
-                'unidades_vendidas': r['unidades_vendidas'],
-                'ganancia_total': ganancia_cat,
-                'ganancia_promedio': ganancia_cat / num_prod if num_prod > 0 else 0
-            })
+    reporte, edad_snapshot = reporte_precalculado(
+        'rentabilidad', ('ventas',), calcular_reporte_rentabilidad,
+        fecha_desde=request.args.get('fecha_desde', ''),
+        fecha_hasta=request.args.get('fecha_hasta', ''),
+        ordenar=request.args.get('ordenar', 'ganancia')
+    )
     
     return render_template(
         'reportes/reporte_rentabilidad.html',
-        productos_rentables=productos_rentables,
-        rentabilidad_categorias=rentabilidad_categorias,
-        ganancia_total=ganancia_total,
-        total_productos=len(productos_rentables),
-        unidades_vendidas=unidades_vendidas
+        productos_rentables=reporte['productos_rentables'],
+        rentabilidad_categorias=reporte['rentabilidad_categorias'],
+        ganancia_total=reporte['ganancia_total'],
+        total_productos=len(reporte['productos_rentables']),
+        unidades_vendidas=reporte['unidades_vendidas'],
+        edad_snapshot=edad_snapshot
     )
 
 
@@ -2053,175 +3713,415 @@ def reporte_rentabilidad():
 @login_required
 def exportar_rentabilidad_excel():
     """Exporta el reporte de rentabilidad a Excel"""
-    try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        from openpyxl.utils import get_column_letter
-    except Exception:
-        flash("openpyxl no está disponible.", "error")
-        return redirect(url_for('reporte_rentabilidad'))
+    return enviar_exportacion(
+        'rentabilidad_excel', 'reporte_rentabilidad',
+        fecha_desde=request.args.get('fecha_desde', ''),
+        fecha_hasta=request.args.get('fecha_hasta', ''),
+        ordenar=request.args.get('ordenar', 'ganancia')
+    )
 
-    import io
-    
-    fecha_desde = request.args.get('fecha_desde', '')
-    fecha_hasta = request.args.get('fecha_hasta', '')
-    ordenar = request.args.get('ordenar', 'ganancia')
-    
-    query = """
-        SELECT 
-            v.producto_id,
-            p.nombre,
-            p.categoria,
-            COUNT(*) as num_ventas,
-            SUM(v.cantidad) as cantidad_vendida,
-            SUM(v.total) as total_vendido,
-            AVG(v.ganancia_unitaria) as ganancia_unitaria_promedio,
-            SUM(v.ganancia_total) as ganancia_total
-        FROM ventas v
-        JOIN productos p ON v.producto_id = p.id
-        WHERE 1=1
+
+VISTAS_REPORTES = {
+    'inventario': 'reporte_inventario_total',
+    'iva': 'reporte_iva',
+    'rentabilidad': 'reporte_rentabilidad',
+}
+
+
+@app.route('/reportes/contable.xlsx')
+@login_required
+def exportar_libro_contable():
+    """Libro contable del mes: inventario, IVA, rentabilidad y ventas diarias en un solo Excel"""
+    return enviar_exportacion('contable_excel', 'dashboard')
+
+
+@app.route('/reportes/<reporte>/exportar/<formato>')
+@login_required
+def exportar_reporte(reporte, formato):
+    """Descarga directa de cualquier reporte tabular en cualquier formato (excel, pdf, csv)"""
+    tipo = f"{reporte}_{formato}"
+    if reporte not in REPORTES_EXPORTABLES or tipo not in TIPOS_EXPORTACION:
+        flash("Formato de exportación no válido.", "error")
+        return redirect(url_for('dashboard'))
+    parametros = {
+        nombre: request.args.get(nombre, '').strip()
+        for nombre in TIPOS_EXPORTACION[tipo]['parametros']
+        if request.args.get(nombre)
+    }
+    return enviar_exportacion(tipo, VISTAS_REPORTES[reporte], **parametros)
+
+# ---------------------------------------------------------------------------------
+# EXPORTACIONES CSV COMPRIMIDAS (DATOS CRUDOS)
+# ---------------------------------------------------------------------------------
+COLUMNAS_CSV_VENTAS = (
+    'id', 'fecha', 'hora', 'producto_id', 'producto_nombre', 'categoria', 'cantidad', 'precio_unitario',
+    'iva_total', 'porcentaje_ganancia', 'ganancia_unitaria', 'ganancia_total', 'total',
+    'usuario_id', 'usuario_nombre', 'fecha_registro'
+)
+COLUMNAS_CSV_LOGS = ('id', 'fecha', 'hora', 'usuario', 'accion', 'detalle', 'fecha_registro')
+
+
+def filas_csv(query, params, columnas):
     """
-    
-    params = []
-    
-    if fecha_desde:
-        query += " AND DATE(v.fecha) >= %s"
-        params.append(fecha_desde)
-    
-    if fecha_hasta:
-        query += " AND DATE(v.fecha) <= %s"
-        params.append(fecha_hasta)
-    
-    query += " GROUP BY v.producto_id, p.nombre, p.categoria"
-    
-    if ordenar == 'cantidad':
-        query += " ORDER BY cantidad_vendida DESC"
+    Tuplas de las columnas pedidas leídas con cursor del lado del servidor. Usa la
+    instantánea en lugar de iterar_query porque sus errores no se silencian: si la
+    lectura falla a mitad, la respuesta se corta sin el cierre del gzip y el archivo
+    queda inválido en lugar de parecer completo.
+    """
+    with instantanea_consistente() as instantanea:
+        for lote in instantanea.iterar(query, params):
+            for fila in lote:
+                yield tuple(fila[c] for c in columnas)
+
+
+@app.route('/exportar/ventas.csv.gz')
+@login_required
+def exportar_ventas_csv():
+    """
+    Todas las ventas (o las del rango fecha_desde / fecha_hasta y la categoría) en
+    CSV comprimido. Se leen con cursor del lado del servidor y se comprimen a medida
+    que se envían, así el tamaño del historial no afecta la memoria.
+    """
+    fecha_desde = request.args.get('fecha_desde', '').strip()
+    fecha_hasta = request.args.get('fecha_hasta', '').strip()
+    if not fechas_filtro_validas(fecha_desde, fecha_hasta):
+        flash("Las fechas deben tener el formato AAAA-MM-DD.", "error")
+        return redirect(url_for('historial_ventas'))
+
+    where, params = filtros_ventas_sql(fecha_desde, fecha_hasta, request.args.get('categoria', '').strip())
+    # ORDER BY fecha, id sigue el orden de idx_ventas_fecha (que incluye la clave primaria), sin ordenar en memoria
+    query = f"SELECT {', '.join('v.' + c for c in COLUMNAS_CSV_VENTAS)} FROM ventas v{where} ORDER BY v.fecha, v.id"
+
+    registrar_log('Exportación de ventas', f"CSV {fecha_desde or 'inicio'} a {fecha_hasta or 'hoy'}")
+    return exportador.enviar_csv_gzip(
+        f"ventas_{fecha_desde or 'inicio'}_{fecha_hasta or datetime.now().strftime('%Y-%m-%d')}.csv.gz",
+        COLUMNAS_CSV_VENTAS,
+        filas_csv(query, tuple(params), COLUMNAS_CSV_VENTAS)
+    )
+
+
+@app.route('/exportar/logs.csv.gz')
+@login_required
+@role_required('admin', 'auditor')
+def exportar_logs_csv():
+    """
+    Logs del sistema en CSV comprimido, con los mismos filtros y búsqueda que el
+    visor: fecha_desde, fecha_hasta, usuario, accion, texto, producto_id, venta_id
+    y monto_min
+    """
+    criterios = criterios_busqueda_logs(request.args)
+    fecha_desde, fecha_hasta = criterios['fecha_desde'], criterios['fecha_hasta']
+    if not fechas_filtro_validas(fecha_desde, fecha_hasta):
+        flash("Las fechas deben tener el formato AAAA-MM-DD.", "error")
+        return redirect(url_for('ver_logs'))
+
+    if almacen_logs:
+        desde_ts, hasta_ts = rango_ts_logs(fecha_desde, fecha_hasta)
+        cumple = filtro_logs_archivos(criterios)
+        registros = takewhile(
+            lambda r: hasta_ts is None or r['ts'] < hasta_ts,
+            almacen_logs.hacia_adelante(desde_ts=desde_ts)
+        )
+        filas = (tuple(r.get(c) for c in COLUMNAS_CSV_LOGS) for r in registros if cumple(r))
+    elif any(criterios[c] not in ('', None) for c in CAMPOS_BUSQUEDA_LOGS):
+        condiciones, params = condiciones_busqueda_logs(criterios)
+        where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+        query = f"""
+            SELECT {', '.join(f'l.{c}' for c in COLUMNAS_CSV_LOGS)}
+            FROM logs_busqueda b
+            JOIN logs l ON l.id = b.log_id AND l.fecha = b.fecha{where}
+            ORDER BY b.log_id
+        """
+        filas = filas_csv(query, tuple(params), COLUMNAS_CSV_LOGS)
     else:
-        query += " ORDER BY ganancia_total DESC"
-    
-    resultados = ejecutar_query(query, tuple(params) if params else None, fetch_all=True)
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Rentabilidad"
-    
-    ws.merge_cells('A1:H1')
-    cell_title = ws['A1']
-    cell_title.value = "Reporte de Productos Más Rentables"
-    cell_title.font = Font(size=16, bold=True, color="FFFFFF")
-    cell_title.fill = PatternFill(start_color="27AE60", end_color="27AE60", fill_type="solid")
-    cell_title.alignment = Alignment(horizontal="center", vertical="center")
-    ws.row_dimensions[1].height = 30
-    
-    ganancia_total = sum(r['ganancia_total'] or 0 for r in resultados) if resultados else 0
-    unidades_vendidas = sum(r['cantidad_vendida'] for r in resultados) if resultados else 0
-    
-    ws.merge_cells('A3:B3')
-    ws.merge_cells('C3:D3')
-    ws.merge_cells('E3:F3')
-    ws['A3'] = "Ganancia Total"
-    ws['C3'] = "Productos Vendidos"
-    ws['E3'] = "Unidades Vendidas"
-    
-    ws['A3'].font = Font(bold=True)
-    ws['C3'].font = Font(bold=True)
-    ws['E3'].font = Font(bold=True)
-    
-    ws.merge_cells('A4:B4')
-    ws.merge_cells('C4:D4')
-    ws.merge_cells('E4:F4')
-    ws['A4'] = ganancia_total
-    ws['C4'] = len(resultados)
-    ws['E4'] = unidades_vendidas
-    
-    ws['A4'].alignment = Alignment(horizontal="center")
-    ws['C4'].alignment = Alignment(horizontal="center")
-    ws['E4'].alignment = Alignment(horizontal="center")
-    
-    ws['A4'].number_format = '"$"#,##0.00'
-    ws['A4'].font = Font(bold=True, size=14, color="27AE60")
-    
-    summary_fill = PatternFill(start_color="E8F8F5", end_color="E8F8F5", fill_type="solid")
-    for cell in ['A3', 'C3', 'E3', 'A4', 'C4', 'E4']:
-        ws[cell].fill = summary_fill
-    
-    start_row = 6
-    encabezados = ["Posición", "Producto", "Categoría", "Unidades", "Total Vendido", "Gan. Unitaria", "Gan. Total", "% Margen"]
-    
-    for col_idx, header in enumerate(encabezados, start=1):
-        cell = ws.cell(row=start_row, column=col_idx, value=header)
-        cell.fill = PatternFill(start_color="27AE60", end_color="27AE60", fill_type="solid")
-        cell.font = Font(color="FFFFFF", bold=True)
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-    
-    row = start_row + 1
-    if resultados:
-        for idx, r in enumerate(resultados, start=1):
-            ganancia_tot = r['ganancia_total'] or 0
-            total_vend = r['total_vendido'] or 0
-            margen = (ganancia_tot / total_vend * 100) if total_vend > 0 else 0
-            
-            ws.cell(row=row, column=1, value=idx)
-            ws.cell(row=row, column=2, value=r['nombre'])
-            ws.cell(row=row, column=3, value=r['categoria'])
-            ws.cell(row=row, column=4, value=r['cantidad_vendida'])
-            
-            cell_total = ws.cell(row=row, column=5, value=total_vend)
-            cell_total.number_format = '"$"#,##0.00'
-            
-            cell_gan_unit = ws.cell(row=row, column=6, value=r['ganancia_unitaria_promedio'] or 0)
-            cell_gan_unit.number_format = '"$"#,##0.00'
-            
-            cell_gan_total = ws.cell(row=row, column=7, value=ganancia_tot)
-            cell_gan_total.number_format = '"$"#,##0.00'
-            cell_gan_total.font = Font(bold=True, color="27AE60")
-            
-            cell_margen = ws.cell(row=row, column=8, value=margen)
-            cell_margen.number_format = '0.0"%"'
-            
-            ws.cell(row=row, column=1).alignment = Alignment(horizontal="center")
-            ws.cell(row=row, column=4).alignment = Alignment(horizontal="center")
-            
-            if idx <= 3:
-                for col in range(1, 9):
-                    ws.cell(row=row, column=col).fill = PatternFill(
-                        start_color="FFF9E6", end_color="FFF9E6", fill_type="solid"
-                    )
-            
-            row += 1
-    
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
+        condiciones, params = filtros_logs_sql(fecha_desde, fecha_hasta, criterios['usuario'], criterios['accion'])
+        where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+        query = f"SELECT {', '.join(COLUMNAS_CSV_LOGS)} FROM logs{where} ORDER BY id"
+        filas = filas_csv(query, tuple(params), COLUMNAS_CSV_LOGS)
+
+    registrar_log('Exportación de logs', f"CSV {fecha_desde or 'inicio'} a {fecha_hasta or 'hoy'}")
+    return exportador.enviar_csv_gzip(
+        f"logs_{fecha_desde or 'inicio'}_{fecha_hasta or datetime.now().strftime('%Y-%m-%d')}.csv.gz",
+        COLUMNAS_CSV_LOGS,
+        filas
     )
-    
-    max_row = row - 1
-    for r in ws.iter_rows(min_row=start_row, max_row=max_row, min_col=1, max_col=8):
-        for cell in r:
-            cell.border = thin_border
-    
-    ws.column_dimensions['A'].width = 10
-    ws.column_dimensions['B'].width = 30
-    ws.column_dimensions['C'].width = 15
-    ws.column_dimensions['D'].width = 10
-    ws.column_dimensions['E'].width = 15
-    ws.column_dimensions['F'].width = 15
-    ws.column_dimensions['G'].width = 15
-    ws.column_dimensions['H'].width = 12
-    
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
+
+
+# ---------------------------------------------------------------------------------
+# EXPORTACIONES EN SEGUNDO PLANO
+# ---------------------------------------------------------------------------------
+COLUMNAS_VENTAS_DIARIAS = [
+    exportador.Columna("Fecha", 'centrado', formato='yyyy-mm-dd', ancho=12),
+    exportador.Columna("Ventas", 'entero', ancho=10),
+    exportador.Columna("Unidades", 'entero', ancho=10),
+    exportador.Columna("Ingresos", 'moneda', ancho=16, destacar=True),
+]
+
+
+def hojas_libro_contable(instantanea):
+    """
+    Hojas del libro contable, todas leídas de la misma instantánea. Cada hoja se
+    consulta justo antes de escribirse; los totales de IVA, rentabilidad y ventas
+    diarias salen de las filas ya leídas en lugar de consultas aparte.
+    """
+    totales = calcular_totales_inventario(instantanea.consultar_uno(CONSULTA_TOTALES_INVENTARIO))
+    yield {
+        'hoja': "Inventario", 'titulo': REPORTES_EXPORTABLES['inventario']['titulo'],
+        'columnas': COLUMNAS_INVENTARIO, 'color': REPORTES_EXPORTABLES['inventario']['color'],
+        'resumen': [
+            ("Total de Productos", totales['total_items']),
+            ("Total de Unidades", totales['total_unidades']),
+            ("Valor Total del Inventario", totales['valor_total'], 'moneda'),
+        ],
+        'filas': filas_inventario(instantanea.iterar(CONSULTA_FILAS_INVENTARIO)),
+    }
+
+    query, params, _ = consulta_iva()
+    iva = resumir_iva(instantanea.consultar(query, params))
+    yield {
+        'hoja': "IVA Mensual", 'titulo': REPORTES_EXPORTABLES['iva']['titulo'],
+        'columnas': COLUMNAS_IVA, 'color': REPORTES_EXPORTABLES['iva']['color'],
+        'resumen': [
+            ("Total Ventas Realizadas", iva['total_ventas']),
+            ("Total Vendido", iva['total_vendido'], 'moneda'),
+            ("IVA a Pagar", iva['total_iva'], 'moneda'),
+        ],
+        'filas': [
+            (r['anio'], r['mes_nombre'], r['num_ventas'], r['total_vendido'], r['iva_total'])
+            for r in iva['iva_por_mes']
+        ],
+    }
+
+    query, params = consulta_rentabilidad()
+    rentabilidad = resumir_rentabilidad(instantanea.consultar(query, params))
+    productos = rentabilidad['productos_rentables']
+    yield {
+        'hoja': "Rentabilidad", 'titulo': REPORTES_EXPORTABLES['rentabilidad']['titulo'],
+        'columnas': COLUMNAS_RENTABILIDAD, 'color': REPORTES_EXPORTABLES['rentabilidad']['color'],
+        'destacar_primeras': 3,
+        'resumen': [
+            ("Ganancia Total", rentabilidad['ganancia_total'], 'moneda'),
+            ("Productos Vendidos", len(productos)),
+            ("Unidades Vendidas", rentabilidad['unidades_vendidas']),
+        ],
+        'filas': [
+            (posicion, r['nombre'], r['categoria'], r['cantidad_vendida'], r['total_vendido'],
+             r['ganancia_unitaria_promedio'], r['ganancia_total'], r['margen_porcentaje'])
+            for posicion, r in enumerate(productos, start=1)
+        ],
+    }
+
+    dias = instantanea.consultar("""
+        SELECT fecha, SUM(num_ventas) as num_ventas, SUM(cantidad) as cantidad, SUM(ingresos) as ingresos
+        FROM resumen_ventas_diario
+        GROUP BY fecha
+        ORDER BY fecha
+    """)
+    filas_dias = [(d['fecha'], int(d['num_ventas'] or 0), int(d['cantidad'] or 0), float(d['ingresos'] or 0)) for d in dias]
+    ingresos = sum(f[3] for f in filas_dias)
+    yield {
+        'hoja': "Ventas Diarias", 'titulo': "Ventas por Día",
+        'columnas': COLUMNAS_VENTAS_DIARIAS, 'color': "2C3E50",
+        'resumen': [
+            ("Días con Ventas", len(filas_dias)),
+            ("Ingresos", ingresos, 'moneda'),
+            ("Promedio Diario", ingresos / len(filas_dias) if filas_dias else 0, 'moneda'),
+        ],
+        'filas': filas_dias,
+    }
+
+
+NUM_HOJAS_CONTABLE = 4
+
+
+def generar_libro_contable(ruta, progreso=None):
+    """
+    Libro contable de Excel con inventario, IVA mensual, rentabilidad por producto
+    y ventas diarias, en un solo libro en modo solo escritura y desde una sola
+    transacción con snapshot consistente.
+    """
+    def por_hoja(indice, nombre):
+        if progreso:
+            progreso(indice / NUM_HOJAS_CONTABLE, f"Escribiendo hoja {nombre}")
+
+    with instantanea_consistente() as instantanea:
+        exportador.escribir_libro(ruta, hojas_libro_contable(instantanea), por_hoja)
+
+
+# Un tipo por reporte y formato: inventario_excel, inventario_pdf, iva_csv, ...
+TIPOS_EXPORTACION = {
+    f"{reporte}_{formato}": {
+        'generar': generador_reporte(reporte, formato),
+        'nombre_descarga': f"{definicion['nombre_descarga']}{sufijo}",
+        'mimetype': mimetype, 'sufijo': sufijo,
+        'parametros': definicion['parametros'], 'tablas': definicion['tablas'],
+    }
+    for reporte, definicion in REPORTES_EXPORTABLES.items()
+    for formato, (_, mimetype, sufijo) in exportador.FORMATOS.items()
+}
+TIPOS_EXPORTACION['contable_excel'] = {
+    'generar': generar_libro_contable, 'nombre_descarga': "libro_contable.xlsx",
+    'mimetype': exportador.MIMETYPE_XLSX, 'sufijo': '.xlsx',
+    'parametros': (), 'tablas': ('productos', 'ventas', 'resumen_iva_mensual', 'resumen_ventas_diario'),
+}
+
+
+def generador_trabajo(tipo):
+    """Generador para el pool: toma el archivo de la caché (o lo genera) y lo deja en la ruta del trabajo"""
+    def generar(ruta, progreso, **parametros):
+        origen, etag, temporal = archivo_exportacion(tipo, parametros, progreso)
+        if temporal:
+            os.replace(origen, ruta)
+        else:
+            exportador.eliminar_archivo(ruta)
+            enlazar_o_copiar(origen, ruta)
+        return etag
+    return generar
+
+
+def registrar_tipos_exportacion():
+    for tipo, definicion in TIPOS_EXPORTACION.items():
+        gestor_exportaciones.registrar_tipo(
+            tipo, generador_trabajo(tipo), definicion['nombre_descarga'], definicion['mimetype'], definicion['sufijo']
+        )
+
+    planificador.registrar(
+        'limpiar_exportaciones', gestor_exportaciones.limpiar_vencidos,
+        intervalo=600,
+        descripcion='Borra las exportaciones vencidas del spool'
+    )
+
+
+registrar_tipos_exportacion()
+
+
+def estado_exportacion(trabajo):
+    datos = trabajo.a_dict()
+    datos['estado_url'] = url_for('estado_exportacion_trabajo', trabajo_id=trabajo.id)
+    if trabajo.estado == LISTO:
+        datos['descarga_url'] = url_for('descargar_exportacion', trabajo_id=trabajo.id)
+    return datos
+
+
+@app.route('/exportaciones/<tipo>', methods=['POST'])
+@login_required
+def crear_exportacion(tipo):
+    """Encola una exportación; los filtros llegan en la query string o en el formulario"""
+    if tipo not in TIPOS_EXPORTACION:
+        return jsonify({'success': False, 'error': 'Tipo de exportación no válido'}), 404
+
+    aceptados = TIPOS_EXPORTACION[tipo]['parametros']
+    parametros = {
+        nombre: (request.values.get(nombre) or '').strip()
+        for nombre in aceptados
+        if request.values.get(nombre)
+    }
+
+    try:
+        trabajo = gestor_exportaciones.enviar(tipo, session.get('user_id'), parametros)
+    except LimiteTrabajosExcedido as e:
+        return jsonify({'success': False, 'error': str(e)}), 429
+
+    registrar_log('Exportación solicitada', f"{tipo} {parametros or ''}".strip())
+    return jsonify({'success': True, **estado_exportacion(trabajo)}), 202
+
+
+@app.route('/exportaciones/<trabajo_id>')
+@login_required
+def estado_exportacion_trabajo(trabajo_id):
+    """Estado y progreso de una exportación del usuario"""
+    trabajo = gestor_exportaciones.obtener(trabajo_id, session.get('user_id'))
+    if not trabajo:
+        return jsonify({'success': False, 'error': 'Exportación no encontrada o vencida'}), 404
+    return jsonify({'success': True, **estado_exportacion(trabajo)})
+
+
+@app.route('/exportaciones/<trabajo_id>/ver')
+@login_required
+def ver_exportacion(trabajo_id):
+    """
+    Página del trabajo para las descargas sin JavaScript: se recarga sola (cabecera
+    Refresh) mientras el archivo se genera y muestra el enlace de descarga al terminar
+    """
+    trabajo = gestor_exportaciones.obtener(trabajo_id, session.get('user_id'))
+    if not trabajo:
+        flash("La exportación no está disponible (vencida o inexistente).", "error")
+        return redirect(url_for('dashboard'))
+
+    volver = request.args.get('volver', '')
+    if not volver.startswith('/') or volver.startswith('//'):
+        volver = url_for('dashboard')
+
+    respuesta = app.make_response(render_template(
+        'exportacion.html', trabajo=estado_exportacion(trabajo), activo=trabajo.activo, volver=volver
+    ))
+    if trabajo.activo:
+        respuesta.headers['Refresh'] = '2'
+    return respuesta
+
+
+@app.route('/exportaciones/<trabajo_id>/descargar')
+@login_required
+def descargar_exportacion(trabajo_id):
+    """Descarga el archivo de una exportación terminada (queda en el spool hasta que vence)"""
+    trabajo = gestor_exportaciones.obtener(trabajo_id, session.get('user_id'))
+    if not trabajo or trabajo.estado != LISTO or not os.path.exists(trabajo.ruta):
+        flash("La exportación no está disponible (vencida o sin terminar).", "error")
+        return redirect(url_for('dashboard'))
     return send_file(
-        output,
+        trabajo.ruta,
         as_attachment=True,
-        download_name="reporte_rentabilidad.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        download_name=trabajo.tipo.nombre_descarga,
+        mimetype=trabajo.tipo.mimetype,
+        conditional=True,
+        etag=trabajo.etag or True,
+        max_age=0
     )
 
+
+# ---------------------------------------------------------------------------------
+# MÉTRICAS
+# ---------------------------------------------------------------------------------
+@app.route('/admin/metricas')
+@login_required
+@role_required('admin')
+def metricas():
+    """Métricas internas en JSON (caché de reportes y versiones de datos)"""
+    return jsonify({
+        'cache_reportes': cache_reportes.metricas(),
+        'estado_usuarios': estado_usuarios.metricas(),
+        'contrasenas': hash_contrasenas.metricas(),
+        'login': limitador_login.metricas(),
+        'versiones_datos': versiones_datos.todas(),
+        'planificador': planificador.estado(),
+        'exportaciones': gestor_exportaciones.metricas(),
+        'importaciones': gestor_importaciones.metricas(),
+        'almacen_logs': almacen_logs.metricas() if almacen_logs else None,
+        'cache_archivos': cache_archivos.metricas()
+    })
+
+
+@app.route('/admin/planificador')
+@login_required
+@role_required('admin')
+def estado_planificador():
+    """Ejecuciones, duraciones y fallos del precálculo de reportes"""
+    return render_template('admin/planificador.html', estado=planificador.estado())
+
+
+@app.route('/admin/planificador/<nombre>/ejecutar', methods=['POST'])
+@login_required
+@role_required('admin')
+def ejecutar_tarea_planificador(nombre):
+    """Solicita ejecutar una tarea del planificador de inmediato"""
+    if planificador.solicitar(nombre):
+        registrar_log('Reporte precalculado manualmente', f"Tarea: {nombre}")
+        flash(f'Tarea "{nombre}" programada para ejecutarse ahora.', 'success')
+    else:
+        flash('Tarea no encontrada.', 'error')
+    return redirect(url_for('estado_planificador'))
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
@@ -2232,49 +4132,275 @@ def internal_server_error(e):
 
 
 @app.route("/cargar_excel")
+@login_required
+@role_required('admin', 'vendedor')
 def cargar_excel():
-    return render_template("cargar_excel.html")
+    importaciones = [estado_importacion(t) for t in gestor_importaciones.de_usuario(session.get('user_id'))[:5]]
+    return render_template("cargar_excel.html", importaciones=importaciones)
 
 
-import openpyxl
+def importar_lote_productos(lote):
+    """
+    Guarda un lote de productos normalizados con un solo upsert sobre codigo_sku.
+    Los SKU que ya existen se consultan antes para separar insertados de actualizados.
+    Devuelve (insertados, actualizados), o None si falla la base de datos.
+    """
+    skus = [p['codigo_sku'] for p in lote]
+    marcadores = ", ".join(["%s"] * len(skus))
+    existentes = ejecutar_query(
+        f"SELECT codigo_sku FROM productos WHERE codigo_sku IN ({marcadores})",
+        tuple(skus),
+        fetch_all=True
+    )
+    if existentes is None:
+        return None
+    existentes = {e['codigo_sku'].lower() for e in existentes}
+
+    if ejecutar_transaccion([importador.sentencia_upsert(lote)]) is None:
+        return None
+
+    actualizados = sum(1 for sku in skus if sku.lower() in existentes)
+    return len(skus) - actualizados, actualizados
+
+
+def generar_importacion_productos(ruta, progreso, archivo, nombre_archivo='', usuario=None):
+    """Trabajo del pool: importa el archivo subido (y lo borra al terminar)"""
+    def informar(resumen):
+        total = resumen.total if resumen.total is not None else '?'
+        progreso(resumen.fraccion, f"{resumen.procesadas} de {total} filas procesadas", **resumen.a_dict())
+
+    resumen = importador.ResumenImportacion()
+    try:
+        importador.importar(importador.leer_filas(archivo, resumen), importar_lote_productos, resumen, informar)
+    finally:
+        exportador.eliminar_archivo(archivo)
+        informar(resumen)
+
+    registrar_log(
+        'Productos importados',
+        f"Archivo: {nombre_archivo} - {resumen.insertados} nuevos, "
+        f"{resumen.actualizados} actualizados, {resumen.rechazados} rechazados",
+        usuario=usuario
+    )
+
+
+def generar_simulacion_productos(ruta, progreso, archivo, nombre_archivo='', usuario=None):
+    """
+    Trabajo del pool: compara el archivo subido con el catálogo sin escribir nada y
+    deja las diferencias en ruta (JSON por líneas) para aplicarlas después.
+    """
+    resumen = importador.ResumenSimulacion()
+
+    def informar(resumen):
+        total = resumen.total if resumen.total is not None else '?'
+        fraccion = resumen.leidas / resumen.total if resumen.total else 0
+        progreso(fraccion, f"{resumen.leidas} de {total} filas comparadas", **resumen.a_dict())
+
+    try:
+        esperado = ejecutar_query(
+            "SELECT COUNT(DISTINCT codigo_sku) as total FROM productos WHERE codigo_sku IS NOT NULL",
+            fetch_one=True
+        )
+        catalogo = importador.indice_catalogo(iterar_query(
+            f"SELECT codigo_sku, {', '.join(importador.CAMPOS_DIFERENCIA)} FROM productos WHERE codigo_sku IS NOT NULL"
+        ))
+        if esperado is None or len(catalogo) < esperado.get('total', 0):
+            raise RuntimeError("No se pudo leer el catálogo completo de productos")
+        resumen.catalogo = len(catalogo)
+
+        with open(ruta, 'w', encoding='utf-8') as salida:
+            importador.simular(importador.leer_filas(archivo, resumen), catalogo, salida, resumen, informar)
+    finally:
+        exportador.eliminar_archivo(archivo)
+        informar(resumen)
+
+    registrar_log(
+        'Importación simulada',
+        f"Archivo: {nombre_archivo} - {resumen.nuevos} nuevos, {resumen.cambiados} con cambios, "
+        f"{resumen.sin_cambios} sin cambios, {resumen.duplicados} duplicados, {resumen.rechazados} rechazados",
+        usuario=usuario
+    )
+
+
+def generar_aplicacion_simulacion(ruta, progreso, simulacion, tipos, excluir=(), total=None, usuario=None):
+    """Trabajo del pool: guarda los productos elegidos de una simulación terminada"""
+    resumen = importador.ResumenImportacion()
+    resumen.total = total
+
+    def informar(resumen):
+        progreso(resumen.fraccion, f"{resumen.procesadas} de {total or '?'} productos aplicados", **resumen.a_dict())
+
+    try:
+        entradas = importador.leer_diferencias(simulacion, tipos, excluir)
+        importador.aplicar_diferencias(entradas, importar_lote_productos, resumen, informar)
+    finally:
+        informar(resumen)
+
+    registrar_log(
+        'Importación aplicada',
+        f"{resumen.insertados} nuevos, {resumen.actualizados} actualizados, {resumen.rechazados} rechazados",
+        usuario=usuario
+    )
+
+
+def registrar_tipos_importacion():
+    gestor_importaciones.registrar_tipo('productos', generar_importacion_productos, None, None, '')
+    gestor_importaciones.registrar_tipo('simulacion', generar_simulacion_productos, None, None, '.jsonl')
+    gestor_importaciones.registrar_tipo('aplicar_simulacion', generar_aplicacion_simulacion, None, None, '')
+
+    planificador.registrar(
+        'limpiar_importaciones', gestor_importaciones.limpiar_vencidos,
+        intervalo=600,
+        descripcion='Borra las importaciones vencidas y los archivos subidos huérfanos'
+    )
+
+
+registrar_tipos_importacion()
+
+
+def estado_importacion(trabajo):
+    datos = trabajo.a_dict()
+    datos['estado_url'] = url_for('estado_importacion_trabajo', trabajo_id=trabajo.id)
+    if trabajo.tipo.nombre == 'simulacion' and trabajo.estado == LISTO:
+        datos['diferencias_url'] = url_for('diferencias_importacion', trabajo_id=trabajo.id)
+        datos['aplicar_url'] = url_for('aplicar_importacion', trabajo_id=trabajo.id)
+    return datos
+
+
+def simulacion_terminada(trabajo_id):
+    """La simulación del usuario si terminó y su archivo de diferencias sigue en el spool"""
+    trabajo = gestor_importaciones.obtener(trabajo_id, session.get('user_id'))
+    if (not trabajo or trabajo.tipo.nombre != 'simulacion' or trabajo.estado != LISTO
+            or not os.path.exists(trabajo.ruta)):
+        return None
+    return trabajo
+
 
 @app.route("/importar_excel", methods=["POST"])
+@login_required
+@role_required('admin', 'vendedor')
 def importar_excel():
-    if "excel_file" not in request.files:
-        flash("No se subió ningún archivo", "danger")
+    """
+    Guarda el .xlsx subido en el spool de importaciones y encola su importación.
+    Responde 202 con la URL de estado si se pide JSON; si no, vuelve a la página de carga.
+    """
+    quiere_json = request.accept_mimetypes.best == 'application/json'
+
+    def rechazar(mensaje, codigo):
+        if quiere_json:
+            return jsonify({'success': False, 'error': mensaje}), codigo
+        flash(mensaje, "danger")
         return redirect(url_for("cargar_excel"))
 
-    file = request.files["excel_file"]
+    archivo = request.files.get("excel_file")
+    if not archivo or not archivo.filename:
+        return rechazar("No se subió ningún archivo", 400)
 
-    upload_folder = "uploads"
-    os.makedirs(upload_folder, exist_ok=True)
-    filepath = os.path.join(upload_folder, "productos.xlsx")
+    if not archivo.filename.lower().endswith(('.xlsx', '.xlsm')):
+        return rechazar("El archivo debe ser un Excel .xlsx", 400)
 
-    file.save(filepath)
+    # Con "simular" solo se comparan las filas con el catálogo, sin guardar nada
+    tipo = 'simulacion' if request.form.get('simular') else 'productos'
+    if tipo == 'productos':
+        error = error_indice_sku()
+        if error:
+            return rechazar(error, 409)
 
-    import openpyxl
-    wb = openpyxl.load_workbook(filepath)
-    sheet = wb.active
+    ruta = os.path.join(gestor_importaciones.directorio, f"subida_{os.urandom(8).hex()}.xlsx")
+    archivo.save(ruta)
 
-    # Recorrer las filas desde la segunda (saltando encabezados)
-    for row in sheet.iter_rows(min_row=2, values_only=True):
-        codigo_sku, nombre, categoria, marca, stock, precio_unitario, descripcion = row
+    parametros = {'archivo': ruta, 'nombre_archivo': archivo.filename, 'usuario': session.get('username')}
+    try:
+        trabajo = gestor_importaciones.enviar(tipo, session.get('user_id'), parametros)
+    except LimiteTrabajosExcedido as e:
+        exportador.eliminar_archivo(ruta)
+        return rechazar(str(e), 429)
 
-        # Ignorar filas vacías
-        if not codigo_sku or not nombre:
-            continue
+    registrar_log('Importación solicitada', f"Archivo: {archivo.filename}{' (simulación)' if tipo == 'simulacion' else ''}")
+    if quiere_json:
+        return jsonify({'success': True, **estado_importacion(trabajo)}), 202
 
-        query = """
-            INSERT INTO productos (codigo_sku, nombre, categoria, marca, stock, precio_unitario, descripcion)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """
+    flash("Importación en curso. El avance se muestra abajo.", "info")
+    return redirect(url_for("cargar_excel"))
 
-        params = (codigo_sku, nombre, categoria, marca, stock, precio_unitario, descripcion)
 
-        ejecutar_query(query, params, commit=True)
+@app.route('/importaciones/<trabajo_id>')
+@login_required
+def estado_importacion_trabajo(trabajo_id):
+    """Estado y progreso de una importación del usuario (filas leídas, escritas, rechazadas y ETA)"""
+    trabajo = gestor_importaciones.obtener(trabajo_id, session.get('user_id'))
+    if not trabajo:
+        return jsonify({'success': False, 'error': 'Importación no encontrada o vencida'}), 404
+    return jsonify({'success': True, **estado_importacion(trabajo)})
+
+
+@app.route('/importaciones/<trabajo_id>/diferencias')
+@login_required
+@role_required('admin', 'vendedor')
+def diferencias_importacion(trabajo_id):
+    """Página de diferencias de una simulación: ?tipo=nuevo|cambiado|duplicado|rechazado&desde=0&limite=100"""
+    trabajo = simulacion_terminada(trabajo_id)
+    if not trabajo:
+        return jsonify({'success': False, 'error': 'Simulación no encontrada, sin terminar o vencida'}), 404
+
+    tipo = request.args.get('tipo', '')
+    try:
+        desde = max(int(request.args.get('desde', 0)), 0)
+        limite = min(max(int(request.args.get('limite', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'desde y limite deben ser números'}), 400
+
+    entradas = importador.leer_diferencias(trabajo.ruta, (tipo,) if tipo else None)
+    pagina = list(islice(entradas, desde, desde + limite + 1))
+    return jsonify({
+        'success': True,
+        'tipo': tipo or None,
+        'desde': desde,
+        'entradas': pagina[:limite],
+        'hay_mas': len(pagina) > limite
+    })
+
+
+@app.route('/importaciones/<trabajo_id>/aplicar', methods=['POST'])
+@login_required
+@role_required('admin', 'vendedor')
+def aplicar_importacion(trabajo_id):
+    """
+    Encola la aplicación de una simulación: los tipos elegidos (nuevo, cambiado)
+    menos las filas excluidas. Recibe JSON {"tipos": [...], "excluir": [filas]}.
+    """
+    trabajo = simulacion_terminada(trabajo_id)
+    if not trabajo:
+        return jsonify({'success': False, 'error': 'Simulación no encontrada, sin terminar o vencida'}), 404
+
+    datos = request.get_json(silent=True) or {}
+    tipos = [t for t in datos.get('tipos', importador.TIPOS_APLICABLES) if t in importador.TIPOS_APLICABLES]
+    if not tipos:
+        return jsonify({'success': False, 'error': 'Elige qué cambios aplicar (nuevos o cambiados)'}), 400
+    try:
+        excluir = [int(f) for f in datos.get('excluir', [])]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Las filas excluidas deben ser números'}), 400
+
+    error = error_indice_sku()
+    if error:
+        return jsonify({'success': False, 'error': error}), 409
+
+    conteos = {importador.NUEVO: 'nuevos', importador.CAMBIADO: 'cambiados'}
+    total = max(sum(trabajo.detalle.get(conteos[t], 0) for t in tipos) - len(excluir), 0)
+    parametros = {
+        'simulacion': trabajo.ruta, 'tipos': tipos, 'excluir': excluir,
+        'total': total, 'usuario': session.get('username')
+    }
+    try:
+        aplicacion = gestor_importaciones.enviar('aplicar_simulacion', session.get('user_id'), parametros)
+    except LimiteTrabajosExcedido as e:
+        return jsonify({'success': False, 'error': str(e)}), 429
+
+    registrar_log('Importación solicitada', f"Aplicar simulación {trabajo.id[:8]}: {', '.join(tipos)}")
+    return jsonify({'success': True, **estado_importacion(aplicacion)}), 202
+
 
-    flash("Productos importados correctamente desde Excel", "success")
-    return redirect(url_for("cargar_excel"))
 # ---------------------------------------------------------------------------------
 # RUN
 # ---------------------------------------------------------------------------------
@@ -0,0 +1,93 @@
+"""
+Benchmark del motor de analítica: ciclo por fila (versión anterior de
+reporte_ventas_periodo) contra el cálculo vectorizado de analitica.py.
+
+Uso:
+python benchmarks/bench_analitica.py --ventas 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import analitica
+
+
+def generar_lotes(num_ventas, tamano_lote=5000, semilla=7):
+    """Genera ventas sintéticas en lotes, como las entrega iterar_query"""
+    rnd = random.Random(semilla)
+    fechas = [date(2022, 1, 1) + timedelta(days=d) for d in range(3 * 365)]
+    lote = []
+    for i in range(num_ventas):
+        cantidad = rnd.randint(1, 10)
+        lote.append({
+            'fecha': rnd.choice(fechas),
+            'cantidad': cantidad,
+            'total': round(cantidad * rnd.uniform(5000, 400000), 3),
+        })
+        if len(lote) == tamano_lote:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def periodo_por_fila(ventas):
+    """Implementación anterior: diccionarios por día y por mes"""
+    ventas_diarias = defaultdict(lambda: {'cantidad': 0, 'ingresos': 0, 'num_ventas': 0})
+    ventas_mensuales = defaultdict(lambda: {'cantidad': 0, 'ingresos': 0, 'num_ventas': 0})
+
+    for v in ventas:
+        fecha_str = v['fecha'].strftime("%Y-%m-%d")
+
+        ventas_diarias[fecha_str]['cantidad'] += v.get('cantidad', 0)
+        ventas_diarias[fecha_str]['ingresos'] += v.get('total', 0)
+        ventas_diarias[fecha_str]['num_ventas'] += 1
+
+        mes = fecha_str[:7]
+        ventas_mensuales[mes]['cantidad'] += v.get('cantidad', 0)
+        ventas_mensuales[mes]['ingresos'] += v.get('total', 0)
+        ventas_mensuales[mes]['num_ventas'] += 1
+
+    por_dia = sorted([{'fecha': k, **v} for k, v in ventas_diarias.items()], key=lambda x: x['fecha'], reverse=True)
+    por_mes = sorted([{'mes': k, **v} for k, v in ventas_mensuales.items()], key=lambda x: x['mes'], reverse=True)
+    return por_dia, por_mes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ventas', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(f"Generando {args.ventas:,} ventas sintéticas...")
+    ventas = [v for lote in generar_lotes(args.ventas) for v in lote]
+
+    inicio = time.perf_counter()
+    por_dia_a, por_mes_a = periodo_por_fila(ventas)
+    t_fila = time.perf_counter() - inicio
+    print(f"Ciclo por fila:        {t_fila:8.3f} s")
+
+    inicio = time.perf_counter()
+    frame = analitica.cargar_ventas(generar_lotes(args.ventas))
+    t_carga = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    por_dia_b, por_mes_b = analitica.ventas_por_periodo(frame)
+    t_vector = time.perf_counter() - inicio
+    print(f"Carga columnar:        {t_carga:8.3f} s  (incluye generar los lotes)")
+    print(f"Agregación vectorial:  {t_vector:8.3f} s")
+    print(f"Aceleración del cálculo: {t_fila / t_vector:6.1f}x")
+
+    assert len(por_dia_a) == len(por_dia_b) and len(por_mes_a) == len(por_mes_b)
+    assert por_mes_a[0]['num_ventas'] == por_mes_b[0]['num_ventas']
+    assert abs(por_mes_a[0]['ingresos'] - por_mes_b[0]['ingresos']) < 1e-3 * por_mes_a[0]['ingresos']
+
+
+if __name__ == "__main__":
+    main()
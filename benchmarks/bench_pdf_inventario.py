@@ -0,0 +1,118 @@
+"""
+Benchmark del PDF de inventario: una sola Table con todas las filas
+(versión anterior de exportar_pdf_inventario) contra las tablas de
+tamaño fijo por página de exportador.escribir_pdf.
+
+Uso:
+python benchmarks/bench_pdf_inventario.py --productos 1000 5000 10000 25000 50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import exportador
+
+ENCABEZADOS = ["ID", "Producto", "Categoría", "Cantidad", "Precio Unitario", "Valor Total"]
+ANCHOS = [40, 240, 120, 60, 90, 100]
+CATEGORIAS = ["Frenos", "Motor", "Transmisión", "Eléctrico", "Suspensión", "Lujos"]
+
+
+def generar_productos(num_productos, semilla=7):
+    """Productos sintéticos con la forma de las filas de iterar_query"""
+    rnd = random.Random(semilla)
+    for i in range(1, num_productos + 1):
+        stock = rnd.randint(0, 200)
+        precio = round(rnd.uniform(5000, 400000), 2)
+        yield (i, f"Repuesto {i:06d}", rnd.choice(CATEGORIAS), stock, precio, round(stock * precio, 2))
+
+
+def moneda(valor):
+    return f"${valor:,.2f}"
+
+
+def pdf_una_tabla(ruta, num_productos):
+    """Implementación anterior: todas las filas en una Table y doc.build"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+
+    doc = SimpleDocTemplate(ruta, pagesize=landscape(A4),
+                            rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
+    data = [ENCABEZADOS]
+    for p in generar_productos(num_productos):
+        data.append([p[0], p[1], p[2], str(p[3]), moneda(p[4]), moneda(p[5])])
+
+    table = Table(data, colWidths=ANCHOS, repeatRows=1, hAlign='CENTER')
+    table.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1F4E78")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, 0), 10),
+        ("BOTTOMPADDING", (0, 0), (-1, 0), 8),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("BACKGROUND", (0, 1), (-1, -1), colors.whitesmoke),
+    ]))
+    doc.build([table])
+
+
+COLUMNAS = [
+    exportador.Columna("ID", 'centrado', ancho=6),
+    exportador.Columna("Producto", ancho=36),
+    exportador.Columna("Categoría", ancho=18),
+    exportador.Columna("Cantidad", 'entero', ancho=9, total=True),
+    exportador.Columna("Precio Unitario", 'moneda', ancho=14),
+    exportador.Columna("Valor Total", 'moneda', ancho=15, total=True),
+]
+
+
+def pdf_por_paginas(ruta, num_productos):
+    exportador.escribir_pdf(
+        ruta,
+        titulo="Reporte de Inventario Total - Motorrepuestos H&D",
+        columnas=COLUMNAS,
+        filas=generar_productos(num_productos),
+        resumen=[("Total de Productos", num_productos)]
+    )
+
+
+def medir(funcion, num_productos, memoria):
+    ruta = exportador.archivo_temporal('.pdf')
+    try:
+        if memoria:
+            tracemalloc.start()
+        inicio = time.perf_counter()
+        funcion(ruta, num_productos)
+        duracion = time.perf_counter() - inicio
+        pico = tracemalloc.get_traced_memory()[1] / 1e6 if memoria else None
+        if memoria:
+            tracemalloc.stop()
+        return duracion, pico
+    finally:
+        exportador.eliminar_archivo(ruta)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--productos', type=int, nargs='+', default=[1000, 5000, 10000, 25000, 50000])
+    parser.add_argument('--max-anterior', type=int, default=10000,
+                        help="tamaño máximo para medir la versión anterior (es muy lenta)")
+    parser.add_argument('--memoria', action='store_true', help="medir pico de memoria (más lento)")
+    args = parser.parse_args()
+
+    print(f"{'Productos':>10} | {'Una tabla':>12} | {'Por páginas':>12} | {'ms / 1k filas':>13} | {'Pico MB':>8}")
+    for n in args.productos:
+        anterior = f"{medir(pdf_una_tabla, n, False)[0]:10.2f} s" if n <= args.max_anterior else f"{'-':>12}"
+        duracion, pico = medir(pdf_por_paginas, n, args.memoria)
+        pico_texto = f"{pico:8.1f}" if pico is not None else f"{'-':>8}"
+        print(f"{n:>10,} | {anterior} | {duracion:10.2f} s | {duracion / n * 1e6:13.1f} | {pico_texto}")
+
+
+if __name__ == "__main__":
+    main()
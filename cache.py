@@ -0,0 +1,336 @@
+"""
+Caché de resultados del Sistema de Inventario H&D.
+
+- VersionesDatos: contador de versión por tabla; cada escritura en MySQL hecha
+  por este proceso lo incrementa, así las entradas calculadas con datos viejos
+  dejan de coincidir.
+- CacheReportes: caché LRU acotada (por número de entradas y por bytes) para
+  los resultados de los reportes, con métricas de aciertos y fallos.
+- CacheArchivos: caché LRU en disco para los archivos exportados (Excel, PDF),
+  direccionada por contenido: la clave sale del tipo, los filtros y la versión
+  de los datos, y sirve también como ETag.
+- CacheTTL: caché pequeña cuyas entradas vencen a los pocos segundos, para
+  datos que cambian poco pero deben reflejarse pronto (rol y estado de usuarios).
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: un archivo abierto no se puede borrar, eso alcanza como candado
+    fcntl = None
+
+PREFIJO_PROCESO = 'proceso-'
+ARCHIVO_CANDADO = '.en_uso'
+
+
+class VersionesDatos:
+    """
+    Contador de versión por tabla, compartido por todo el proceso. Vive en memoria:
+    una escritura hecha por otro proceso no lo incrementa, así que las cachés que
+    dependen de él sirven para un solo proceso (un solo worker de la aplicación).
+    """
+
+    def __init__(self):
+        self._versiones = defaultdict(int)
+        self._suscriptores = []
+        self._lock = threading.Lock()
+
+    def incrementar(self, tabla):
+        with self._lock:
+            self._versiones[tabla] += 1
+            version = self._versiones[tabla]
+        for callback in list(self._suscriptores):
+            try:
+                callback(tabla, version)
+            except Exception as e:
+                print(f"❌ Error notificando cambio en {tabla}: {e}")
+        return version
+
+    def actual(self, *tablas):
+        with self._lock:
+            return tuple(self._versiones[t] for t in tablas)
+
+    def suscribir(self, callback):
+        """Registra callback(tabla, version) que se llama en cada escritura"""
+        self._suscriptores.append(callback)
+
+    def todas(self):
+        with self._lock:
+            return dict(self._versiones)
+
+
+def normalizar_parametros(parametros):
+    """Clave estable para un dict de filtros: ignora vacíos y el orden de las claves"""
+    return tuple(sorted(
+        (k, str(v).strip()) for k, v in (parametros or {}).items()
+        if v is not None and str(v).strip() != ''
+    ))
+
+
+class CacheReportes:
+    """Caché LRU de resultados de reportes con memoria acotada"""
+
+    def __init__(self, max_entradas=128, max_bytes=32 * 1024 * 1024):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def guardar(self, clave, valor):
+        try:
+            tamano = len(pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return
+        if tamano > self.max_bytes:
+            return
+
+        with self._lock:
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self._bytes -= anterior[1]
+
+            self._entradas[clave] = (valor, tamano)
+            self._bytes += tamano
+
+            while self._entradas and (len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes):
+                _, (_, tamano_viejo) = self._entradas.popitem(last=False)
+                self._bytes -= tamano_viejo
+                self.desalojos += 1
+
+    def obtener_o_calcular(self, nombre, parametros, version, calcular, guardar_si=None):
+        """
+        Devuelve el resultado en caché para (nombre, parámetros, versión de datos)
+        o lo calcula y lo guarda. Si guardar_si() devuelve False tras calcular (p. ej.
+        falló una consulta) el resultado se entrega sin guardarlo. El resultado se
+        comparte: no debe modificarse.
+        """
+        clave = (nombre, normalizar_parametros(parametros), version)
+        valor = self.obtener(clave)
+        if valor is None:
+            valor = calcular()
+            if guardar_si is None or guardar_si():
+                self.guardar(clave, valor)
+        return valor
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._bytes = 0
+
+    def metricas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._entradas),
+                'max_entradas': self.max_entradas,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'desalojos': self.desalojos,
+                'tasa_aciertos': round(self.aciertos / consultas, 4) if consultas else 0,
+            }
+
+
+class CacheTTL:
+    """Caché en memoria con vencimiento por tiempo; al llenarse se quitan las entradas más viejas"""
+
+    def __init__(self, ttl=60, max_entradas=1024):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None or entrada[1] < time.monotonic():
+                self._entradas.pop(clave, None)
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            return entrada[0]
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            self._entradas.pop(clave, None)
+            self._entradas[clave] = (valor, time.monotonic() + self.ttl)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def obtener_o_calcular(self, clave, calcular):
+        """Valor vigente para la clave o el resultado de calcular() (None no se guarda)"""
+        valor = self.obtener(clave)
+        if valor is None:
+            valor = calcular()
+            if valor is not None:
+                self.guardar(clave, valor)
+        return valor
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+    def metricas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._entradas),
+                'ttl': self.ttl,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / consultas, 4) if consultas else 0,
+            }
+
+
+def enlazar_o_copiar(origen, destino):
+    """Hard link si ambos archivos están en el mismo disco; si no, copia"""
+    try:
+        os.link(origen, destino)
+    except OSError:
+        shutil.copyfile(origen, destino)
+
+
+def carpeta_abandonada(carpeta):
+    """True si el proceso dueño de la subcarpeta de caché ya no está corriendo"""
+    ruta = os.path.join(carpeta, ARCHIVO_CANDADO)
+    if fcntl is None:
+        try:
+            os.remove(ruta)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+
+    try:
+        with open(ruta, 'a') as candado:
+            fcntl.flock(candado.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+    except OSError:
+        return False
+
+
+class CacheArchivos:
+    """Caché LRU de archivos generados, acotada en bytes, guardada en una carpeta"""
+
+    def __init__(self, directorio, max_bytes=256 * 1024 * 1024):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+
+        # Las versiones de datos viven en memoria y empiezan de cero en cada proceso:
+        # la clave incluye un identificador del proceso y cada proceso guarda sus
+        # archivos en su propia subcarpeta. Al iniciar solo se borran las subcarpetas
+        # de procesos que ya terminaron (nadie tiene su candado); el resto de la
+        # carpeta no se toca.
+        self._proceso = uuid.uuid4().hex
+        self.carpeta = os.path.join(directorio, f"{PREFIJO_PROCESO}{self._proceso}")
+        os.makedirs(self.carpeta, exist_ok=True)
+        self._candado = open(os.path.join(self.carpeta, ARCHIVO_CANDADO), 'w')
+        if fcntl:
+            fcntl.flock(self._candado.fileno(), fcntl.LOCK_SH)
+        self._borrar_abandonadas()
+
+    def _borrar_abandonadas(self):
+        for nombre in os.listdir(self.directorio):
+            carpeta = os.path.join(self.directorio, nombre)
+            if not nombre.startswith(PREFIJO_PROCESO) or carpeta == self.carpeta or not os.path.isdir(carpeta):
+                continue
+            # Una carpeta recién creada puede ser de un proceso que todavía no tomó su candado
+            if time.time() - os.path.getmtime(carpeta) > 60 and carpeta_abandonada(carpeta):
+                shutil.rmtree(carpeta, ignore_errors=True)
+
+    def clave(self, tipo, parametros, version):
+        """Hash estable de (tipo, filtros normalizados, versión de datos) dentro de este proceso"""
+        texto = repr((self._proceso, tipo, normalizar_parametros(parametros), tuple(version)))
+        return hashlib.sha256(texto.encode('utf-8')).hexdigest()[:32]
+
+    def obtener(self, clave):
+        """Ruta del archivo en caché o None"""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None or not os.path.exists(entrada[0]):
+                if entrada is not None:
+                    self._bytes -= self._entradas.pop(clave)[1]
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def guardar(self, clave, origen, sufijo=''):
+        """
+        Agrega a la caché una copia (hard link) del archivo generado y devuelve
+        su ruta; None si el archivo es más grande que toda la caché.
+        """
+        tamano = os.path.getsize(origen)
+        if tamano > self.max_bytes:
+            return None
+
+        destino = os.path.join(self.carpeta, f"{clave}{sufijo}")
+        temporal = f"{destino}.{threading.get_ident()}.tmp"
+        enlazar_o_copiar(origen, temporal)
+        os.replace(temporal, destino)
+
+        with self._lock:
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self._bytes -= anterior[1]
+            self._entradas[clave] = (destino, tamano)
+            self._bytes += tamano
+            self._desalojar()
+        return destino
+
+    def _desalojar(self):
+        while self._entradas and self._bytes > self.max_bytes:
+            _, (ruta, tamano) = self._entradas.popitem(last=False)
+            self._bytes -= tamano
+            self.desalojos += 1
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    def metricas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'archivos': len(self._entradas),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'desalojos': self.desalojos,
+                'tasa_aciertos': round(self.aciertos / consultas, 4) if consultas else 0,
+            }
@@ -0,0 +1,457 @@
+"""
+Exportación de reportes por partes del Sistema de Inventario H&D.
+
+Todos los reportes tabulares se describen con una lista de Columna (encabezado,
+tipo, formato numérico, ancho sugerido) y un iterador de filas, y se escriben
+en Excel, PDF o CSV con el mismo motor. Los archivos se escriben en disco fila
+por fila, así la memoria del proceso no crece con el número de filas del
+reporte.
+"""
+
+import csv
+import io
+import os
+import tempfile
+import zlib
+from itertools import chain, islice
+
+from flask import Response
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+from openpyxl.utils import get_column_letter
+
+
+FILAS_BLOQUE_CSV = 2000
+FILAS_MUESTRA_ANCHOS = 500
+FILAS_PROGRESO = 1000
+
+MIMETYPE_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+COLOR_PREDETERMINADO = "1F4E78"
+
+
+# ---------------------------------------------------------------------------------
+# ARCHIVOS TEMPORALES Y ENVÍO POR PARTES
+# ---------------------------------------------------------------------------------
+def archivo_temporal(sufijo):
+    """Ruta de un archivo temporal vacío para escribir un reporte"""
+    descriptor, ruta = tempfile.mkstemp(prefix='reporte_', suffix=sufijo)
+    os.close(descriptor)
+    return ruta
+
+
+def eliminar_archivo(ruta):
+    try:
+        os.remove(ruta)
+    except OSError:
+        pass
+
+
+def csv_gzip_por_partes(encabezados, filas, filas_por_bloque=FILAS_BLOQUE_CSV):
+    """
+    Genera un CSV comprimido con gzip en bloques: cada filas_por_bloque filas el
+    texto acumulado se pasa al compresor y se entrega lo que haya producido.
+    En memoria solo vive un bloque de filas y el estado del compresor.
+    """
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+
+    def vaciar():
+        datos = compresor.compress(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+        return datos
+
+    # BOM para que Excel reconozca las tildes al abrir el CSV descomprimido
+    buffer.write('\ufeff')
+    escritor.writerow(encabezados)
+    for numero, fila in enumerate(filas, start=1):
+        escritor.writerow(fila)
+        if numero % filas_por_bloque == 0:
+            datos = vaciar()
+            if datos:
+                yield datos
+
+    yield vaciar() + compresor.flush()
+
+
+def enviar_csv_gzip(nombre_descarga, encabezados, filas):
+    """Respuesta que comprime y envía el CSV a medida que se leen las filas (sin Content-Length)"""
+    return Response(
+        csv_gzip_por_partes(encabezados, filas),
+        mimetype='application/gzip',
+        direct_passthrough=True,
+        headers={'Content-Disposition': f'attachment; filename="{nombre_descarga}"'}
+    )
+
+
+# ---------------------------------------------------------------------------------
+# COLUMNAS
+# ---------------------------------------------------------------------------------
+def _texto(valor):
+    return '' if valor is None else str(valor)
+
+
+def _moneda(valor):
+    return '' if valor is None else f"${valor:,.2f}"
+
+
+def _porcentaje(valor):
+    return '' if valor is None else f"{valor:.1f}%"
+
+
+# tipo: (alineación horizontal en Excel, formato numérico en Excel, texto en PDF)
+TIPOS_COLUMNA = {
+    'texto': (None, None, _texto),
+    'centrado': ("center", None, _texto),
+    'entero': ("center", '0', _texto),
+    'moneda': (None, '"$"#,##0.00', _moneda),
+    'porcentaje': ("center", '0.0"%"', _porcentaje),
+}
+
+
+class Columna:
+    """
+    Una columna de un reporte tabular.
+
+    - tipo: una de TIPOS_COLUMNA; define alineación, formato numérico y texto en PDF.
+    - formato: formato numérico de Excel que reemplaza el del tipo.
+    - ancho: ancho sugerido en caracteres; si falta se calcula con las primeras filas.
+    - total: en el PDF se imprime su subtotal por página y el acumulado.
+    - destacar: valor en negrita con el color del reporte.
+    """
+
+    def __init__(self, encabezado, tipo='texto', formato=None, ancho=None, total=False, destacar=False):
+        if tipo not in TIPOS_COLUMNA:
+            raise ValueError(f"Tipo de columna desconocido: {tipo}")
+        self.encabezado = encabezado
+        self.tipo = tipo
+        self.alineacion, formato_tipo, self.a_texto = TIPOS_COLUMNA[tipo]
+        self.formato = formato or formato_tipo
+        self.ancho = ancho
+        self.total = total
+        self.destacar = destacar
+
+
+def _resumen_con_tipo(resumen):
+    """Normaliza el resumen a (etiqueta, valor, tipo); el tipo es opcional en cada cuadro"""
+    return [(r[0], r[1], r[2] if len(r) > 2 else 'centrado') for r in resumen]
+
+
+# ---------------------------------------------------------------------------------
+# EXCEL EN MODO SOLO ESCRITURA
+# ---------------------------------------------------------------------------------
+def registrar_estilos(wb, columnas, resumen=(), color=COLOR_PREDETERMINADO, destacar_filas=False, prefijo=''):
+    """
+    Crea una sola vez por hoja los estilos con nombre que usan todas sus celdas:
+    título, resumen, encabezado y uno por columna (más su variante de fila
+    destacada si se pide). En un libro de varias hojas cada una usa su prefijo.
+    Devuelve los nombres de estilo de cada columna.
+    """
+    borde = Border(left=Side(style='thin'), right=Side(style='thin'),
+                   top=Side(style='thin'), bottom=Side(style='thin'))
+    fondo_color = PatternFill(start_color=color, end_color=color, fill_type="solid")
+    fondo_resumen = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
+    fondo_destacado = PatternFill(start_color="FFF9E6", end_color="FFF9E6", fill_type="solid")
+
+    estilos = [
+        NamedStyle(name=f'{prefijo}titulo', font=Font(size=14, bold=True, color="FFFFFF"), fill=fondo_color,
+                   alignment=Alignment(horizontal="center", vertical="center")),
+        NamedStyle(name=f'{prefijo}resumen_etiqueta', font=Font(bold=True), fill=fondo_resumen,
+                   alignment=Alignment(horizontal="center")),
+        NamedStyle(name=f'{prefijo}encabezado', font=Font(color="FFFFFF", bold=True), border=borde, fill=fondo_color,
+                   alignment=Alignment(horizontal="center", vertical="center")),
+    ]
+    for tipo in sorted({t for _, _, t in _resumen_con_tipo(resumen)}):
+        estilos.append(NamedStyle(name=f'{prefijo}resumen_{tipo}', fill=fondo_resumen,
+                                  number_format=TIPOS_COLUMNA[tipo][1] or 'General',
+                                  alignment=Alignment(horizontal="center")))
+
+    nombres = []
+    for i, columna in enumerate(columnas):
+        base = dict(border=borde, number_format=columna.formato or 'General',
+                    alignment=Alignment(horizontal=columna.alineacion))
+        if columna.destacar:
+            base['font'] = Font(bold=True, color=color)
+        nombre = f'{prefijo}columna_{i}'
+        estilos.append(NamedStyle(name=nombre, **base))
+        if destacar_filas:
+            estilos.append(NamedStyle(name=f'{nombre}_destacada', fill=fondo_destacado, **base))
+        nombres.append(nombre)
+
+    for estilo in estilos:
+        wb.add_named_style(estilo)
+    return nombres
+
+
+def _celda(ws, valor=None, estilo=None):
+    celda = WriteOnlyCell(ws, value=valor)
+    if estilo:
+        celda.style = estilo
+    return celda
+
+
+def anchos_columnas(columnas, filas, minimo=10, maximo=60):
+    """
+    Ancho de cada columna: el sugerido en la Columna o, si no hay, el del texto más
+    largo del encabezado y de las filas dadas.
+    """
+    anchos = [len(str(c.encabezado)) for c in columnas]
+    for fila in filas:
+        for i, valor in enumerate(fila):
+            if valor is not None:
+                anchos[i] = max(anchos[i], len(str(valor)))
+    return [
+        c.ancho if c.ancho else min(max(a + 2, minimo), maximo)
+        for c, a in zip(columnas, anchos)
+    ]
+
+
+def escribir_hoja(wb, hoja, titulo, columnas, filas, resumen=(), color=COLOR_PREDETERMINADO,
+                  destacar_primeras=0, progreso=None, prefijo=''):
+    """
+    Agrega a un libro en modo solo escritura una hoja con título, cuadros de
+    resumen, encabezados y filas.
+
+    - columnas: lista de Columna.
+    - filas: iterable de tuplas; se consume una sola vez y nunca se guarda completo.
+    - resumen: lista de (etiqueta, valor[, tipo]); cada cuadro ocupa dos columnas.
+    - destacar_primeras: cuántas filas iniciales llevan fondo resaltado (p. ej. un top 3).
+    - progreso: función opcional que recibe el número de filas escritas cada FILAS_PROGRESO.
+
+    En modo solo escritura los anchos deben fijarse antes de la primera fila, así que
+    los que no vienen en la Columna se calculan con las primeras FILAS_MUESTRA_ANCHOS
+    filas. Cada fila se vuelca al archivo temporal de la hoja en cuanto se agrega.
+    Devuelve el número de filas escritas.
+    """
+    resumen = _resumen_con_tipo(resumen)
+    estilos = registrar_estilos(wb, columnas, resumen, color, destacar_primeras > 0, prefijo)
+    ws = wb.create_sheet(hoja)
+
+    filas = iter(filas)
+    muestra = list(islice(filas, FILAS_MUESTRA_ANCHOS))
+    for i, ancho in enumerate(anchos_columnas(columnas, muestra), start=1):
+        ws.column_dimensions[get_column_letter(i)].width = ancho
+
+    ultima = get_column_letter(len(columnas))
+    ws.merged_cells.add(f"A1:{ultima}1")
+    ws.row_dimensions[1].height = 30
+    ws.append([_celda(ws, titulo, f'{prefijo}titulo')])
+
+    etiquetas, valores = [], []
+    for i, (etiqueta, valor, tipo) in enumerate(resumen):
+        inicio, fin = get_column_letter(2 * i + 1), get_column_letter(2 * i + 2)
+        ws.merged_cells.add(f"{inicio}2:{fin}2")
+        ws.merged_cells.add(f"{inicio}3:{fin}3")
+        etiqueta_estilo, valor_estilo = f'{prefijo}resumen_etiqueta', f'{prefijo}resumen_{tipo}'
+        etiquetas += [_celda(ws, etiqueta, etiqueta_estilo), _celda(ws, None, etiqueta_estilo)]
+        valores += [_celda(ws, valor, valor_estilo), _celda(ws, None, valor_estilo)]
+    ws.append(etiquetas)
+    ws.append(valores)
+    ws.append([])
+
+    ws.append([_celda(ws, c.encabezado, f'{prefijo}encabezado') for c in columnas])
+
+    # Una celda reutilizable por columna: el estilo se asigna una sola vez
+    celdas = [_celda(ws, None, estilo) for estilo in estilos]
+    if destacar_primeras:
+        destacadas = [_celda(ws, None, f"{estilo}_destacada") for estilo in estilos]
+
+    escritas = 0
+    for fila in chain(muestra, filas):
+        fila_celdas = destacadas if escritas < destacar_primeras else celdas
+        for celda, valor in zip(fila_celdas, fila):
+            celda.value = valor
+        ws.append(fila_celdas)
+        escritas += 1
+        if progreso and escritas % FILAS_PROGRESO == 0:
+            progreso(escritas)
+
+    return escritas
+
+
+def escribir_excel(ruta, titulo, columnas, filas, hoja="Reporte", **opciones):
+    """Escribe un libro de una sola hoja (ver escribir_hoja). Devuelve el número de filas escritas."""
+    wb = Workbook(write_only=True)
+    escritas = escribir_hoja(wb, hoja, titulo, columnas, filas, **opciones)
+    wb.save(ruta)
+    return escritas
+
+
+def escribir_libro(ruta, hojas, progreso=None):
+    """
+    Escribe un libro con varias hojas. hojas es un iterable de dicts con los
+    argumentos de escribir_hoja (hoja, titulo, columnas, filas, ...); se consume
+    de a una, así cada hoja puede consultar sus datos justo antes de escribirse.
+    progreso(indice, nombre_hoja) se llama al empezar cada hoja.
+    Devuelve {nombre_hoja: filas escritas}.
+    """
+    wb = Workbook(write_only=True)
+    escritas = {}
+    for indice, hoja in enumerate(hojas):
+        if progreso:
+            progreso(indice, hoja['hoja'])
+        escritas[hoja['hoja']] = escribir_hoja(wb, prefijo=f"h{indice}_", **hoja)
+    wb.save(ruta)
+    return escritas
+
+
+# ---------------------------------------------------------------------------------
+# PDF POR PÁGINAS
+# ---------------------------------------------------------------------------------
+MARGEN_PDF = 20
+ALTO_FILA_PDF = 16
+ALTO_ENCABEZADO_PDF = 20
+ALTO_PIE_PDF = 24
+ALTO_TITULO_PDF = 110
+PUNTOS_POR_CARACTER_PDF = 6.6
+
+
+def escribir_pdf(ruta, titulo, columnas, filas, resumen=(), color=COLOR_PREDETERMINADO, progreso=None, **_):
+    """
+    Escribe un PDF horizontal con una tabla que se corta en bloques de tamaño fijo,
+    uno por página, dibujados directamente sobre el canvas.
+
+    - columnas: lista de Columna; el ancho sugerido (en caracteres) se pasa a
+      puntos y se reduce en proporción si no cabe en la página. Las columnas con
+      total=True imprimen en el pie su subtotal de la página y el acumulado.
+    - filas: iterable de tuplas con los valores crudos; se consume bloque a bloque.
+    - resumen: lista de (etiqueta, valor[, tipo]) que va en la primera página bajo el título.
+    - progreso: función opcional que recibe el número de filas escritas tras cada página.
+
+    Cada página arma una Table pequeña con el mismo TableStyle precalculado, así
+    el costo por página es constante y el tiempo total crece en forma lineal.
+    Devuelve el número de filas escritas.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfgen import canvas
+    from reportlab.platypus import Table, TableStyle
+
+    ancho_pagina, alto_pagina = landscape(A4)
+    encabezados = [c.encabezado for c in columnas]
+    formatos = [c.a_texto for c in columnas]
+    columnas_total = [i for i, c in enumerate(columnas) if c.total]
+
+    anchos = [(c.ancho or 12) * PUNTOS_POR_CARACTER_PDF for c in columnas]
+    ancho_util = ancho_pagina - 2 * MARGEN_PDF
+    if sum(anchos) > ancho_util:
+        anchos = [a * ancho_util / sum(anchos) for a in anchos]
+    x_tabla = (ancho_pagina - sum(anchos)) / 2
+
+    estilo_tabla = TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor(f"#{color}")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, 0), 10),
+        ("FONTSIZE", (0, 1), (-1, -1), 8),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("BACKGROUND", (0, 1), (-1, -1), colors.whitesmoke),
+    ] + [
+        ("FONTNAME", (i, 1), (i, -1), "Helvetica-Bold") for i, c in enumerate(columnas) if c.destacar
+    ])
+    estilo_resumen = TableStyle([
+        ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#f0f0f0")),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"),
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+    ])
+    filas_resumen = [[e, TIPOS_COLUMNA[t][2](v)] for e, v, t in _resumen_con_tipo(resumen)]
+
+    alto_util = alto_pagina - 2 * MARGEN_PDF - ALTO_PIE_PDF - ALTO_ENCABEZADO_PDF
+    filas_primera = int((alto_util - ALTO_TITULO_PDF) // ALTO_FILA_PDF)
+    filas_por_pagina = int(alto_util // ALTO_FILA_PDF)
+
+    c = canvas.Canvas(ruta, pagesize=(ancho_pagina, alto_pagina), pageCompression=1)
+    c.setTitle(titulo)
+
+    filas = iter(filas)
+    acumulados = {i: 0 for i in columnas_total}
+    escritas = 0
+    pagina = 1
+
+    while True:
+        bloque = list(islice(filas, filas_primera if pagina == 1 else filas_por_pagina))
+        if not bloque and pagina > 1:
+            break
+
+        y = alto_pagina - MARGEN_PDF
+        if pagina == 1:
+            c.setFont("Helvetica-Bold", 18)
+            c.drawCentredString(ancho_pagina / 2, y - 18, titulo)
+            if filas_resumen:
+                tabla_resumen = Table(filas_resumen, colWidths=[200, 120])
+                tabla_resumen.setStyle(estilo_resumen)
+                _, alto = tabla_resumen.wrapOn(c, ancho_pagina, alto_pagina)
+                tabla_resumen.drawOn(c, (ancho_pagina - 320) / 2, y - 36 - alto)
+            y -= ALTO_TITULO_PDF
+        else:
+            c.setFont("Helvetica", 9)
+            c.drawString(MARGEN_PDF, y - 9, titulo)
+            y -= 14
+
+        datos = [encabezados] + [[f(v) for f, v in zip(formatos, fila)] for fila in bloque]
+        tabla = Table(datos, colWidths=anchos,
+                      rowHeights=[ALTO_ENCABEZADO_PDF] + [ALTO_FILA_PDF] * len(bloque))
+        tabla.setStyle(estilo_tabla)
+        _, alto = tabla.wrapOn(c, ancho_pagina, alto_pagina)
+        tabla.drawOn(c, x_tabla, y - alto)
+
+        pie = [f"Página {pagina}", f"Filas {escritas + 1 if bloque else 0}–{escritas + len(bloque)}"]
+        for i in columnas_total:
+            subtotal = sum(fila[i] or 0 for fila in bloque)
+            acumulados[i] += subtotal
+            pie.append(f"{encabezados[i]}: {formatos[i](subtotal)} (acumulado {formatos[i](acumulados[i])})")
+        c.setFont("Helvetica", 8)
+        c.drawString(MARGEN_PDF, MARGEN_PDF, "   |   ".join(pie))
+
+        escritas += len(bloque)
+        c.showPage()
+        if progreso:
+            progreso(escritas)
+        pagina += 1
+
+    c.save()
+    return escritas
+
+
+# ---------------------------------------------------------------------------------
+# CSV
+# ---------------------------------------------------------------------------------
+def escribir_csv(ruta, titulo, columnas, filas, progreso=None, **_):
+    """
+    Escribe los encabezados y las filas en CSV con valores crudos (sin símbolo de
+    moneda). UTF-8 con BOM para que Excel reconozca las tildes. Devuelve el número
+    de filas escritas.
+    """
+    escritas = 0
+    with open(ruta, 'w', newline='', encoding='utf-8-sig') as archivo:
+        escritor = csv.writer(archivo)
+        escritor.writerow([c.encabezado for c in columnas])
+        for fila in filas:
+            escritor.writerow(fila)
+            escritas += 1
+            if progreso and escritas % FILAS_PROGRESO == 0:
+                progreso(escritas)
+    return escritas
+
+
+# formato: (función, mimetype, sufijo)
+FORMATOS = {
+    'excel': (escribir_excel, MIMETYPE_XLSX, '.xlsx'),
+    'pdf': (escribir_pdf, "application/pdf", '.pdf'),
+    'csv': (escribir_csv, "text/csv", '.csv'),
+}
+
+
+def escribir_tabla(ruta, formato, titulo, columnas, filas, **opciones):
+    """
+    Escribe un reporte tabular en el formato pedido ('excel', 'pdf' o 'csv').
+    Las opciones que un formato no usa (hoja, color, resumen, destacar_primeras)
+    se ignoran.
+    """
+    escribir = FORMATOS[formato][0]
+    return escribir(ruta, titulo, columnas, filas, **opciones)
@@ -0,0 +1,474 @@
+"""
+Importación de productos desde Excel del Sistema de Inventario H&D.
+
+El archivo se lee con openpyxl en modo solo lectura, las filas se validan y
+normalizan en lotes y cada lote se guarda con un solo INSERT ... ON DUPLICATE
+KEY UPDATE sobre codigo_sku. La lectura y la escritura corren en hilos
+distintos unidos por una cola acotada, así se solapan sin acumular el archivo
+en memoria.
+
+La simulación compara el archivo con el catálogo actual (un índice por
+codigo_sku en memoria) en una sola pasada y deja las diferencias en un
+archivo JSON por líneas, para aplicar después solo los cambios elegidos.
+"""
+
+import json
+import queue
+import threading
+import time
+from itertools import islice
+
+import openpyxl
+
+
+COLUMNAS = ('codigo_sku', 'nombre', 'categoria', 'marca', 'stock', 'precio_unitario', 'descripcion')
+
+# Nombres de encabezado aceptados (en minúsculas, sin tildes) para cada columna
+ENCABEZADOS = {
+    'codigo_sku': 'codigo_sku', 'sku': 'codigo_sku', 'codigo': 'codigo_sku', 'codigo sku': 'codigo_sku',
+    'nombre': 'nombre', 'producto': 'nombre',
+    'categoria': 'categoria',
+    'marca': 'marca',
+    'stock': 'stock', 'cantidad': 'stock', 'unidades': 'stock',
+    'precio_unitario': 'precio_unitario', 'precio unitario': 'precio_unitario', 'precio': 'precio_unitario',
+    'descripcion': 'descripcion',
+}
+
+TAMANO_LOTE = 500
+LOTES_EN_COLA = 4
+REINTENTOS_LOTE = 3
+ESPERA_REINTENTO = 0.5
+IVA = 0.19
+MAX_RECHAZOS_DETALLE = 100
+
+# Clasificación de cada fila en la simulación
+NUEVO = 'nuevo'
+CAMBIADO = 'cambiado'
+SIN_CAMBIOS = 'sin_cambios'
+DUPLICADO = 'duplicado'
+RECHAZADO = 'rechazado'
+TIPOS_APLICABLES = (NUEVO, CAMBIADO)
+
+# Campos que sobrescribe el upsert y que se comparan contra el catálogo
+CAMPOS_DIFERENCIA = ('nombre', 'precio_unitario', 'stock', 'categoria', 'marca', 'descripcion')
+
+
+class ResumenImportacion:
+    """
+    Conteo de filas de una importación. total es una estimación tomada de las
+    dimensiones de la hoja; leidas avanza con la lectura y procesadas con la
+    escritura (incluye rechazadas, vacías y repetidas).
+    """
+
+    def __init__(self):
+        self.total = None
+        self.leidas = 0
+        self.procesadas = 0
+        self.insertados = 0
+        self.actualizados = 0
+        self.vacias = 0
+        self.rechazados = 0
+        self.reintentos = 0
+        self.detalle_rechazos = []
+        self._lock = threading.Lock()
+
+    def rechazar(self, fila, motivo):
+        with self._lock:
+            self.rechazados += 1
+            if len(self.detalle_rechazos) < MAX_RECHAZOS_DETALLE:
+                self.detalle_rechazos.append({'fila': fila, 'motivo': motivo})
+
+    @property
+    def escritas(self):
+        return self.insertados + self.actualizados
+
+    @property
+    def fraccion(self):
+        if not self.total:
+            return 0.0
+        return min(self.procesadas / self.total, 1.0)
+
+    def a_dict(self):
+        with self._lock:
+            detalle_rechazos = list(self.detalle_rechazos)
+        return {
+            'total': self.total,
+            'leidas': self.leidas,
+            'procesadas': self.procesadas,
+            'escritas': self.escritas,
+            'reintentos': self.reintentos,
+            'insertados': self.insertados,
+            'actualizados': self.actualizados,
+            'rechazados': self.rechazados,
+            'vacias': self.vacias,
+            'detalle_rechazos': detalle_rechazos,
+        }
+
+
+class ResumenSimulacion(ResumenImportacion):
+    """Conteo de una simulación: filas nuevas, con cambios, sin cambios y duplicadas"""
+
+    def __init__(self):
+        super().__init__()
+        self.nuevos = 0
+        self.cambiados = 0
+        self.sin_cambios = 0
+        self.duplicados = 0
+        self.catalogo = 0
+
+    def a_dict(self):
+        datos = super().a_dict()
+        datos.update({
+            'simulacion': True,
+            'catalogo': self.catalogo,
+            'nuevos': self.nuevos,
+            'cambiados': self.cambiados,
+            'sin_cambios': self.sin_cambios,
+            'duplicados': self.duplicados,
+        })
+        return datos
+
+
+def _sin_tildes(texto):
+    return texto.translate(str.maketrans('áéíóúÁÉÍÓÚ', 'aeiouAEIOU'))
+
+
+def mapear_encabezados(encabezado):
+    """
+    Posición de cada columna según la fila de encabezados. Si no se reconocen
+    nombre y SKU se usa el orden fijo de COLUMNAS.
+    """
+    posiciones = {}
+    for indice, valor in enumerate(encabezado or ()):
+        if valor is None:
+            continue
+        columna = ENCABEZADOS.get(_sin_tildes(str(valor).strip().lower()))
+        if columna and columna not in posiciones:
+            posiciones[columna] = indice
+
+    if 'codigo_sku' in posiciones and 'nombre' in posiciones:
+        return posiciones
+    return {columna: indice for indice, columna in enumerate(COLUMNAS)}
+
+
+def leer_filas(archivo, resumen=None):
+    """
+    Genera (número de fila, dict de valores crudos) desde un archivo o stream .xlsx.
+    La primera fila se toma como encabezado. Si se pasa un resumen, se anota el
+    total de filas estimado según las dimensiones de la hoja.
+    """
+    wb = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        hoja = wb.active
+        if resumen is not None and hoja.max_row:
+            resumen.total = max(hoja.max_row - 1, 0)
+        filas = hoja.iter_rows(values_only=True)
+        posiciones = mapear_encabezados(next(filas, None))
+        for numero, valores in enumerate(filas, start=2):
+            yield numero, {
+                columna: valores[indice] if indice < len(valores) else None
+                for columna, indice in posiciones.items()
+            }
+    finally:
+        wb.close()
+
+
+def _texto(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+
+def normalizar_fila(crudo):
+    """
+    Valida y normaliza una fila. Devuelve (producto, None), (None, motivo) si se
+    rechaza, o (None, None) si la fila está vacía.
+    """
+    if all(_texto(v) == '' for v in crudo.values()):
+        return None, None
+
+    codigo_sku = _texto(crudo.get('codigo_sku'))
+    nombre = _texto(crudo.get('nombre'))
+    if not codigo_sku:
+        return None, 'Falta el código SKU'
+    if not nombre:
+        return None, 'Falta el nombre'
+
+    try:
+        stock_texto = _texto(crudo.get('stock')) or '0'
+        stock = int(float(stock_texto))
+        if stock != float(stock_texto):
+            return None, f"Stock no entero: {stock_texto}"
+    except ValueError:
+        return None, f"Stock inválido: {crudo.get('stock')}"
+
+    try:
+        precio_unitario = round(float(_texto(crudo.get('precio_unitario')).replace('$', '').replace(',', '')), 3)
+    except ValueError:
+        return None, f"Precio inválido: {crudo.get('precio_unitario')}"
+
+    if stock < 0 or precio_unitario < 0:
+        return None, 'El stock y el precio no pueden ser negativos'
+
+    precio_con_iva = round(precio_unitario * (1 + IVA), 3)
+    return {
+        'codigo_sku': codigo_sku,
+        'nombre': nombre,
+        'categoria': _texto(crudo.get('categoria')) or 'Sin categoría',
+        'marca': _texto(crudo.get('marca')),
+        'stock': stock,
+        'precio_unitario': precio_unitario,
+        'descripcion': _texto(crudo.get('descripcion')),
+        'valor_total': round(precio_con_iva * stock, 3),
+    }, None
+
+
+def lotes_validos(filas, resumen, tamano_lote=TAMANO_LOTE):
+    """
+    Agrupa cada bloque de tamano_lote filas en (productos válidos, filas del
+    bloque) y anota rechazos y vacías; la lista puede quedar vacía. Igual que en
+    simular, si un SKU se repite en el archivo (sin distinguir mayúsculas, como
+    la collation de MySQL) vale la primera fila y las demás quedan rechazadas.
+    """
+    vistos = {}
+    filas = iter(filas)
+    while True:
+        bloque = list(islice(filas, tamano_lote))
+        if not bloque:
+            return
+        resumen.leidas += len(bloque)
+
+        lote = []
+        for numero, crudo in bloque:
+            producto, motivo = normalizar_fila(crudo)
+            if not producto:
+                if motivo:
+                    resumen.rechazar(numero, motivo)
+                else:
+                    resumen.vacias += 1
+                continue
+
+            clave = producto['codigo_sku'].lower()
+            if clave in vistos:
+                resumen.rechazar(numero, f"SKU repetido, ya aparece en la fila {vistos[clave]}")
+                continue
+            vistos[clave] = numero
+            producto['fila'] = numero
+            lote.append(producto)
+
+        yield lote, len(bloque)
+
+
+CAMPOS_UPSERT = ('codigo_sku', 'nombre', 'categoria', 'marca', 'stock', 'precio_unitario', 'descripcion', 'valor_total')
+
+
+def sentencia_upsert(lote):
+    """INSERT de varias filas que actualiza el producto cuando el SKU ya existe"""
+    marcadores = "(" + ", ".join(["%s"] * len(CAMPOS_UPSERT)) + ")"
+    actualizar = ", ".join(f"{c} = VALUES({c})" for c in CAMPOS_UPSERT if c != 'codigo_sku')
+    query = f"""
+        INSERT INTO productos ({", ".join(CAMPOS_UPSERT)})
+        VALUES {", ".join([marcadores] * len(lote))}
+        ON DUPLICATE KEY UPDATE {actualizar}, fecha_actualizacion = NOW()
+    """
+    params = tuple(p[c] for p in lote for c in CAMPOS_UPSERT)
+    return query, params
+
+
+def escribir_lote(lote, guardar_lote, resumen, reintentos=REINTENTOS_LOTE, espera=ESPERA_REINTENTO):
+    """
+    Guarda un lote con guardar_lote(lote) -> (insertados, actualizados), o None si
+    falla. Cada lote es su propia transacción, así que un reintento solo repite
+    este lote y nunca los que ya se confirmaron. Si se agotan los reintentos,
+    sus filas quedan como rechazadas.
+    """
+    for intento in range(reintentos + 1):
+        resultado = guardar_lote(lote)
+        if resultado is not None:
+            insertados, actualizados = resultado
+            resumen.insertados += insertados
+            resumen.actualizados += actualizados
+            return True
+        if intento < reintentos:
+            resumen.reintentos += 1
+            time.sleep(espera * 2 ** intento)
+
+    for producto in lote:
+        resumen.rechazar(producto['fila'], f"SKU {producto['codigo_sku']}: error al guardar en la base de datos")
+    return False
+
+
+def importar(filas, guardar_lote, resumen, progreso=None, tamano_lote=TAMANO_LOTE,
+             reintentos=REINTENTOS_LOTE, espera=ESPERA_REINTENTO):
+    """
+    Importa las filas en dos etapas que se solapan: un hilo lee y valida los
+    lotes y los deja en una cola de LOTES_EN_COLA, y el hilo actual los escribe.
+    progreso(resumen) se llama desde ambas etapas después de cada lote.
+    Un error de lectura se vuelve a lanzar cuando la escritura termina con lo leído.
+    """
+    cola = queue.Queue(maxsize=LOTES_EN_COLA)
+    detener = threading.Event()
+    errores = []
+
+    def encolar(elemento):
+        while not detener.is_set():
+            try:
+                cola.put(elemento, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def leer():
+        try:
+            for lote, num_filas in lotes_validos(filas, resumen, tamano_lote):
+                if not encolar((lote, num_filas)):
+                    return
+                if progreso:
+                    progreso(resumen)
+        except Exception as e:
+            errores.append(e)
+        finally:
+            if hasattr(filas, 'close'):
+                filas.close()
+            encolar(None)
+
+    lector = threading.Thread(target=leer, name='importacion-lectura', daemon=True)
+    lector.start()
+    try:
+        while True:
+            elemento = cola.get()
+            if elemento is None:
+                break
+            lote, num_filas = elemento
+            if lote:
+                escribir_lote(lote, guardar_lote, resumen, reintentos, espera)
+            resumen.procesadas += num_filas
+            if progreso:
+                progreso(resumen)
+    finally:
+        detener.set()
+        lector.join()
+
+    if errores:
+        raise errores[0]
+    return resumen
+
+
+# ---------------------------------------------------------------------------------
+# SIMULACIÓN (DIFERENCIAS CONTRA EL CATÁLOGO)
+# ---------------------------------------------------------------------------------
+def _valor_comparable(campo, valor):
+    if campo == 'precio_unitario':
+        return round(float(valor or 0), 3)
+    if campo == 'stock':
+        return int(valor or 0)
+    return _texto(valor)
+
+
+def indice_catalogo(lotes):
+    """
+    Índice del catálogo por codigo_sku en minúsculas (como compara MySQL) con
+    los valores de CAMPOS_DIFERENCIA ya normalizados; lotes viene de iterar_query.
+    """
+    indice = {}
+    for lote in lotes:
+        for producto in lote:
+            sku = _texto(producto.get('codigo_sku'))
+            if sku:
+                indice[sku.lower()] = tuple(_valor_comparable(c, producto.get(c)) for c in CAMPOS_DIFERENCIA)
+    return indice
+
+
+def _escribir_entrada(salida, tipo, fila, producto=None, cambios=None, motivo=None):
+    entrada = {'tipo': tipo, 'fila': fila}
+    if producto is not None:
+        entrada['producto'] = producto
+    if cambios:
+        entrada['cambios'] = cambios
+    if motivo:
+        entrada['motivo'] = motivo
+    salida.write(json.dumps(entrada, ensure_ascii=False))
+    salida.write('\n')
+
+
+def simular(filas, catalogo, salida, resumen, progreso=None, cada=1000):
+    """
+    Compara cada fila con el índice del catálogo en una sola pasada y escribe en
+    salida (JSON por líneas) las filas nuevas, cambiadas (con el antes y después
+    de cada campo), duplicadas y rechazadas. Las filas sin cambios solo se cuentan.
+    Si un SKU se repite en el archivo vale la primera fila; las demás son duplicadas.
+    """
+    vistos = {}
+    for numero, crudo in filas:
+        resumen.leidas += 1
+        if progreso and resumen.leidas % cada == 0:
+            progreso(resumen)
+
+        producto, motivo = normalizar_fila(crudo)
+        if not producto:
+            if motivo:
+                resumen.rechazar(numero, motivo)
+                _escribir_entrada(salida, RECHAZADO, numero, motivo=motivo)
+            else:
+                resumen.vacias += 1
+            continue
+
+        producto['fila'] = numero
+        clave = producto['codigo_sku'].lower()
+        if clave in vistos:
+            resumen.duplicados += 1
+            _escribir_entrada(salida, DUPLICADO, numero, producto,
+                              motivo=f"SKU repetido, ya aparece en la fila {vistos[clave]}")
+            continue
+        vistos[clave] = numero
+
+        actual = catalogo.get(clave)
+        if actual is None:
+            resumen.nuevos += 1
+            _escribir_entrada(salida, NUEVO, numero, producto)
+            continue
+
+        cambios = {
+            campo: [antes, producto[campo]]
+            for campo, antes in zip(CAMPOS_DIFERENCIA, actual)
+            if antes != _valor_comparable(campo, producto[campo])
+        }
+        if cambios:
+            resumen.cambiados += 1
+            _escribir_entrada(salida, CAMBIADO, numero, producto, cambios)
+        else:
+            resumen.sin_cambios += 1
+
+    resumen.procesadas = resumen.leidas
+    return resumen
+
+
+def leer_diferencias(ruta, tipos=None, excluir=()):
+    """Genera las entradas de un archivo de simulación, filtradas por tipo y sin las filas excluidas"""
+    excluir = set(excluir)
+    with open(ruta, encoding='utf-8') as archivo:
+        for linea in archivo:
+            entrada = json.loads(linea)
+            if tipos and entrada['tipo'] not in tipos:
+                continue
+            if entrada['fila'] in excluir:
+                continue
+            yield entrada
+
+
+def aplicar_diferencias(entradas, guardar_lote, resumen, progreso=None, tamano_lote=TAMANO_LOTE):
+    """Guarda en lotes los productos de las entradas elegidas de una simulación"""
+    entradas = iter(entradas)
+    while True:
+        lote = [e['producto'] for e in islice(entradas, tamano_lote)]
+        if not lote:
+            break
+        resumen.leidas += len(lote)
+        escribir_lote(lote, guardar_lote, resumen)
+        resumen.procesadas += len(lote)
+        if progreso:
+            progreso(resumen)
+    return resumen
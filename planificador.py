@@ -0,0 +1,170 @@
+"""
+Planificador de reportes del Sistema de Inventario H&D.
+
+Hilo en segundo plano (sin servicios externos) que precalcula reportes cada
+cierto intervalo o después de N cambios en las tablas que observa, y guarda el
+resultado como snapshot para que las rutas lo sirvan de inmediato.
+"""
+
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+from cache import normalizar_parametros
+
+
+class Tarea:
+    """Reporte a precalcular: función, juegos de parámetros y disparadores"""
+
+    def __init__(self, nombre, calcular, parametros=None, intervalo=900,
+                 tablas=(), umbral_cambios=None, descripcion=''):
+        self.nombre = nombre
+        self.calcular = calcular
+        self.parametros = parametros or (lambda: [{}])
+        self.intervalo = intervalo
+        self.tablas = tuple(tablas)
+        self.umbral_cambios = umbral_cambios
+        self.descripcion = descripcion
+
+        self.cambios_pendientes = 0
+        self.forzar = False
+        self.ultima_ejecucion = None
+        self.ultima_duracion = None
+        self.ultimo_error = None
+        self.ejecuciones = 0
+        self.fallos = 0
+
+    def pendiente(self, ahora):
+        if self.forzar or self.ultima_ejecucion is None:
+            return True
+        if self.intervalo and ahora - self.ultima_ejecucion >= self.intervalo:
+            return True
+        return bool(self.umbral_cambios) and self.cambios_pendientes >= self.umbral_cambios
+
+
+class PlanificadorReportes:
+    """Ejecuta las tareas registradas en un hilo daemon y guarda sus snapshots"""
+
+    def __init__(self, intervalo_revision=5, max_historial=200):
+        self.intervalo_revision = intervalo_revision
+        self._tareas = {}
+        self._snapshots = {}
+        self._historial = deque(maxlen=max_historial)
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    # ----------------------------------------------------------------- registro
+    def registrar(self, nombre, calcular, **opciones):
+        self._tareas[nombre] = Tarea(nombre, calcular, **opciones)
+
+    def notificar_cambio(self, tabla):
+        """Se llama en cada escritura; cuenta cambios para las tareas que observan la tabla"""
+        despertar = False
+        with self._lock:
+            for tarea in self._tareas.values():
+                if tabla in tarea.tablas:
+                    tarea.cambios_pendientes += 1
+                    if tarea.umbral_cambios and tarea.cambios_pendientes >= tarea.umbral_cambios:
+                        despertar = True
+        if despertar:
+            self._despertar.set()
+
+    def solicitar(self, nombre):
+        """Pide ejecutar una tarea en la próxima vuelta del hilo"""
+        tarea = self._tareas.get(nombre)
+        if not tarea:
+            return False
+        tarea.forzar = True
+        self._despertar.set()
+        return True
+
+    # ---------------------------------------------------------------- snapshots
+    def snapshot(self, nombre, parametros=None):
+        """Devuelve (datos, edad_en_segundos) o None si no hay snapshot"""
+        with self._lock:
+            entrada = self._snapshots.get((nombre, normalizar_parametros(parametros)))
+        if entrada is None:
+            return None
+        datos, generado_en = entrada
+        return datos, time.time() - generado_en
+
+    # ---------------------------------------------------------------- ejecución
+    def ejecutar(self, tarea):
+        inicio = time.time()
+        tarea.forzar = False
+        with self._lock:
+            cambios_al_iniciar = tarea.cambios_pendientes
+
+        try:
+            resultados = [(p, tarea.calcular(**p)) for p in tarea.parametros()]
+            with self._lock:
+                for parametros, datos in resultados:
+                    self._snapshots[(tarea.nombre, normalizar_parametros(parametros))] = (datos, time.time())
+                tarea.cambios_pendientes -= cambios_al_iniciar
+            tarea.ultimo_error = None
+            resultado = 'ok'
+        except Exception as e:
+            tarea.fallos += 1
+            tarea.ultimo_error = f"{type(e).__name__}: {e}"
+            resultado = 'error'
+            traceback.print_exc()
+
+        duracion = time.time() - inicio
+        tarea.ultima_ejecucion = inicio
+        tarea.ultima_duracion = duracion
+        tarea.ejecuciones += 1
+        self._historial.appendleft({
+            'tarea': tarea.nombre,
+            'inicio': datetime.fromtimestamp(inicio).strftime('%Y-%m-%d %H:%M:%S'),
+            'duracion': round(duracion, 3),
+            'resultado': resultado,
+            'error': tarea.ultimo_error,
+        })
+
+    def _ciclo(self):
+        while not self._detener.is_set():
+            ahora = time.time()
+            for tarea in list(self._tareas.values()):
+                if self._detener.is_set():
+                    break
+                if tarea.pendiente(ahora):
+                    self.ejecutar(tarea)
+            self._despertar.wait(self.intervalo_revision)
+            self._despertar.clear()
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._ciclo, name='planificador-reportes', daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._despertar.set()
+
+    # ------------------------------------------------------------------- estado
+    def activo(self):
+        return bool(self._hilo and self._hilo.is_alive())
+
+    def estado(self):
+        ahora = time.time()
+        tareas = []
+        for tarea in self._tareas.values():
+            tareas.append({
+                'nombre': tarea.nombre,
+                'descripcion': tarea.descripcion,
+                'intervalo': tarea.intervalo,
+                'umbral_cambios': tarea.umbral_cambios,
+                'cambios_pendientes': tarea.cambios_pendientes,
+                'ejecuciones': tarea.ejecuciones,
+                'fallos': tarea.fallos,
+                'ultima_duracion': round(tarea.ultima_duracion, 3) if tarea.ultima_duracion is not None else None,
+                'edad': ahora - tarea.ultima_ejecucion if tarea.ultima_ejecucion else None,
+                'ultimo_error': tarea.ultimo_error,
+            })
+        return {'activo': self.activo(), 'tareas': tareas, 'historial': list(self._historial)}
@@ -0,0 +1,244 @@
+"""
+Seguridad del Sistema de Inventario H&D: hash de contraseñas.
+
+El hash (scrypt o PBKDF2 de Werkzeug) es deliberadamente caro. HashContrasenas
+lo ejecuta en un pool de hilos acotado: hashlib suelta el GIL mientras calcula,
+así que los demás hilos siguen atendiendo, y como mucho max_hilos hashes corren
+a la vez aunque llegue una ráfaga de inicios de sesión. Si la cola se llena se
+rechaza el pedido en lugar de acumular espera. El método y el costo son
+configurables; los hashes guardados con otros parámetros se recalculan en
+segundo plano tras el siguiente inicio de sesión correcto. Se mide cuánto tarda
+cada operación para poder ajustar el costo.
+
+LimitadorIntentos frena los intentos de inicio de sesión por IP y por usuario
+(token bucket en memoria) antes de consultar la base o calcular un hash, y
+acumula los fallos para registrarlos resumidos.
+"""
+
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as EsperaAgotada
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashSaturado(Exception):
+    """Hay demasiados hashes en curso o en cola"""
+
+
+class MedicionTiempos:
+    """Cantidad, promedio y percentiles de las últimas duraciones registradas"""
+
+    def __init__(self, muestras=512):
+        self._duraciones = deque(maxlen=muestras)
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def registrar(self, segundos):
+        with self._lock:
+            self._duraciones.append(segundos)
+            self.total += 1
+
+    def resumen(self):
+        with self._lock:
+            duraciones = sorted(self._duraciones)
+            total = self.total
+        if not duraciones:
+            return {'total': total, 'promedio_ms': None, 'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+
+        def percentil(p):
+            return round(duraciones[min(len(duraciones) - 1, int(p * len(duraciones)))] * 1000, 1)
+
+        return {
+            'total': total,
+            'promedio_ms': round(sum(duraciones) / len(duraciones) * 1000, 1),
+            'p50_ms': percentil(0.5),
+            'p95_ms': percentil(0.95),
+            'max_ms': round(duraciones[-1] * 1000, 1),
+        }
+
+
+class HashContrasenas:
+    """Genera y verifica hashes de contraseñas en un pool de hilos acotado"""
+
+    def __init__(self, metodo='scrypt:32768:8:1', max_hilos=2, max_en_cola=32, espera_maxima=30):
+        self.metodo = metodo
+        self.max_hilos = max_hilos
+        self.max_en_cola = max_en_cola
+        self.espera_maxima = espera_maxima
+        self._pool = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix='hash')
+        self._cupos = threading.BoundedSemaphore(max_hilos + max_en_cola)
+        self.tiempos = {'generar': MedicionTiempos(), 'verificar': MedicionTiempos()}
+        self.rechazados = 0
+        self.rehashes = 0
+        # Werkzeug completa los parámetros que falten (p. ej. las iteraciones de
+        # pbkdf2): el prefijo real sale de un hash de prueba, no del texto configurado
+        self.prefijo = generate_password_hash('', metodo).split('$', 1)[0]
+
+    def _ejecutar(self, operacion, funcion, *args):
+        if not self._cupos.acquire(blocking=False):
+            self.rechazados += 1
+            raise HashSaturado("Demasiadas contraseñas en proceso")
+
+        def medir():
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args)
+            finally:
+                self.tiempos[operacion].registrar(time.perf_counter() - inicio)
+                self._cupos.release()
+
+        return self._pool.submit(medir)
+
+    def _esperar(self, futuro):
+        try:
+            return futuro.result(self.espera_maxima)
+        except EsperaAgotada:
+            raise HashSaturado("El cálculo de la contraseña tardó demasiado")
+
+    def generar(self, password):
+        """Hash de la contraseña con el método configurado"""
+        return self._esperar(self._ejecutar('generar', generate_password_hash, password, self.metodo))
+
+    def verificar(self, hash_guardado, password):
+        """True si la contraseña coincide con el hash guardado (de cualquier método)"""
+        return self._esperar(self._ejecutar('verificar', check_password_hash, hash_guardado, password))
+
+    def requiere_rehash(self, hash_guardado):
+        """True si el hash se generó con un método o costo distinto del configurado"""
+        return (hash_guardado or '').split('$', 1)[0] != self.prefijo
+
+    def rehash_en_segundo_plano(self, password, guardar):
+        """Calcula el hash con los parámetros actuales y llama guardar(hash) sin esperar el resultado"""
+        def rehash():
+            try:
+                guardar(generate_password_hash(password, self.metodo))
+                self.rehashes += 1
+            except Exception:
+                traceback.print_exc()
+
+        try:
+            self._ejecutar('generar', rehash)
+        except HashSaturado:
+            # Se reintentará en el próximo inicio de sesión
+            pass
+
+    def metricas(self):
+        return {
+            'metodo': self.prefijo,
+            'max_hilos': self.max_hilos,
+            'max_en_cola': self.max_en_cola,
+            'rechazados': self.rechazados,
+            'rehashes': self.rehashes,
+            'generar': self.tiempos['generar'].resumen(),
+            'verificar': self.tiempos['verificar'].resumen(),
+        }
+
+
+class LimitadorIntentos:
+    """
+    Token bucket en memoria por IP y por usuario. limites = {'ip': (capacidad,
+    segundos_por_token), 'usuario': (...)}: cada intento consume una ficha de
+    ambos cubos y se rechaza si alguno está vacío. Un cubo que volvió a llenarse
+    equivale a no tenerlo, así que se borra al barrer; por encima de max_claves se
+    descartan los menos usados. Los fallos y rechazos se acumulan por (ip, usuario)
+    hasta que resumir_fallos() los entrega.
+    """
+
+    def __init__(self, limites, max_claves=10000, intervalo_barrido=60):
+        self.limites = limites
+        self.max_claves = max_claves
+        self.intervalo_barrido = intervalo_barrido
+        self._cubos = OrderedDict()
+        self._fallos = {}
+        self._lock = threading.Lock()
+        self._ultimo_barrido = time.monotonic()
+        self.permitidos = 0
+        self.rechazados = 0
+        self.fallidos = 0
+        self.exitosos = 0
+
+    def _fichas(self, clave, ahora):
+        capacidad, periodo = self.limites[clave[0]]
+        cubo = self._cubos.get(clave)
+        if cubo is None:
+            return capacidad
+        return min(capacidad, cubo[0] + (ahora - cubo[1]) / periodo)
+
+    def _barrer(self, ahora):
+        if ahora - self._ultimo_barrido < self.intervalo_barrido:
+            return
+        self._ultimo_barrido = ahora
+        llenos = [c for c in self._cubos if self._fichas(c, ahora) >= self.limites[c[0]][0]]
+        for clave in llenos:
+            del self._cubos[clave]
+
+    def _anotar(self, ip, usuario, campo):
+        clave = (ip, usuario)
+        if clave not in self._fallos and len(self._fallos) >= self.max_claves:
+            clave = ('*', '*')
+        ahora = time.time()
+        entrada = self._fallos.setdefault(clave, {'fallos': 0, 'rechazados': 0, 'desde': ahora, 'hasta': ahora})
+        entrada[campo] += 1
+        entrada['hasta'] = ahora
+
+    def permitir(self, ip, usuario):
+        """True si el intento entra en el límite (y consume una ficha de cada cubo)"""
+        usuario = (usuario or '').lower()
+        claves = (('ip', ip), ('usuario', usuario))
+        ahora = time.monotonic()
+        with self._lock:
+            self._barrer(ahora)
+            fichas = [self._fichas(clave, ahora) for clave in claves]
+            if any(f < 1 for f in fichas):
+                self.rechazados += 1
+                self._anotar(ip, usuario, 'rechazados')
+                return False
+
+            for clave, disponibles in zip(claves, fichas):
+                self._cubos[clave] = [disponibles - 1, ahora]
+                self._cubos.move_to_end(clave)
+            while len(self._cubos) > self.max_claves:
+                self._cubos.popitem(last=False)
+            self.permitidos += 1
+            return True
+
+    def fallo(self, ip, usuario):
+        """Intento con usuario inexistente o contraseña incorrecta"""
+        with self._lock:
+            self.fallidos += 1
+            self._anotar(ip, (usuario or '').lower(), 'fallos')
+
+    def exito(self, ip, usuario):
+        """Inicio de sesión correcto: el cubo del usuario vuelve a estar lleno (el de la IP no)"""
+        with self._lock:
+            self.exitosos += 1
+            self._cubos.pop(('usuario', (usuario or '').lower()), None)
+
+    def resumir_fallos(self, inactividad=60, maximo=300):
+        """
+        Entrega y olvida los fallos de cada (ip, usuario) sin intentos en los últimos
+        `inactividad` segundos o acumulados hace más de `maximo` segundos (un ataque
+        largo se resume por tramos).
+        """
+        ahora = time.time()
+        with self._lock:
+            listos = [
+                clave for clave, entrada in self._fallos.items()
+                if ahora - entrada['hasta'] >= inactividad or ahora - entrada['desde'] >= maximo
+            ]
+            return [{'ip': ip, 'usuario': usuario, **self._fallos.pop((ip, usuario))} for ip, usuario in listos]
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'limites': {tipo: {'capacidad': c, 'segundos_por_intento': p} for tipo, (c, p) in self.limites.items()},
+                'permitidos': self.permitidos,
+                'rechazados': self.rechazados,
+                'fallidos': self.fallidos,
+                'exitosos': self.exitosos,
+                'cubos_activos': len(self._cubos),
+                'fallos_sin_resumir': len(self._fallos),
+            }
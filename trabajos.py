@@ -0,0 +1,223 @@
+"""
+Trabajos de exportación en segundo plano del Sistema de Inventario H&D.
+
+Los reportes pesados (Excel, PDF) y las importaciones se ejecutan en un pool
+de hilos acotado en lugar de hacerlo dentro de la petición. Cada trabajo
+informa su progreso, deja el archivo (si produce uno) en una carpeta de spool
+y se borra pasado un tiempo (TTL). Cada usuario tiene un límite de trabajos
+activos a la vez.
+"""
+
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+PENDIENTE = 'pendiente'
+EN_PROCESO = 'en_proceso'
+LISTO = 'listo'
+ERROR = 'error'
+
+
+class LimiteTrabajosExcedido(Exception):
+    """El usuario ya tiene el máximo de trabajos en curso"""
+
+
+class TipoTrabajo:
+    def __init__(self, nombre, generar, nombre_descarga, mimetype, sufijo):
+        self.nombre = nombre
+        self.generar = generar
+        self.nombre_descarga = nombre_descarga
+        self.mimetype = mimetype
+        self.sufijo = sufijo
+
+
+class Trabajo:
+    """Un trabajo: su estado, progreso (0 a 1), detalle informado y archivo resultante"""
+
+    def __init__(self, tipo, usuario_id, parametros, ruta):
+        self.id = uuid.uuid4().hex
+        self.tipo = tipo
+        self.usuario_id = usuario_id
+        self.parametros = parametros
+        self.ruta = ruta
+        self.estado = PENDIENTE
+        self.progreso = 0.0
+        self.mensaje = 'En cola'
+        self.detalle = {}
+        self.error = None
+        self.etag = None
+        self.creado = time.time()
+        self.iniciado = None
+        self.terminado = None
+        self._fin = threading.Event()
+
+    @property
+    def activo(self):
+        return self.estado in (PENDIENTE, EN_PROCESO)
+
+    def segundos_restantes(self):
+        """Estimación lineal del tiempo que falta según el progreso y lo que lleva corriendo"""
+        if self.estado != EN_PROCESO or not self.iniciado or not 0 < self.progreso < 1:
+            return None
+        transcurrido = time.time() - self.iniciado
+        return round(transcurrido * (1 - self.progreso) / self.progreso, 1)
+
+    def a_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo.nombre,
+            'estado': self.estado,
+            'progreso': round(self.progreso * 100, 1),
+            'mensaje': self.mensaje,
+            'detalle': self.detalle,
+            'eta': self.segundos_restantes(),
+            'error': self.error,
+            'nombre_descarga': self.tipo.nombre_descarga,
+            'duracion': round((self.terminado or time.time()) - self.iniciado, 3) if self.iniciado else None,
+        }
+
+
+class GestorTrabajos:
+    """Pool de hilos para trabajos en segundo plano, con límite por usuario y limpieza por TTL"""
+
+    def __init__(self, directorio, max_hilos=2, max_por_usuario=2, ttl=3600, prefijo_hilos='exportacion'):
+        self.directorio = directorio
+        self.max_por_usuario = max_por_usuario
+        self.ttl = ttl
+        self._tipos = {}
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix=prefijo_hilos)
+        self.max_hilos = max_hilos
+        os.makedirs(directorio, exist_ok=True)
+
+    def registrar_tipo(self, nombre, generar, nombre_descarga, mimetype, sufijo):
+        """
+        generar(ruta, progreso, **parametros) escribe el archivo y puede devolver un
+        identificador de su contenido (ETag); progreso(fraccion, mensaje=None, **detalle).
+        Los trabajos sin descarga (nombre_descarga None) pueden usar ruta para guardar
+        sus resultados, que se borran igual al vencer.
+        """
+        self._tipos[nombre] = TipoTrabajo(nombre, generar, nombre_descarga, mimetype, sufijo)
+
+    def tipos(self):
+        return list(self._tipos)
+
+    # ------------------------------------------------------------------- envío
+    def enviar(self, tipo, usuario_id, parametros=None):
+        if tipo not in self._tipos:
+            raise KeyError(tipo)
+
+        self.limpiar_vencidos()
+        definicion = self._tipos[tipo]
+        with self._lock:
+            activos = sum(1 for t in self._trabajos.values() if t.usuario_id == usuario_id and t.activo)
+            if activos >= self.max_por_usuario:
+                raise LimiteTrabajosExcedido(
+                    f"Ya tienes {activos} trabajo(s) en curso. Espera a que terminen."
+                )
+            ruta = os.path.join(self.directorio, f"{uuid.uuid4().hex}{definicion.sufijo}")
+            trabajo = Trabajo(definicion, usuario_id, dict(parametros or {}), ruta)
+            self._trabajos[trabajo.id] = trabajo
+
+        self._pool.submit(self._ejecutar, trabajo)
+        return trabajo
+
+    def _ejecutar(self, trabajo):
+        trabajo.estado = EN_PROCESO
+        trabajo.iniciado = time.time()
+        trabajo.mensaje = 'Generando archivo'
+
+        def progreso(fraccion, mensaje=None, **detalle):
+            trabajo.progreso = min(max(float(fraccion), 0.0), 1.0)
+            if mensaje:
+                trabajo.mensaje = mensaje
+            if detalle:
+                trabajo.detalle = detalle
+
+        # terminado se asigna antes de cambiar el estado: un trabajo no activo
+        # siempre tiene hora de término (limpiar_vencidos la compara)
+        try:
+            trabajo.etag = trabajo.tipo.generar(trabajo.ruta, progreso, **trabajo.parametros)
+            trabajo.progreso = 1.0
+            trabajo.mensaje = 'Listo para descargar' if trabajo.tipo.nombre_descarga else 'Terminado'
+            trabajo.terminado = time.time()
+            trabajo.estado = LISTO
+        except Exception as e:
+            trabajo.error = f"{type(e).__name__}: {e}"
+            trabajo.mensaje = 'Error al generar el archivo' if trabajo.tipo.nombre_descarga else 'Error en el trabajo'
+            trabajo.terminado = time.time()
+            trabajo.estado = ERROR
+            self._borrar_archivo(trabajo.ruta)
+            traceback.print_exc()
+        finally:
+            trabajo._fin.set()
+
+    # ------------------------------------------------------------------ consulta
+    def obtener(self, trabajo_id, usuario_id=None):
+        """El trabajo si existe y pertenece al usuario (None = cualquier usuario)"""
+        with self._lock:
+            trabajo = self._trabajos.get(trabajo_id)
+        if trabajo is None or (usuario_id is not None and trabajo.usuario_id != usuario_id):
+            return None
+        return trabajo
+
+    def esperar(self, trabajo, segundos):
+        """Espera a que el trabajo termine (bien o con error); False si sigue activo al cabo de `segundos`"""
+        return trabajo._fin.wait(segundos)
+
+    def de_usuario(self, usuario_id):
+        with self._lock:
+            trabajos = [t for t in self._trabajos.values() if t.usuario_id == usuario_id]
+        return sorted(trabajos, key=lambda t: t.creado, reverse=True)
+
+    # ------------------------------------------------------------------ limpieza
+    def _borrar_archivo(self, ruta):
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+    def limpiar_vencidos(self):
+        """Quita los trabajos terminados hace más de ttl segundos y los archivos huérfanos del spool"""
+        limite = time.time() - self.ttl
+        with self._lock:
+            vencidos = [
+                t for t in self._trabajos.values()
+                if not t.activo and t.terminado is not None and t.terminado < limite
+            ]
+            for trabajo in vencidos:
+                del self._trabajos[trabajo.id]
+            en_uso = {t.ruta for t in self._trabajos.values()}
+
+        for trabajo in vencidos:
+            self._borrar_archivo(trabajo.ruta)
+
+        huerfanos = 0
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            if ruta in en_uso or not os.path.isfile(ruta):
+                continue
+            if os.path.getmtime(ruta) < limite:
+                self._borrar_archivo(ruta)
+                huerfanos += 1
+
+        return {'trabajos_eliminados': len(vencidos), 'archivos_huerfanos': huerfanos}
+
+    def metricas(self):
+        with self._lock:
+            trabajos = list(self._trabajos.values())
+        por_estado = {}
+        for trabajo in trabajos:
+            por_estado[trabajo.estado] = por_estado.get(trabajo.estado, 0) + 1
+        return {
+            'max_hilos': self.max_hilos,
+            'max_por_usuario': self.max_por_usuario,
+            'ttl': self.ttl,
+            'trabajos': len(trabajos),
+            'por_estado': por_estado,
+        }